@@ -5,11 +5,14 @@ from load_dotenv import load_dotenv
 
 from datasets import load_dataset
 
+from review_index import ReviewIndex, search_parent_asin
+
 import openai
 
 load_dotenv()
 
 api_key = os.environ["OCTOAI_TOKEN"]
+base_url = os.environ.get("OCTOAI_BASE_URL", "https://text.octoai.run/v1")
 model = "mixtral-8x7b-instruct"
 
 SYSTEM_PROMPT = "You are a world class marketer a product reviewver. Every input text you receive you will have a long description with some information about a product and separately some reviews of the product. Your job is to generate a list of short product cards. Each card has two elements: a short description, and a title. Generate the title and description based on the language provided in the designator, that can be English, French, Italian, German, or Spanish. Also, append a list of pros and cons of the product, only based on the reviews. The list of pros and cons should not be longer than 3 elements."
@@ -72,12 +75,8 @@ def generate_descriptions(client: openai.OpenAI, info: str, reviews: str):
     return chat_completion.choices[0].message.content
 
 
-def search_parent_asin(reviews, parent_asin):
-    return [review for review in reviews if review["parent_asin"] == parent_asin]
-
-
 if __name__ == "__main__":
-    client = openai.OpenAI(base_url="https://text.octoai.run/v1", api_key=api_key)
+    client = openai.OpenAI(base_url=base_url, api_key=api_key)
 
     # We use a dataset from Huggingface to quickly
     # see the performance on many examples
@@ -93,8 +92,10 @@ if __name__ == "__main__":
         split="full",
         trust_remote_code=True,
     )
+    # NOTE: built once and cached next to the dataset, every lookup is then a slice instead of a scan of all the reviews
+    review_index = ReviewIndex.load_or_build(reviews, "parent_asin")
     for example in dataset.select(range(1)):
         long_description = example["title"] + "\n" + "".join(example["description"])
-        reviews = search_parent_asin(reviews, example["parent_asin"])
-        long_reviews = "\n".join([review["text"] for review in reviews])
+        product_reviews = search_parent_asin(reviews, example["parent_asin"], review_index)
+        long_reviews = "\n".join([review["text"] for review in product_reviews])
         print(generate_descriptions(client, long_description, long_reviews))
@@ -6,21 +6,29 @@ import base64
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from datasets import load_dataset
-import numpy as np
-from scipy.cluster.hierarchy import linkage, fcluster
 import openai
 import requests
 
 from enum import Enum
 
+from function_calling_cx_agent.clustering import group_customer_issues
+from function_calling_cx_agent.embeddings import BatchedEmbedder, EmbeddingCache
+from function_calling_cx_agent.review_index import ReviewIndex, search_parent_asin
+
 
 load_dotenv()
 
 
 API_KEY = os.environ.get("OCTOAI_TOKEN")
+# NOTE: point it to a local stand-in server, e.g. local_openai_server/, for offline load tests
+BASE_URL = os.environ.get("OCTOAI_BASE_URL", "https://text.octoai.run/v1")
 NUM_PRODUCTS = int(os.environ.get("NUM_PRODUCTS", "5"))
 FUNCTION_MODEL = os.environ.get("FUNCTION_MODEL_NAME", "meta-llama-3.1-8b-instruct")
 JSON_MODEL = "meta-llama-3-8b-instruct"
+EMBEDDING_MODEL = "thenlper/gte-large"
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "64"))
+# NOTE: set it to an empty string to keep the embeddings in memory only
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", ".embedding_cache")
 SYSTEM_PROMPT = ("You are an helpful AI assistant helping a Senior Customer Success Manager interact with users and create user tickets for relevant issues."
                  " You must ensure that you call one of the provided functions if necessary, and only refer to the user feedback you received and nothing more."
                  " You can ask for clarifications multiple times, but thanking the user or asking forgiveness should be done just once.")
@@ -281,46 +289,14 @@ def prepare_jira_ticket_info(client: openai.OpenAI, customer_issues: List[dict])
         print("DEBUG >>>>", chat_completion)
 
 
-def search_parent_asin(reviews, parent_asin):
-    return [review for review in reviews if review["parent_asin"] == parent_asin]
-
-
-def group_customer_issues(customer_issues, issue_embeddings):
-    issue_embeddings_similarity = issue_embeddings.dot(issue_embeddings.T)
-    square_mag = np.diag(issue_embeddings_similarity)
-
-    # inverse squared magnitude
-    inv_square_mag = 1 / square_mag
-
-    # if it doesn't occur, set it's inverse magnitude to zero (instead of inf)
-    inv_square_mag[np.isinf(inv_square_mag)] = 0
-
-    # inverse of the magnitude
-    inv_mag = np.sqrt(inv_square_mag)
-        
-    # cosine similarity (elementwise multiply by inverse magnitudes)
-    cosine = issue_embeddings_similarity * inv_mag
-    cosine_similarity = cosine.T * inv_mag
-
-    # values on the diagonal should not interfere
-    np.fill_diagonal(cosine_similarity, -1)
-
-
-    distance_matrix = 1 - np.abs(cosine_similarity)
-    linkage_matrix = linkage(distance_matrix, method='ward')
-    threshold = 0.15
-    clusters = fcluster(linkage_matrix, threshold, criterion='distance')
-
-
-    grouped_customer_issues = []
-    for unique_cluster_id in set(clusters):
-        related_issues = [customer_issues[idx] for idx, cluster_id in enumerate(clusters) if cluster_id == unique_cluster_id]
-        grouped_customer_issues.append(related_issues)
-    return grouped_customer_issues
+def embed_batch(client: openai.OpenAI, texts: List[str]):
+    # NOTE: need to check context legnth of the model
+    resp = client.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+    return [item.embedding for item in sorted(resp.data, key=lambda item: item.index)]
 
 
 if __name__ == "__main__":
-    client = openai.OpenAI(base_url="https://text.octoai.run/v1", api_key=API_KEY)
+    client = openai.OpenAI(base_url=BASE_URL, api_key=API_KEY)
 
     # We use a dataset from Huggingface to quickly
     # see the performance on many examples
@@ -336,13 +312,15 @@ if __name__ == "__main__":
         split="full",
         trust_remote_code=True,
     )
+    # NOTE: built once and cached next to the dataset, every lookup is then a slice instead of a scan of all the reviews
+    review_index = ReviewIndex.load_or_build(reviews, "parent_asin")
 
 
     # 1: structure_customer_feedback
     customer_feedbacks = []
     for example in dataset.select(range(NUM_PRODUCTS)):
         long_description = example["title"] + "\n" + "".join(example["description"])
-        product_reviews = search_parent_asin(reviews, example["parent_asin"])
+        product_reviews = search_parent_asin(reviews, example["parent_asin"], review_index)
         for review in product_reviews:
             customer_feedback = process_review(client, long_description, review["text"])
             customer_feedbacks.append(customer_feedback)
@@ -351,18 +329,10 @@ if __name__ == "__main__":
     print("products =", NUM_PRODUCTS, "issues =", len(CUSTOMER_ISSUES_REGISTRY), "feedbacks =", len(customer_feedbacks))
 
 
-    # 3: group by high similarity using GTE model from OctoAI
-    issue_embeddings = []
-    for issue in CUSTOMER_ISSUES_REGISTRY:
-        # NOTE: need to check context legnth of the model
-        resp = client.embeddings.create(
-            model="thenlper/gte-large",
-            input=f"Product Name: {issue['product_name']} (Category - {issue['category']})\n\nIssue:\n{issue['description']}",
-        )
-
-        issue_embeddings.append(resp.data[0].embedding)
-
-    issue_embeddings = np.array(issue_embeddings)
+    # 3: group by high similarity using GTE model from OctoAI, with batched requests, only for the issues not embedded by a previous run
+    embedder = BatchedEmbedder(lambda texts: embed_batch(client, texts), EmbeddingCache(EMBEDDING_CACHE_DIR, EMBEDDING_MODEL),
+                               batch_size=EMBEDDING_BATCH_SIZE)
+    issue_embeddings = embedder.embed([f"Product Name: {issue['product_name']} (Category - {issue['category']})\n\nIssue:\n{issue['description']}" for issue in CUSTOMER_ISSUES_REGISTRY])
 
     grouped_customer_issues = group_customer_issues(CUSTOMER_ISSUES_REGISTRY, issue_embeddings)
 
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+
+def text_key(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """On-disk cache of the embeddings of one model, keyed by the SHA-256 of the embedded text.
+
+    The vectors are appended to a float32 matrix, read back as a memory mapped array, and the keys to a text
+    file, one per line, in the same order. The vectors are always written before their keys, and the dimension
+    file after both, so an interrupted run leaves at most a few extra vectors, which are truncated away on the next start.
+    With `cache_dir=None` the vectors are only kept in memory.
+    """
+
+    def __init__(self, cache_dir, model_name):
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.dim = None
+        self.vectors = None
+        self.dir = os.path.join(cache_dir, model_name.replace("/", "--")) if cache_dir else None
+        if self.dir is None:
+            return
+
+        os.makedirs(self.dir, exist_ok=True)
+        self.vectors_path = os.path.join(self.dir, "vectors.f32")
+        self.keys_path = os.path.join(self.dir, "keys.txt")
+        self.meta_path = os.path.join(self.dir, "meta.json")
+        if not os.path.exists(self.meta_path):
+            # NOTE: the first run was interrupted before the dimension was known, whatever it wrote is unusable
+            for path in (self.vectors_path, self.keys_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        with open(self.meta_path) as f:
+            self.dim = json.load(f)["dim"]
+        keys = []
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path) as f:
+                # NOTE: a key cut short by an interrupted write is dropped
+                keys = [line.strip() for line in f if len(line.strip()) == 64]
+        num_vectors = os.path.getsize(self.vectors_path) // (4 * self.dim) if os.path.exists(self.vectors_path) else 0
+        num_rows = min(len(keys), num_vectors)
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(num_rows * self.dim * 4)
+        with open(self.keys_path, "w") as f:
+            f.writelines(key + "\n" for key in keys[:num_rows])
+        self.rows = {key: row for row, key in enumerate(keys[:num_rows])}
+        self.open_vectors()
+
+    def open_vectors(self):
+        if self.rows:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(self.rows), self.dim))
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def add(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self.lock:
+            is_new = [key not in self.rows for key in keys]
+            keys = [key for key, new in zip(keys, is_new) if new]
+            vectors = vectors[is_new]
+            if not keys:
+                return
+
+            is_first = self.dim is None
+            self.dim = vectors.shape[1]
+
+            if self.dir is None:
+                self.vectors = vectors if self.vectors is None else np.concatenate([self.vectors, vectors])
+            else:
+                with open(self.vectors_path, "ab") as f:
+                    f.write(vectors.tobytes())
+                with open(self.keys_path, "a") as f:
+                    f.writelines(key + "\n" for key in keys)
+                if is_first:
+                    # NOTE: written last, and atomically, so it only exists once there are vectors and keys to read
+                    tmp_path = f"{self.meta_path}.{os.getpid()}.tmp"
+                    with open(tmp_path, "w") as f:
+                        json.dump({"dim": self.dim}, f)
+                    os.replace(tmp_path, self.meta_path)
+            for key in keys:
+                self.rows[key] = len(self.rows)
+            if self.dir is not None:
+                self.open_vectors()
+
+    def get(self, keys):
+        with self.lock:
+            if not keys:
+                return np.zeros((0, self.dim or 0), dtype=np.float32)
+            return np.asarray(self.vectors[[self.rows[key] for key in keys]])
+
+
+def make_batches(texts, batch_size, max_batch_tokens):
+    """Consecutive batches of at most `batch_size` texts and about `max_batch_tokens` tokens."""
+    batches, batch, batch_tokens = [], [], 0
+    for text in texts:
+        # NOTE: ~4 characters per token for English text, no need for the exact count of the embedding model's tokenizer
+        num_tokens = len(text) // 4 + 1
+        if batch and (len(batch) == batch_size or batch_tokens + num_tokens > max_batch_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += num_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class BatchedEmbedder:
+    """Embeds many texts with a few batched requests, running concurrently, and only the texts not cached yet.
+
+    `embed_batch` takes a list of texts and returns their embeddings, in the same order.
+    """
+
+    def __init__(self, embed_batch, cache, batch_size=64, max_batch_tokens=8192, max_concurrency=4):
+        self.embed_batch = embed_batch
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_concurrency = max_concurrency
+
+    def embed(self, texts):
+        """float32 matrix with the embedding of every text, one row per text."""
+        keys = [text_key(text) for text in texts]
+        # NOTE: the same text is only embedded once, even when it's repeated
+        missing = list({key: text for key, text in zip(keys, texts) if key not in self.cache}.values())
+        batches = make_batches(missing, self.batch_size, self.max_batch_tokens)
+
+        if batches:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+                futures = {executor.submit(self.embed_batch, batch): batch for batch in batches}
+                # NOTE: every batch is cached as soon as it's done, so a failed run doesn't lose the others
+                for future in as_completed(futures):
+                    self.cache.add([text_key(text) for text in futures[future]], future.result())
+        return self.cache.get(keys)
@@ -0,0 +1,361 @@
+"""A local stand-in for the OpenAI-compatible OctoAI text endpoint, to load test and profile the cookbook offline.
+
+python server.py --profile octoai --port 8080
+
+Serves `POST /v1/chat/completions` (with streaming, `response_format` JSON mode and `tools`),
+`POST /v1/embeddings` and `GET /v1/models`, plus `GET /stats` with the request counters.
+The outputs are canned: they only depend on the request and on `--seed`, so two runs of the same
+pipeline see exactly the same responses. Only the standard library is needed.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import struct
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# NOTE: time to first token and delay per output token, in seconds, the jitter is relative to both
+PROFILES = {"instant": {"ttft": 0.0, "token_delay": 0.0, "jitter": 0.0},
+            "fast": {"ttft": 0.15, "token_delay": 0.005, "jitter": 0.1},
+            "octoai": {"ttft": 0.35, "token_delay": 0.015, "jitter": 0.2},
+            "slow": {"ttft": 1.5, "token_delay": 0.05, "jitter": 0.3}}
+
+WORDS = ("the customer product issue subscription magazine delivery quality order price support account "
+         "review summary contract payment report team service month issue received page content shipping "
+         "package refund update request experience problem value format print digital weekly annual").split()
+
+
+def estimate_tokens(text):
+    # NOTE: ~4 characters per token, close enough to the real tokenizers to compare the pipelines' usage
+    return max(1, math.ceil(len(text) / 4)) if text else 0
+
+
+def request_rng(*parts):
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).digest()
+    return random.Random(int.from_bytes(digest[:8], "little"))
+
+
+def canned_text(rng, num_tokens):
+    words, sentence_len = [], 0
+    for idx in range(num_tokens):
+        word = rng.choice(WORDS)
+        if sentence_len == 0:
+            word = word.capitalize()
+        sentence_len += 1
+        if idx == num_tokens - 1 or (sentence_len > 6 and rng.random() < 0.15):
+            word, sentence_len = word + ".", 0
+        words.append(word)
+    return " ".join(words)
+
+
+def value_from_schema(schema, rng, defs, depth=0):
+    """A value matching the JSON schema, covering what pydantic's `model_json_schema` produces."""
+    if "$ref" in schema:
+        return value_from_schema(defs[schema["$ref"].split("/")[-1]], rng, defs, depth)
+    if "const" in schema:
+        return schema["const"]
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            options = [option for option in schema[key] if option.get("type") != "null"] or schema[key]
+            return value_from_schema(options[0], rng, defs, depth)
+    if "allOf" in schema:
+        return value_from_schema(schema["allOf"][0], rng, defs, depth)
+
+    schema_type = schema.get("type", "object" if "properties" in schema else "string")
+    if isinstance(schema_type, list):
+        schema_type = next((name for name in schema_type if name != "null"), "null")
+
+    if schema_type == "object":
+        properties = schema.get("properties", {})
+        return {name: value_from_schema(prop, rng, defs, depth + 1) for name, prop in properties.items()}
+    if schema_type == "array":
+        min_items = schema.get("minItems", 1)
+        max_items = schema.get("maxItems", max(min_items, 3))
+        num_items = rng.randint(min_items, max_items) if depth < 4 else min_items
+        return [value_from_schema(schema.get("items", {}), rng, defs, depth + 1) for _ in range(num_items)]
+    if schema_type == "boolean":
+        return rng.random() < 0.5
+    if schema_type == "integer":
+        return rng.randint(schema.get("minimum", 0), schema.get("maximum", 100))
+    if schema_type == "number":
+        return round(rng.uniform(schema.get("minimum", 0.0), schema.get("maximum", 100.0)), 3)
+    if schema_type == "null":
+        return None
+    text = canned_text(rng, rng.randint(2, 12))
+    return text[:schema["maxLength"]] if "maxLength" in schema else text
+
+
+class StandInBackend:
+    """Decides what every request gets back: the canned payload, the latency, and the injected failures."""
+
+    def __init__(self, ttft, token_delay, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, max_in_flight=0,
+                 output_tokens=128, embedding_dim=1024, embedding_delay=0.02, seed=0):
+        self.ttft = ttft
+        self.token_delay = token_delay
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.max_in_flight = max_in_flight
+        self.output_tokens = output_tokens
+        self.embedding_dim = embedding_dim
+        self.embedding_delay = embedding_delay
+        self.seed = seed
+
+        # NOTE: the number of times every request body was seen, its retries draw new failures
+        self.attempts = {}
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.counters = {"requests": 0, "errors": 0, "rate_limited": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def count(self, **increments):
+        with self.lock:
+            for name, value in increments.items():
+                self.counters[name] += value
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, in_flight=self.in_flight)
+
+    def admit(self, request):
+        """Returns the (status, message) of an injected failure, or None when the request goes through.
+
+        Whether a request fails only depends on its body, on `--seed` and on how many times the same body was
+        sent before, not on the order the requests arrive in, so concurrent runs fail the same requests,
+        and a retry gets a new draw and can succeed.
+        """
+        key = hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+        with self.lock:
+            self.counters["requests"] += 1
+            attempt_no = self.attempts.get(key, 0)
+            self.attempts[key] = attempt_no + 1
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                self.counters["rate_limited"] += 1
+                return 429, "Too many requests in flight"
+            draw = request_rng(self.seed, "failure", key, attempt_no).random()
+            if draw < self.rate_limit_rate:
+                self.counters["rate_limited"] += 1
+                return 429, "Rate limit exceeded"
+            if draw < self.rate_limit_rate + self.error_rate:
+                self.counters["errors"] += 1
+                return 500, "Injected server error"
+            self.in_flight += 1
+            return None
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def delay(self, seconds, rng):
+        if seconds > 0:
+            time.sleep(max(0.0, seconds * (1 + rng.uniform(-self.jitter, self.jitter))))
+
+    def chat_completion(self, request):
+        """The (message, finish_reason, output chunks) of a chat completion request."""
+        messages = request.get("messages", [])
+        rng = request_rng(self.seed, request.get("model"), messages, request.get("tools"), request.get("response_format"))
+        max_tokens = request.get("max_tokens") or self.output_tokens
+        tools = request.get("tools") or []
+        tool_choice = request.get("tool_choice", "auto")
+        response_format = request.get("response_format") or {}
+
+        # NOTE: call a tool until the conversation contains a tool result, then answer in plain text
+        if tools and tool_choice != "none" and not (messages and messages[-1].get("role") == "tool"):
+            if isinstance(tool_choice, dict):
+                function = next(tool["function"] for tool in tools if tool["function"]["name"] == tool_choice["function"]["name"])
+            else:
+                function = rng.choice(tools)["function"]
+            parameters = function.get("parameters") or {"type": "object", "properties": {}}
+            arguments = json.dumps(value_from_schema(parameters, rng, parameters.get("$defs", {})))
+            tool_call = {"id": f"call_{uuid.UUID(int=rng.getrandbits(128)).hex[:24]}", "type": "function",
+                         "function": {"name": function["name"], "arguments": arguments}}
+            return {"role": "assistant", "content": None, "tool_calls": [tool_call]}, "tool_calls", [arguments]
+
+        if response_format.get("type") == "json_object":
+            schema = response_format.get("schema") or {"type": "object", "properties": {"response": {"type": "string"}}}
+            content = json.dumps(value_from_schema(schema, rng, schema.get("$defs", {})))
+            # NOTE: streamed as pieces of ~4 characters, like a tokenizer would
+            return {"role": "assistant", "content": content}, "stop", [content[idx: idx + 4] for idx in range(0, len(content), 4)]
+
+        num_tokens = min(max_tokens, max(1, int(self.output_tokens * rng.uniform(0.5, 1.0))))
+        words = canned_text(rng, num_tokens).split(" ")
+        finish_reason = "length" if num_tokens == max_tokens else "stop"
+        pieces = [word if idx == 0 else " " + word for idx, word in enumerate(words)]
+        return {"role": "assistant", "content": "".join(pieces)}, finish_reason, pieces
+
+    def embedding(self, text):
+        rng = request_rng(self.seed, "embedding", text)
+        vector = [rng.gauss(0.0, 1.0) for _ in range(self.embedding_dim)]
+        norm = math.sqrt(sum(value * value for value in vector))
+        return [value / norm for value in vector]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    backend: StandInBackend = None
+    verbose = False
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        error_type = "rate_limit_error" if status == 429 else "server_error"
+        self.send_json(status, {"error": {"message": message, "type": error_type, "code": status}},
+                       headers={"Retry-After": "1"} if status == 429 else None)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": "local-stand-in", "object": "model", "owned_by": "local"}]})
+        elif self.path.rstrip("/").endswith("/stats"):
+            self.send_json(200, self.backend.stats())
+        else:
+            self.send_error_json(404, f"Unknown path {self.path}")
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = self.path.rstrip("/")
+        if not path.endswith(("/chat/completions", "/embeddings")):
+            self.send_error_json(404, f"Unknown path {self.path}")
+            return
+
+        failure = self.backend.admit(request)
+        if failure is not None:
+            self.send_error_json(*failure)
+            return
+
+        try:
+            if path.endswith("/chat/completions"):
+                self.chat_completions(request)
+            else:
+                self.embeddings(request)
+        finally:
+            self.backend.release()
+
+    def chat_completions(self, request):
+        backend = self.backend
+        message, finish_reason, pieces = backend.chat_completion(request)
+        prompt_tokens = sum(estimate_tokens(json.dumps(msg.get("content")) if not isinstance(msg.get("content"), str) else msg["content"])
+                            for msg in request.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(pieces), "total_tokens": prompt_tokens + len(pieces)}
+        backend.count(prompt_tokens=prompt_tokens, completion_tokens=len(pieces))
+
+        rng = random.Random()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = request.get("model", "local-stand-in")
+        backend.delay(backend.ttft, rng)
+
+        if not request.get("stream"):
+            backend.delay(backend.token_delay * len(pieces), rng)
+            self.send_json(200, {"id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                                 "choices": [{"index": 0, "message": message, "finish_reason": finish_reason, "logprobs": None}],
+                                 "usage": usage})
+            return
+
+        # NOTE: no Content-Length for the event stream, the connection is closed once it's done
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send_event(payload):
+            self.wfile.write(b"data: " + (payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")) + b"\n\n")
+            self.wfile.flush()
+
+        def chunk(delta, chunk_finish_reason=None, chunk_usage=None):
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                       "choices": [{"index": 0, "delta": delta, "finish_reason": chunk_finish_reason, "logprobs": None}]}
+            if chunk_usage is not None:
+                payload["usage"] = chunk_usage
+            return payload
+
+        if message.get("tool_calls"):
+            tool_calls = [dict(tool_call, index=idx) for idx, tool_call in enumerate(message["tool_calls"])]
+            send_event(chunk({"role": "assistant", "content": None, "tool_calls": tool_calls}))
+            backend.delay(backend.token_delay * len(pieces), rng)
+        else:
+            for idx, piece in enumerate(pieces):
+                if idx > 0:
+                    backend.delay(backend.token_delay, rng)
+                send_event(chunk({"role": "assistant", "content": piece} if idx == 0 else {"content": piece}))
+        send_event(chunk({}, finish_reason, usage))
+        send_event(b"[DONE]")
+
+    def embeddings(self, request):
+        backend = self.backend
+        inputs = request.get("input", [])
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        backend.delay(backend.embedding_delay * max(1, len(inputs)) ** 0.5, random.Random())
+
+        data = []
+        for idx, text in enumerate(inputs):
+            vector = backend.embedding(text if isinstance(text, str) else json.dumps(text))
+            if request.get("encoding_format") == "base64":
+                # NOTE: the openai client asks for base64 float32 by default when numpy is installed
+                vector = base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode("ascii")
+            data.append({"object": "embedding", "index": idx, "embedding": vector})
+
+        num_tokens = sum(estimate_tokens(text if isinstance(text, str) else json.dumps(text)) for text in inputs)
+        backend.count(prompt_tokens=num_tokens)
+        self.send_json(200, {"object": "list", "data": data, "model": request.get("model", "local-stand-in"),
+                             "usage": {"prompt_tokens": num_tokens, "total_tokens": num_tokens}})
+
+
+def serve(host="127.0.0.1", port=8080, verbose=False, **backend_kwargs):
+    handler = type("StandInHandler", (Handler,), {"backend": StandInBackend(**backend_kwargs), "verbose": verbose})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--profile", choices=list(PROFILES), default="octoai", help="Latency profile, the flags below override its values")
+    parser.add_argument("--ttft", type=float, default=None, help="Seconds before the first output token")
+    parser.add_argument("--token_delay", type=float, default=None, help="Seconds between two output tokens")
+    parser.add_argument("--jitter", type=float, default=None, help="Relative random variation of every delay, e.g. 0.2 for +-20%%")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of the requests failing with a 500")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="Fraction of the requests failing with a 429")
+    parser.add_argument("--max_in_flight", type=int, default=0, help="Requests above this many in flight get a 429, 0 for no limit")
+    parser.add_argument("--output_tokens", type=int, default=128, help="Typical length of the canned text answers")
+    parser.add_argument("--embedding_dim", type=int, default=1024)
+    parser.add_argument("--embedding_delay", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=0, help="Changes the canned outputs and which requests fail")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    profile = PROFILES[args.profile]
+    server = serve(args.host, args.port, verbose=args.verbose,
+                   ttft=profile["ttft"] if args.ttft is None else args.ttft,
+                   token_delay=profile["token_delay"] if args.token_delay is None else args.token_delay,
+                   jitter=profile["jitter"] if args.jitter is None else args.jitter,
+                   error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, max_in_flight=args.max_in_flight,
+                   output_tokens=args.output_tokens, embedding_dim=args.embedding_dim,
+                   embedding_delay=args.embedding_delay, seed=args.seed)
+    print(f"Serving on http://{args.host}:{args.port}/v1, export OCTOAI_BASE_URL=http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
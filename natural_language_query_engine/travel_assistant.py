@@ -78,7 +78,7 @@ if len(audio) > 0:
     data_frame = pd.DataFrame.from_records(results)
 
     client = OpenAI(
-        base_url="https://text.octoai.run/v1",
+        base_url=os.environ.get("OCTOAI_BASE_URL", "https://text.octoai.run/v1"),
         api_key=os.environ["OCTOAI_API_TOKEN"],
     )
     system_prompt = "You are a helpful travel agent. You are given a user request complemented by context retrieved from a database that contains relevant information. Please provide helpful advice to the user as much as possible."
@@ -1,52 +1,242 @@
+import bisect
+import json
+import math
+import random
+import threading
 import time
-import uuid
+from collections import Counter
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+import openai
 import pandas as pd
 
 
-class Benchmark:
+# NOTE: geometric buckets from 1ms to ~3h, each 19% wider than the previous one, so the percentiles are within ~10%
+LATENCY_BUCKETS = [0.001 * 2 ** (idx / 4) for idx in range(96)]
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram, recording a value is a binary search and an increment."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # NOTE: the last bucket counts the values above the last bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """Interpolated within the bucket holding the q-th percentile, like Prometheus' histogram_quantile."""
+        if self.count == 0:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = self.bounds[idx - 1] if idx > 0 else 0.0
+                high = self.bounds[idx] if idx < len(self.bounds) else self.bounds[-1]
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+class StageMetrics:
     def __init__(self):
-        self.error_per_run: dict = {}
-        self.token_usage_per_run: dict = {}
-        self.retries_per_run: dict = {}
-        self.total_time_per_run: dict = {}
-
-    def new_run(self):
-        run_id = f"run-{uuid.uuid4()}"
-        self.error_per_run[run_id] = False
-        self.retries_per_run[run_id] = 0
-        self.token_usage_per_run[run_id] = [0, 0]
-        self.total_time_per_run[run_id] = time.perf_counter()
-        return run_id
-    
-    def add_input_tokens(self, run_id, usage):
-        self.token_usage_per_run[run_id][0] += usage.prompt_tokens
-        self.token_usage_per_run[run_id][1] += usage.completion_tokens
-
-    def increment_retries(self, run_id):
-        self.retries_per_run[run_id] += 1
-
-    def end_with_error(self, run_id):
-        self.error_per_run[run_id] = True
-        self.total_time_per_run[run_id] = time.perf_counter() - self.total_time_per_run[run_id]
-
-    def end(self, run_id):
-        self.total_time_per_run[run_id] = time.perf_counter() - self.total_time_per_run[run_id]
+        self.latency = LatencyHistogram()
+        self.num_runs = 0
+        self.num_errors = 0
+        self.num_retries = 0
+        self.retry_errors = Counter()
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.first_start = math.inf
+        self.last_end = 0.0
+
+    def summary(self):
+        wall_clock_seconds = max(0.0, self.last_end - self.first_start)
+        return {"num_runs": self.num_runs,
+                "num_errors": self.num_errors,
+                "num_retries": self.num_retries,
+                "retry_errors": dict(self.retry_errors),
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "mean_latency_seconds": self.latency.sum / self.latency.count if self.latency.count else None,
+                "p50_latency_seconds": self.latency.percentile(50),
+                "p95_latency_seconds": self.latency.percentile(95),
+                "p99_latency_seconds": self.latency.percentile(99),
+                "wall_clock_seconds": wall_clock_seconds,
+                # NOTE: over the time the stage was running, so concurrent runs add up
+                "output_tokens_per_second": self.output_tokens / wall_clock_seconds if wall_clock_seconds > 0 else None}
+
+
+class Run:
+    """One timed unit of work, e.g. a request and its retries. Only the thread or task running it touches it."""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = time.perf_counter()
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.retries = 0
+        self.retry_errors = Counter()
+        self.is_error = False
+
+    def add_usage(self, usage):
+        self.input_tokens += usage.prompt_tokens
+        # NOTE: the embeddings' usage has no completion tokens
+        self.output_tokens += getattr(usage, "completion_tokens", 0) or 0
+
+    def retry(self, err=None):
+        self.retries += 1
+        if err is not None:
+            self.retry_errors[type(err).__name__] += 1
+
+    def error(self):
+        self.is_error = True
+
+
+class MetricsRecorder:
+    """Concurrency-safe recorder of the latency, tokens, retries and errors of every stage of a pipeline.
+
+    Every run is timed with `with recorder.run("stage") as run:`, the run object is private to the caller,
+    and only its final numbers are merged into the per-stage histograms and counters, under a lock.
+    So it's safe to use from many threads, and from asyncio tasks since nothing is kept per thread.
+    A run ending with an exception counts as an error.
+    """
+
+    def __init__(self, keep_runs=True):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.keep_runs = keep_runs
+        self.runs = []
+
+    @contextmanager
+    def run(self, stage):
+        run = Run(stage)
+        try:
+            yield run
+        except BaseException:
+            run.error()
+            raise
+        finally:
+            self.finish(run)
+
+    def finish(self, run):
+        end = time.perf_counter()
+        with self.lock:
+            stage = self.stages.setdefault(run.stage, StageMetrics())
+            stage.latency.record(end - run.start)
+            stage.num_runs += 1
+            stage.num_errors += run.is_error
+            stage.num_retries += run.retries
+            stage.retry_errors.update(run.retry_errors)
+            stage.input_tokens += run.input_tokens
+            stage.output_tokens += run.output_tokens
+            stage.first_start = min(stage.first_start, run.start)
+            stage.last_end = max(stage.last_end, end)
+            if self.keep_runs:
+                # NOTE: the same columns as the per-run CSV had before the stages were added
+                self.runs.append({"stage": run.stage,
+                                  "error_per_run": run.is_error,
+                                  "retries_per_run": run.retries,
+                                  "input_token_usage_per_run": run.input_tokens,
+                                  "output_token_usage_per_run": run.output_tokens,
+                                  "total_time_per_run": end - run.start})
+
+    def summary(self):
+        with self.lock:
+            return {name: stage.summary() for name, stage in self.stages.items()}
+
+    def to_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def to_prometheus(self, prefix="structured_generation"):
+        """The metrics in the Prometheus text exposition format, one label per stage."""
+        lines = []
+        with self.lock:
+            stages = list(self.stages.items())
+            lines += [f"# HELP {prefix}_latency_seconds Latency of the runs, including their retries.",
+                      f"# TYPE {prefix}_latency_seconds histogram"]
+            for name, stage in stages:
+                cumulative = 0
+                for bound, count in zip(stage.latency.bounds, stage.latency.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}_latency_seconds_bucket{{stage="{name}",le="{bound:.6g}"}} {cumulative}')
+                lines.append(f'{prefix}_latency_seconds_bucket{{stage="{name}",le="+Inf"}} {stage.latency.count}')
+                lines.append(f'{prefix}_latency_seconds_sum{{stage="{name}"}} {stage.latency.sum}')
+                lines.append(f'{prefix}_latency_seconds_count{{stage="{name}"}} {stage.latency.count}')
+
+            for metric, attribute, help_text in [("runs_total", "num_runs", "Number of runs."),
+                                                 ("errors_total", "num_errors", "Number of runs ending with an error."),
+                                                 ("retries_total", "num_retries", "Number of retried requests."),
+                                                 ("input_tokens_total", "input_tokens", "Number of prompt tokens."),
+                                                 ("output_tokens_total", "output_tokens", "Number of completion tokens.")]:
+                lines += [f"# HELP {prefix}_{metric} {help_text}", f"# TYPE {prefix}_{metric} counter"]
+                lines += [f'{prefix}_{metric}{{stage="{name}"}} {getattr(stage, attribute)}' for name, stage in stages]
+
+            lines += [f"# HELP {prefix}_retry_errors_total Number of retried requests by the error they got.",
+                      f"# TYPE {prefix}_retry_errors_total counter"]
+            lines += [f'{prefix}_retry_errors_total{{stage="{name}",error="{error}"}} {count}'
+                      for name, stage in stages for error, count in sorted(stage.retry_errors.items())]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="structured_generation"):
+        with open(path, "w") as f:
+            f.write(self.to_prometheus(prefix))
 
     def print_summary(self, save_to_file=None):
-        run_ids = list(self.token_usage_per_run.keys())
-        summary_df = pd.DataFrame({
-            "run_ids": run_ids,
-            "error_per_run": [self.error_per_run[rid] for rid in run_ids],
-            "retries_per_run": [self.retries_per_run[rid] for rid in run_ids],
-            "input_token_usage_per_run": [self.token_usage_per_run[rid][0] for rid in run_ids],
-            "output_token_usage_per_run": [self.token_usage_per_run[rid][1] for rid in run_ids],
-            "total_time_per_run": [self.total_time_per_run[rid] for rid in run_ids],
-        })
-
-        print(summary_df)
-
-        if save_to_file is not None:
+        print(pd.DataFrame.from_dict(self.summary(), orient="index"))
+
+        if save_to_file is not None and self.keep_runs:
+            with self.lock:
+                runs_df = pd.DataFrame(self.runs)
             if isinstance(save_to_file, str):
-                summary_df.to_csv(save_to_file)
+                runs_df.to_csv(save_to_file)
             else:
-                summary_df.to_csv("benchmark_measurements.csv")
+                runs_df.to_csv("benchmark_measurements.csv")
+
+
+def retry_after_seconds(err):
+    """The delay asked by the `Retry-After` header of a 429 response, in seconds, None without one."""
+    response = getattr(err, "response", None)
+    if response is None or response.status_code != 429:
+        return None
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        # NOTE: the header can also be an HTTP date
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def create_with_backoff(create, run, max_retries=5, base_delay=0.5, max_delay=30.0, **kwargs):
+    """Calls `create(**kwargs)`, retrying rate limited (429), failed (5xx) and dropped requests.
+
+    A 429 waits as long as its `Retry-After` header asks, up to `max_delay`, every other retry waits a
+    full jitter exponential backoff. The retries and their errors are recorded in `run`, not printed.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return create(**kwargs)
+        except (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError) as err:
+            if attempt == max_retries:
+                raise
+            run.retry(err)
+            delay = retry_after_seconds(err)
+            if delay is None:
+                # NOTE: a random delay up to the exponential one, so the concurrent requests don't all come back at once
+                delay = random.uniform(0, base_delay * 2 ** attempt)
+            time.sleep(min(max_delay, delay))
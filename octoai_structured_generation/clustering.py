@@ -0,0 +1,65 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+def normalize(embeddings):
+    """float32 copy of the embeddings with unit L2 norms, the all-zero rows stay zero."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.where(norms > 0, norms, 1.0)
+
+
+def knn_graph(embeddings, k=10, min_similarity=0.85, block_size=256):
+    """Sparse graph linking every embedding to its `k` most similar ones, if their cosine similarity is at least `min_similarity`.
+
+    The similarities are computed exactly, one block of rows at a time, so the memory is `block_size` x N for the
+    current block plus N x k for the edges, never N x N.
+    """
+    vectors = normalize(embeddings)
+    num_vectors = len(vectors)
+    k = min(k, num_vectors - 1)
+    if k <= 0:
+        return coo_matrix((num_vectors, num_vectors), dtype=np.float32).tocsr()
+
+    sources, targets, weights = [], [], []
+    for start in range(0, num_vectors, block_size):
+        block_rows = np.arange(start, min(start + block_size, num_vectors))
+        similarities = vectors[block_rows] @ vectors.T
+        # NOTE: an embedding isn't its own neighbour
+        similarities[np.arange(len(block_rows)), block_rows] = -np.inf
+        neighbours = np.argpartition(similarities, -k, axis=1)[:, -k:]
+        neighbour_similarities = np.take_along_axis(similarities, neighbours, axis=1)
+        is_edge = neighbour_similarities >= min_similarity
+        sources.append(np.repeat(block_rows, k)[is_edge.ravel()])
+        targets.append(neighbours[is_edge])
+        weights.append(neighbour_similarities[is_edge])
+
+    return coo_matrix((np.concatenate(weights), (np.concatenate(sources), np.concatenate(targets))),
+                      shape=(num_vectors, num_vectors)).tocsr()
+
+
+def cluster_embeddings(embeddings, k=10, min_similarity=0.85, block_size=256):
+    """Cluster label of every embedding, the connected components of its k-nearest-neighbour graph.
+
+    Two embeddings end up in the same cluster when a chain of neighbours, each at least `min_similarity`
+    similar to the next, links them, i.e. a single linkage clustering cut at a distance of `1 - min_similarity`.
+    """
+    if len(embeddings) == 0:
+        return np.zeros(0, dtype=np.int64)
+    graph = knn_graph(embeddings, k=k, min_similarity=min_similarity, block_size=block_size)
+    # NOTE: weak connectivity, an edge in either direction links two embeddings
+    _, labels = connected_components(graph, directed=True, connection="weak")
+    return labels
+
+
+def group_customer_issues(customer_issues, issue_embeddings, k=10, min_similarity=0.85):
+    """The customer issues grouped by cluster, the groups and the issues within them keep the order of `customer_issues`."""
+    labels = cluster_embeddings(issue_embeddings, k=k, min_similarity=min_similarity)
+    _, first_seen, group_ids = np.unique(labels, return_index=True, return_inverse=True)
+    group_order = np.argsort(np.argsort(first_seen))
+
+    grouped_customer_issues = [[] for _ in first_seen]
+    for issue, group_id in zip(customer_issues, group_ids):
+        grouped_customer_issues[group_order[group_id]].append(issue)
+    return grouped_customer_issues
@@ -0,0 +1,89 @@
+"""Compares the time and peak memory of the k-nearest-neighbour issue clustering with the previous dense one.
+
+python clustering_benchmark.py --sizes 1000 5000 20000 100000 --dim 1024 --max_dense_size 5000
+
+The embeddings are synthetic: random unit centers, one per `--issues_per_cluster` issues, plus Gaussian noise,
+so the expected clusters are known and the agreement of every method with them is reported as well.
+The dense method builds the N x N cosine matrix and a Ward linkage of its rows, it's only run up to `--max_dense_size`.
+"""
+import argparse
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+from scipy.cluster.hierarchy import fcluster, linkage
+
+from clustering import cluster_embeddings
+
+
+def dense_ward_clusters(embeddings, threshold=0.15):
+    # NOTE: the clustering of group_customer_issues before the k-nearest-neighbour graph
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    norms = np.linalg.norm(embeddings, axis=1)
+    cosine_similarity = embeddings @ embeddings.T / np.outer(norms, norms)
+    np.fill_diagonal(cosine_similarity, -1)
+    with warnings.catch_warnings():
+        # NOTE: scipy rightly warns the rows of a distance matrix aren't observations, that's how it used to be called
+        warnings.simplefilter("ignore")
+        linkage_matrix = linkage(1 - np.abs(cosine_similarity), method="ward")
+    return fcluster(linkage_matrix, threshold, criterion="distance")
+
+
+def make_embeddings(num_issues, dim, issues_per_cluster, noise, rng):
+    num_clusters = max(1, num_issues // issues_per_cluster)
+    centers = rng.standard_normal((num_clusters, dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    labels = rng.integers(0, num_clusters, size=num_issues)
+    # NOTE: the noise is spread over all the dimensions, so its norm is about `noise`
+    embeddings = centers[labels] + rng.standard_normal((num_issues, dim)).astype(np.float32) * (noise / np.sqrt(dim))
+    return embeddings, labels
+
+
+def pair_agreement(labels, expected_labels):
+    """Precision and recall of the pairs of issues put in the same cluster, from the contingency table."""
+    _, labels = np.unique(labels, return_inverse=True)
+    _, expected_labels = np.unique(expected_labels, return_inverse=True)
+    contingency = np.bincount(labels * (expected_labels.max() + 1) + expected_labels).astype(np.float64)
+    same_both = (contingency * (contingency - 1)).sum() / 2
+    same_predicted = (np.bincount(labels) * (np.bincount(labels) - 1.0)).sum() / 2
+    same_expected = (np.bincount(expected_labels) * (np.bincount(expected_labels) - 1.0)).sum() / 2
+    return same_both / max(same_predicted, 1), same_both / max(same_expected, 1)
+
+
+def measure(method, embeddings):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    labels = method(embeddings)
+    seconds = time.perf_counter() - start_time
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return labels, seconds, peak_bytes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 2000, 5000, 20000])
+    parser.add_argument("--dim", type=int, default=1024, help="1024 for thenlper/gte-large")
+    parser.add_argument("--issues_per_cluster", type=int, default=20)
+    parser.add_argument("--noise", type=float, default=0.4, help="Norm of the noise added to the unit cluster centers")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--min_similarity", type=float, default=0.85)
+    parser.add_argument("--block_size", type=int, default=256)
+    parser.add_argument("--max_dense_size", type=int, default=5000, help="Larger sizes skip the dense method, its memory grows with N^2")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    methods = {"knn": lambda embeddings: cluster_embeddings(embeddings, k=args.k, min_similarity=args.min_similarity, block_size=args.block_size),
+               "dense-ward": dense_ward_clusters}
+
+    print(f"{'issues':>8} {'method':<11} {'seconds':>9} {'peak MiB':>9} {'clusters':>9} {'precision':>9} {'recall':>7}")
+    for size in args.sizes:
+        embeddings, expected_labels = make_embeddings(size, args.dim, args.issues_per_cluster, args.noise, rng)
+        for name, method in methods.items():
+            if name == "dense-ward" and size > args.max_dense_size:
+                continue
+            labels, seconds, peak_bytes = measure(method, embeddings)
+            precision, recall = pair_agreement(labels, expected_labels)
+            print(f"{size:>8} {name:<11} {seconds:>9.3f} {peak_bytes / 2 ** 20:>9.1f} {len(np.unique(labels)):>9} {precision:>9.3f} {recall:>7.3f}")
@@ -1,25 +1,38 @@
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 import base64
 
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from datasets import load_dataset
-import numpy as np
-from scipy.cluster.hierarchy import linkage, fcluster
 import openai
 import requests
 
-from benchmark import Benchmark
+from benchmark import MetricsRecorder, create_with_backoff
+from clustering import group_customer_issues
+from embeddings import BatchedEmbedder, EmbeddingCache
+from review_index import ReviewIndex, search_parent_asin
 
 
 load_dotenv()
 
 
 API_KEY = os.environ.get("OCTOAI_TOKEN")
+# NOTE: point it to a local stand-in server, e.g. local_openai_server/, for offline load tests
+BASE_URL = os.environ.get("OCTOAI_BASE_URL", "https://text.octoai.run/v1")
 SAVE_TO_FILE = os.environ.get("SAVE_BENCHMARK_RESULTS")
+SAVE_METRICS_JSON = os.environ.get("SAVE_METRICS_JSON")
+SAVE_METRICS_PROMETHEUS = os.environ.get("SAVE_METRICS_PROMETHEUS")
 NUM_PRODUCTS = int(os.environ.get("NUM_PRODUCTS", "5"))
+# NOTE: the number of customer feedback requests in flight at once
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "8"))
+MAX_API_RETRIES = int(os.environ.get("MAX_API_RETRIES", "5"))
+EMBEDDING_MODEL = "thenlper/gte-large"
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "64"))
+# NOTE: set it to an empty string to keep the embeddings in memory only
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", ".embedding_cache")
 MODEL = os.environ.get("MODEL_NAME", "mistral-7b-instruct")
 SYSTEM_PROMPT = ("You are an helpful AI assistant helping a Senior Product Manager create user tickets for relevant issues."
                  " You must ensure that your responses only refer to the user feedback you received and nothing more.")
@@ -34,6 +47,7 @@ if MODEL not in ["mistral-7b-instruct",
                  "meta-llama-3-70b-instruct"], "but got:", MODEL)
 
 print("MODEL=", MODEL)
+print("MAX_CONCURRENCY=", MAX_CONCURRENCY)
 print("SYSTEM_PROMPT=", SYSTEM_PROMPT)
 
 
@@ -56,98 +70,69 @@ class JIRATicket(BaseModel):
     category: str = Field("What category is the given customer issue. It should be one of the following: 'product-quality', 'packaging', 'shipping', 'unclear-instructions', 'content-quality', 'subscription-and-billing', 'other'. Make the category is all lowercase, and whitespace is replaced with a dash ('-').")
 
 
-def structure_customer_feedback(client: openai.OpenAI, info: str, review: str, benchmark_client: Benchmark):
-    run_id = benchmark_client.new_run()
-    chat_completion = client.chat.completions.create(
-        model=MODEL,
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {
-                "role": "user",
-                "content": f"Product Description:\n{info}\n========\nReview:\n{review}",
-            },
-        ],
-        temperature=0.1,
-        max_tokens=4096,
-        response_format={"type": "json_object", "schema": CustomerFeedback.model_json_schema()},
-    )
-    benchmark_client.add_input_tokens(run_id, chat_completion.usage)
-    try:
-        response = json.loads(chat_completion.choices[0].message.content)
-        benchmark_client.end(run_id)
-        return response
-    except Exception:
-        benchmark_client.end_with_error(run_id)
-        print("DEBUG >>>>", chat_completion)
-
-
-def prepare_jira_ticket_info(client: openai.OpenAI, customer_issues: List[CustomerFeedback], benchmark_client: Benchmark):
-    run_id = benchmark_client.new_run()
-    related_reviews = "\n========\n".join([f"Review:\nProduct Name: {issue['product_name']} (Category - {issue['category']})\n\nIssue:\n{issue['description']}" for issue in customer_issues])
-    chat_completion = client.chat.completions.create(
-        model=MODEL,
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {
-                "role": "user",
-                "content": "Important note, for the `issue_description` field, please summarize the following customer reviews according to the schema." + "\n\n" + related_reviews,
-            },
-        ],
-        temperature=0.1,
-        response_format={"type": "json_object", "schema": JIRATicket.model_json_schema()},
-        max_tokens=4096,
-    )
-    benchmark_client.add_input_tokens(run_id, chat_completion.usage)
-    try:
-        response = json.loads(chat_completion.choices[0].message.content)
-        benchmark_client.end(run_id)
-        return response
-    except Exception:
-        benchmark_client.end_with_error(run_id)
-        print("DEBUG >>>>", chat_completion)
-
-
-
-def search_parent_asin(reviews, parent_asin):
-    return [review for review in reviews if review["parent_asin"] == parent_asin]
-
-
-def group_customer_issues(customer_issues, issue_embeddings):
-    issue_embeddings_similarity = issue_embeddings.dot(issue_embeddings.T)
-    square_mag = np.diag(issue_embeddings_similarity)
-
-    # inverse squared magnitude
-    inv_square_mag = 1 / square_mag
-
-    # if it doesn't occur, set it's inverse magnitude to zero (instead of inf)
-    inv_square_mag[np.isinf(inv_square_mag)] = 0
-
-    # inverse of the magnitude
-    inv_mag = np.sqrt(inv_square_mag)
-        
-    # cosine similarity (elementwise multiply by inverse magnitudes)
-    cosine = issue_embeddings_similarity * inv_mag
-    cosine_similarity = cosine.T * inv_mag
-
-    # values on the diagonal should not interfere
-    np.fill_diagonal(cosine_similarity, -1)
-
+def structure_customer_feedback(client: openai.OpenAI, info: str, review: str, benchmark_client: MetricsRecorder):
+    with benchmark_client.run("structure_feedback") as run:
+        chat_completion = create_with_backoff(
+            client.chat.completions.create, run, max_retries=MAX_API_RETRIES,
+            model=MODEL,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {
+                    "role": "user",
+                    "content": f"Product Description:\n{info}\n========\nReview:\n{review}",
+                },
+            ],
+            temperature=0.1,
+            max_tokens=4096,
+            response_format={"type": "json_object", "schema": CustomerFeedback.model_json_schema()},
+        )
+        run.add_usage(chat_completion.usage)
+        try:
+            response = json.loads(chat_completion.choices[0].message.content)
+            return response
+        except Exception:
+            run.error()
+            print("DEBUG >>>>", chat_completion)
+
+
+def prepare_jira_ticket_info(client: openai.OpenAI, customer_issues: List[CustomerFeedback], benchmark_client: MetricsRecorder):
+    with benchmark_client.run("jira_ticket") as run:
+        related_reviews = "\n========\n".join([f"Review:\nProduct Name: {issue['product_name']} (Category - {issue['category']})\n\nIssue:\n{issue['description']}" for issue in customer_issues])
+        chat_completion = create_with_backoff(
+            client.chat.completions.create, run, max_retries=MAX_API_RETRIES,
+            model=MODEL,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {
+                    "role": "user",
+                    "content": "Important note, for the `issue_description` field, please summarize the following customer reviews according to the schema." + "\n\n" + related_reviews,
+                },
+            ],
+            temperature=0.1,
+            response_format={"type": "json_object", "schema": JIRATicket.model_json_schema()},
+            max_tokens=4096,
+        )
+        run.add_usage(chat_completion.usage)
+        try:
+            response = json.loads(chat_completion.choices[0].message.content)
+            return response
+        except Exception:
+            run.error()
+            print("DEBUG >>>>", chat_completion)
 
-    distance_matrix = 1 - np.abs(cosine_similarity)
-    linkage_matrix = linkage(distance_matrix, method='ward')
-    threshold = 0.15
-    clusters = fcluster(linkage_matrix, threshold, criterion='distance')
 
 
-    grouped_customer_issues = []
-    for unique_cluster_id in set(clusters):
-        related_issues = [customer_issues[idx] for idx, cluster_id in enumerate(clusters) if cluster_id == unique_cluster_id]
-        grouped_customer_issues.append(related_issues)
-    return grouped_customer_issues
+def embed_batch(client: openai.OpenAI, texts: List[str], benchmark_client: MetricsRecorder):
+    with benchmark_client.run("embed") as run:
+        # NOTE: need to check context legnth of the model
+        resp = create_with_backoff(client.embeddings.create, run, max_retries=MAX_API_RETRIES, model=EMBEDDING_MODEL, input=texts)
+        run.add_usage(resp.usage)
+    return [item.embedding for item in sorted(resp.data, key=lambda item: item.index)]
 
 
 if __name__ == "__main__":
-    client = openai.OpenAI(base_url="https://text.octoai.run/v1", api_key=API_KEY)
+    # NOTE: the requests are retried by create_with_backoff, so the retries show up in the metrics
+    client = openai.OpenAI(base_url=BASE_URL, api_key=API_KEY, max_retries=0)
 
     # We use a dataset from Huggingface to quickly
     # see the performance on many examples
@@ -163,18 +148,29 @@ if __name__ == "__main__":
         split="full",
         trust_remote_code=True,
     )
+    # NOTE: built once and cached next to the dataset, every lookup is then a slice instead of a scan of all the reviews
+    review_index = ReviewIndex.load_or_build(reviews, "parent_asin")
 
-    benchmark_client = Benchmark()
+    benchmark_client = MetricsRecorder()
 
 
-    # 1: structure_customer_feedback
-    customer_feedbacks = []
+    # 1: structure_customer_feedback, MAX_CONCURRENCY reviews at a time, the results keep the order of the reviews
+    feedback_inputs = []
     for example in dataset.select(range(NUM_PRODUCTS)):
         long_description = example["title"] + "\n" + "".join(example["description"])
-        product_reviews = search_parent_asin(reviews, example["parent_asin"])
-        for review in product_reviews:
-            customer_feedback = structure_customer_feedback(client, long_description, review["text"], benchmark_client)
-            customer_feedbacks.append(customer_feedback)
+        product_reviews = search_parent_asin(reviews, example["parent_asin"], review_index)
+        feedback_inputs += [(long_description, review["text"]) for review in product_reviews]
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+        futures = [executor.submit(structure_customer_feedback, client, info, review, benchmark_client) for info, review in feedback_inputs]
+        customer_feedbacks = []
+        for future in futures:
+            try:
+                customer_feedbacks.append(future.result())
+            except openai.APIError as err:
+                # NOTE: still failing after the retries, only this review is dropped, its stage counts the error
+                print(err, "... skipping this review")
+                continue
 
 
     # 2: filter only is_issue
@@ -190,18 +186,11 @@ if __name__ == "__main__":
     print("products =", NUM_PRODUCTS, "issues =", len(customer_issues), "feedbacks =", len(customer_feedbacks))
 
 
-    # 3: group by high similarity using GTE model from OctoAI
-    issue_embeddings = []
-    for issue in customer_issues:
-        # NOTE: need to check context legnth of the model
-        resp = client.embeddings.create(
-            model="thenlper/gte-large",
-            input=f"Product Name: {issue['product_name']} (Category - {issue['category']})\n\nIssue:\n{issue['description']}",
-        )
-
-        issue_embeddings.append(resp.data[0].embedding)
-
-    issue_embeddings = np.array(issue_embeddings)
+    # 3: group by high similarity using GTE model from OctoAI, with batched requests, only for the issues not embedded by a previous run
+    embedding_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, EMBEDDING_MODEL)
+    embedder = BatchedEmbedder(lambda texts: embed_batch(client, texts, benchmark_client), embedding_cache,
+                               batch_size=EMBEDDING_BATCH_SIZE, max_concurrency=MAX_CONCURRENCY)
+    issue_embeddings = embedder.embed([f"Product Name: {issue['product_name']} (Category - {issue['category']})\n\nIssue:\n{issue['description']}" for issue in customer_issues])
 
     grouped_customer_issues = group_customer_issues(customer_issues, issue_embeddings)
 
@@ -215,6 +204,10 @@ if __name__ == "__main__":
     print(jira_tickets)
 
     benchmark_client.print_summary(save_to_file=SAVE_TO_FILE)
+    if SAVE_METRICS_JSON:
+        benchmark_client.to_json(SAVE_METRICS_JSON)
+    if SAVE_METRICS_PROMETHEUS:
+        benchmark_client.write_prometheus(SAVE_METRICS_PROMETHEUS)
 
 
     # 5: Send a REST request to JIRA server - mock
@@ -1,24 +1,37 @@
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from datasets import load_dataset
-import numpy as np
-from scipy.cluster.hierarchy import linkage, fcluster
 import openai
 from jsonschema import ValidationError, validate
 
-from benchmark import Benchmark
+from benchmark import MetricsRecorder, create_with_backoff
+from clustering import group_customer_issues
+from embeddings import BatchedEmbedder, EmbeddingCache
+from review_index import ReviewIndex, search_parent_asin
 
 
 load_dotenv()
 
 
 API_KEY = os.environ.get("OCTOAI_TOKEN")
+# NOTE: point it to a local stand-in server, e.g. local_openai_server/, for offline load tests
+BASE_URL = os.environ.get("OCTOAI_BASE_URL", "https://text.octoai.run/v1")
 SAVE_TO_FILE = os.environ.get("SAVE_BENCHMARK_RESULTS")
+SAVE_METRICS_JSON = os.environ.get("SAVE_METRICS_JSON")
+SAVE_METRICS_PROMETHEUS = os.environ.get("SAVE_METRICS_PROMETHEUS")
 NUM_PRODUCTS = int(os.environ.get("NUM_PRODUCTS", "5"))
+# NOTE: the number of customer feedback requests in flight at once
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "8"))
+MAX_API_RETRIES = int(os.environ.get("MAX_API_RETRIES", "5"))
+EMBEDDING_MODEL = "thenlper/gte-large"
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "64"))
+# NOTE: set it to an empty string to keep the embeddings in memory only
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", ".embedding_cache")
 USE_PREFILL = os.environ.get("USE_PREFILL") in ["1", "yes", "y", "true"]
 MODEL = os.environ.get("MODEL_NAME", "mistral-7b-instruct")
 SYSTEM_PROMPT = ("You are an helpful AI assistant helping a Senior Product Manager create user tickets for relevant issues."
@@ -38,6 +51,7 @@ if MODEL not in ["mistral-7b-instruct",
 
 print("USE_PREFILL=", USE_PREFILL)
 print("MODEL=", MODEL)
+print("MAX_CONCURRENCY=", MAX_CONCURRENCY)
 print("SYSTEM_PROMPT=", SYSTEM_PROMPT)
 
 
@@ -80,8 +94,7 @@ def parse_json(response: str, schema: dict):
     return obj, was_an_error
 
 
-def structure_customer_feedback(client: openai.OpenAI, info: str, review: str, schema: dict, benchmark_client: Benchmark, max_retries: int=3):
-    run_id = benchmark_client.new_run()
+def structure_customer_feedback(client: openai.OpenAI, info: str, review: str, schema: dict, benchmark_client: MetricsRecorder, max_retries: int=3):
     assistant_seed = '{"description": "'
     retries = 0
 
@@ -100,31 +113,31 @@ def structure_customer_feedback(client: openai.OpenAI, info: str, review: str, s
                     "content": assistant_seed,
                 })
 
-    while retries < max_retries:
-        chat_completion = client.chat.completions.create(
-            model=MODEL,
-            messages=messages,
-            temperature=0.2, # NOTE: a temperature higher than 0 is necessary to get slighlty different results when retrying
-        )
+    # NOTE: the retries are timed with the request, running out of them ends the run with an error
+    with benchmark_client.run("structure_feedback") as run:
+        while retries < max_retries:
+            chat_completion = create_with_backoff(
+                client.chat.completions.create, run, max_retries=MAX_API_RETRIES,
+                model=MODEL,
+                messages=messages,
+                temperature=0.2, # NOTE: a temperature higher than 0 is necessary to get slighlty different results when retrying
+            )
 
-        benchmark_client.add_input_tokens(run_id, chat_completion.usage)
-        prefix = assistant_seed if USE_PREFILL else ""
-        valid_response, is_error = parse_json(prefix + chat_completion.choices[0].message.content, schema=schema)
+            run.add_usage(chat_completion.usage)
+            prefix = assistant_seed if USE_PREFILL else ""
+            valid_response, is_error = parse_json(prefix + chat_completion.choices[0].message.content, schema=schema)
 
-        if not is_error:
-            benchmark_client.end(run_id)
-            return valid_response
-        else:
-            print("Failed to extract a valid JSON, retrying...")
-            benchmark_client.increment_retries(run_id)
-            retries += 1
+            if not is_error:
+                return valid_response
+            else:
+                print("Failed to extract a valid JSON, retrying...")
+                run.retry()
+                retries += 1
 
-    benchmark_client.end_with_error(run_id)
-    raise RuntimeError(f"Couldn't generate a valid JSON even after {max_retries}")
+        raise RuntimeError(f"Couldn't generate a valid JSON even after {max_retries}")
 
 
-def prepare_jira_ticket_info(client: openai.OpenAI, customer_issues: List[CustomerFeedback], schema: dict, benchmark_client: Benchmark, max_retries: int=3):
-    run_id = benchmark_client.new_run()
+def prepare_jira_ticket_info(client: openai.OpenAI, customer_issues: List[CustomerFeedback], schema: dict, benchmark_client: MetricsRecorder, max_retries: int=3):
     assistant_seed = '{"issue_title": "'
     retries = 0
     related_reviews = "\n========\n".join([f"Review:\nProduct Name: {issue['product_name']} (Category - {issue['category']})\n\nIssue:\n{issue['description']}" for issue in customer_issues])
@@ -144,69 +157,40 @@ def prepare_jira_ticket_info(client: openai.OpenAI, customer_issues: List[Custom
                     "content": assistant_seed,
                 })
 
-    while retries < max_retries:
-        chat_completion = client.chat.completions.create(
-            model=MODEL,
-            messages=messages,
-            temperature=0.2
-        )
+    with benchmark_client.run("jira_ticket") as run:
+        while retries < max_retries:
+            chat_completion = create_with_backoff(
+                client.chat.completions.create, run, max_retries=MAX_API_RETRIES,
+                model=MODEL,
+                messages=messages,
+                temperature=0.2
+            )
 
-        benchmark_client.add_input_tokens(run_id, chat_completion.usage)
-        prefix = assistant_seed if USE_PREFILL else ""
-        valid_response, is_error = parse_json(prefix + chat_completion.choices[0].message.content, schema=schema)
+            run.add_usage(chat_completion.usage)
+            prefix = assistant_seed if USE_PREFILL else ""
+            valid_response, is_error = parse_json(prefix + chat_completion.choices[0].message.content, schema=schema)
 
-        if not is_error:
-            benchmark_client.end(run_id)
-            return valid_response
-        else:
-            print("Failed to extract a valid JSON, retrying...")
-            benchmark_client.increment_retries(run_id)
-            retries += 1
+            if not is_error:
+                return valid_response
+            else:
+                print("Failed to extract a valid JSON, retrying...")
+                run.retry()
+                retries += 1
 
-    benchmark_client.end_with_error(run_id)
-    raise RuntimeError(f"Couldn't generate a valid JSON even after {max_retries}")
+        raise RuntimeError(f"Couldn't generate a valid JSON even after {max_retries}")
 
 
-def search_parent_asin(reviews, parent_asin):
-    return [review for review in reviews if review["parent_asin"] == parent_asin]
-
-
-def group_customer_issues(customer_issues, issue_embeddings):
-    issue_embeddings_similarity = issue_embeddings.dot(issue_embeddings.T)
-    square_mag = np.diag(issue_embeddings_similarity)
-
-    # inverse squared magnitude
-    inv_square_mag = 1 / square_mag
-
-    # if it doesn't occur, set it's inverse magnitude to zero (instead of inf)
-    inv_square_mag[np.isinf(inv_square_mag)] = 0
-
-    # inverse of the magnitude
-    inv_mag = np.sqrt(inv_square_mag)
-        
-    # cosine similarity (elementwise multiply by inverse magnitudes)
-    cosine = issue_embeddings_similarity * inv_mag
-    cosine_similarity = cosine.T * inv_mag
-
-    # values on the diagonal should not interfere
-    np.fill_diagonal(cosine_similarity, -1)
-
-
-    distance_matrix = 1 - np.abs(cosine_similarity)
-    linkage_matrix = linkage(distance_matrix, method='ward')
-    threshold = 0.15
-    clusters = fcluster(linkage_matrix, threshold, criterion='distance')
-
-
-    grouped_customer_issues = []
-    for unique_cluster_id in set(clusters):
-        related_issues = [customer_issues[idx] for idx, cluster_id in enumerate(clusters) if cluster_id == unique_cluster_id]
-        grouped_customer_issues.append(related_issues)
-    return grouped_customer_issues
+def embed_batch(client: openai.OpenAI, texts: List[str], benchmark_client: MetricsRecorder):
+    with benchmark_client.run("embed") as run:
+        # NOTE: need to check context legnth of the model
+        resp = create_with_backoff(client.embeddings.create, run, max_retries=MAX_API_RETRIES, model=EMBEDDING_MODEL, input=texts)
+        run.add_usage(resp.usage)
+    return [item.embedding for item in sorted(resp.data, key=lambda item: item.index)]
 
 
 if __name__ == "__main__":
-    client = openai.OpenAI(base_url="https://text.octoai.run/v1", api_key=API_KEY)
+    # NOTE: the requests are retried by create_with_backoff, so the retries show up in the metrics
+    client = openai.OpenAI(base_url=BASE_URL, api_key=API_KEY, max_retries=0)
 
     # We use a dataset from Huggingface to quickly
     # see the performance on many examples
@@ -222,22 +206,33 @@ if __name__ == "__main__":
         split="full",
         trust_remote_code=True,
     )
+    # NOTE: built once and cached next to the dataset, every lookup is then a slice instead of a scan of all the reviews
+    review_index = ReviewIndex.load_or_build(reviews, "parent_asin")
 
-    benchmark_client = Benchmark()
+    benchmark_client = MetricsRecorder()
 
 
-    # 1: structure_customer_feedback
-    customer_feedbacks = []
+    # 1: structure_customer_feedback, MAX_CONCURRENCY reviews at a time, the results keep the order of the reviews
+    feedback_inputs = []
     for example in dataset.select(range(NUM_PRODUCTS)):
         long_description = example["title"] + "\n" + "".join(example["description"])
-        product_reviews = search_parent_asin(reviews, example["parent_asin"])
-        for review in product_reviews:
+        product_reviews = search_parent_asin(reviews, example["parent_asin"], review_index)
+        feedback_inputs += [(long_description, review["text"]) for review in product_reviews]
+
+    customer_feedbacks = []
+    schema = CustomerFeedback.model_json_schema()
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+        futures = [executor.submit(structure_customer_feedback, client, info, review, schema, benchmark_client) for info, review in feedback_inputs]
+        for future in futures:
             try:
-                customer_feedback = structure_customer_feedback(client, long_description, review["text"], CustomerFeedback.model_json_schema(), benchmark_client)
-                customer_feedbacks.append(customer_feedback)
+                customer_feedbacks.append(future.result())
             except RuntimeError as err:
                 print(err)
                 continue
+            except openai.APIError as err:
+                # NOTE: still failing after the retries, only this review is dropped, its stage counts the error
+                print(err, "... skipping this review")
+                continue
 
     # 2: filter only is_issue
     customer_issues = []
@@ -252,18 +247,11 @@ if __name__ == "__main__":
     print("products =", NUM_PRODUCTS, "issues =", len(customer_issues), "feedbacks =", len(customer_feedbacks))
 
 
-    # 3: group by high similarity using GTE model from OctoAI
-    issue_embeddings = []
-    for issue in customer_issues:
-        # NOTE: need to check context legnth of the model
-        resp = client.embeddings.create(
-            model="thenlper/gte-large",
-            input=f"Product Name: {issue['product_name']} (Category - {issue['category']})\n\nIssue:\n{issue['description']}",
-        )
-
-        issue_embeddings.append(resp.data[0].embedding)
-
-    issue_embeddings = np.array(issue_embeddings)
+    # 3: group by high similarity using GTE model from OctoAI, with batched requests, only for the issues not embedded by a previous run
+    embedding_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, EMBEDDING_MODEL)
+    embedder = BatchedEmbedder(lambda texts: embed_batch(client, texts, benchmark_client), embedding_cache,
+                               batch_size=EMBEDDING_BATCH_SIZE, max_concurrency=MAX_CONCURRENCY)
+    issue_embeddings = embedder.embed([f"Product Name: {issue['product_name']} (Category - {issue['category']})\n\nIssue:\n{issue['description']}" for issue in customer_issues])
 
     grouped_customer_issues = group_customer_issues(customer_issues, issue_embeddings)
 
@@ -281,3 +269,7 @@ if __name__ == "__main__":
     print(jira_tickets)
 
     benchmark_client.print_summary(save_to_file=SAVE_TO_FILE)
+    if SAVE_METRICS_JSON:
+        benchmark_client.to_json(SAVE_METRICS_JSON)
+    if SAVE_METRICS_PROMETHEUS:
+        benchmark_client.write_prometheus(SAVE_METRICS_PROMETHEUS)
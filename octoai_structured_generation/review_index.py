@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+
+
+class ReviewIndex:
+    """Row numbers of the reviews of every product, so fetching them is a `dataset.select` instead of a full scan.
+
+    The index is built once, with an Arrow group by over the `parent_asin` column, and saved next to the cache
+    files of the dataset, under a key of their paths, sizes and modification times, see `index_key`, so the next
+    runs only read it back. The rows are stored flat, grouped by product, and every product maps to its slice of them.
+    """
+
+    def __init__(self, keys, offsets, rows):
+        self.rows = rows
+        self.slices = {key: (start, end) for key, start, end in zip(keys, offsets[:-1].tolist(), offsets[1:].tolist())}
+
+    @classmethod
+    def build_table(cls, dataset, column="parent_asin"):
+        # NOTE: the Arrow format reads the column straight from the memory mapped cache, without making Python objects
+        keys = dataset.with_format("arrow")[column]
+        row_numbers = pa.array(np.arange(len(dataset), dtype=np.int64))
+        return pa.table({column: keys, "row": row_numbers}).group_by(column).aggregate([("row", "list")])
+
+    @classmethod
+    def from_table(cls, table, column="parent_asin"):
+        row_lists = table["row_list"].combine_chunks()
+        offsets = row_lists.offsets.to_numpy()
+        offsets = offsets - offsets[0]
+        rows = row_lists.flatten().to_numpy()
+        # NOTE: the group by doesn't guarantee the order within the groups, the reviews are kept in the dataset order
+        group_ids = np.repeat(np.arange(len(table)), np.diff(offsets))
+        rows = rows[np.lexsort((rows, group_ids))]
+        return cls(table[column].to_pylist(), offsets, rows)
+
+    @classmethod
+    def load_or_build(cls, dataset, column="parent_asin"):
+        path = index_path(dataset, column)
+        if path is not None and os.path.exists(path):
+            return cls.from_table(feather.read_table(path), column)
+
+        table = cls.build_table(dataset, column)
+        if path is not None:
+            # NOTE: written aside first, so a concurrent run never reads a partial index
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            feather.write_feather(table, tmp_path)
+            os.replace(tmp_path, path)
+        return cls.from_table(table, column)
+
+    def get(self, key):
+        start, end = self.slices.get(key, (0, 0))
+        return self.rows[start:end]
+
+
+def index_key(dataset, column, num_samples=64):
+    """Changes with the files backing the dataset, its number of rows and a sample of its keys.
+
+    The sample catches the views sharing the same cache files, like an in-memory `select`, whose rows differ.
+    """
+    files = [(info["filename"], os.path.getsize(info["filename"]), os.path.getmtime(info["filename"])) for info in dataset.cache_files]
+    sample_rows = np.linspace(0, len(dataset) - 1, num=min(num_samples, len(dataset)), dtype=np.int64).tolist()
+    sample = dataset.select(sample_rows)[column] if sample_rows else []
+    payload = json.dumps([files, len(dataset), column, sample], default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def index_path(dataset, column):
+    """Next to the cache files of the dataset, None for in-memory datasets."""
+    if not dataset.cache_files:
+        return None
+    cache_dir = os.path.dirname(dataset.cache_files[0]["filename"])
+    return os.path.join(cache_dir, f"{column}-index-{index_key(dataset, column)}.arrow")
+
+
+def search_parent_asin(reviews, parent_asin, index):
+    return reviews.select(index.get(parent_asin))
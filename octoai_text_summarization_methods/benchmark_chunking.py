@@ -0,0 +1,55 @@
+"""Compares the decode-based chunking with the offset-based structural chunking.
+
+python benchmark_chunking.py --use_model mixtral --docs_path raw_docs
+"""
+import argparse
+import glob
+import os
+import time
+
+from summarization_methods_app import AbstractOctoAIModel, load_parse_pdf
+
+
+def decode_chunks(model, text):
+    # NOTE: the chunking used before TokenizedDocument, kept here only as a baseline
+    max_size = model.max_chunk_size
+    text_tokens = model.tokenizer.encode(text)
+    n_chunks = len(text_tokens) // max_size + 1
+    return [model.tokenizer.decode(text_tokens[idx * max_size: (idx + 1) * max_size], skip_special_tokens=True) for idx in range(n_chunks)]
+
+
+def offset_chunks(model, text):
+    return [chunk.text for chunk in model.chunk_text_iter(model.tokenize(text))]
+
+
+def ends_at_sentence(chunk):
+    return chunk.rstrip().endswith((".", "!", "?", ".\"", ".)"))
+
+
+def measure(chunk_fn, model, text, repeats):
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        chunks = chunk_fn(model, text)
+        timings.append(time.perf_counter() - start_time)
+
+    return {"best_seconds": min(timings),
+            "num_chunks": len(chunks),
+            "chunks_ending_at_sentence": sum(ends_at_sentence(chunk) for chunk in chunks[:-1]) / max(len(chunks) - 1, 1),
+            "chunks_found_in_source": sum(chunk in text for chunk in chunks) / len(chunks)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--use_model", choices=["llama2", "mixtral", "mistral", "nous-hermes"], default="mixtral")
+    parser.add_argument("--docs_path", type=str, default="raw_docs")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    model = AbstractOctoAIModel(args.use_model)
+
+    for doc_name in glob.glob(os.path.join(args.docs_path, "*.pdf")):
+        text = load_parse_pdf(doc_name)
+        print(doc_name)
+        for name, chunk_fn in [("decode", decode_chunks), ("offsets", offset_chunks)]:
+            print(f"  {name:>8}:", measure(chunk_fn, model, text, args.repeats))
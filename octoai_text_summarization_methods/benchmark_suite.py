@@ -0,0 +1,155 @@
+"""Runs `benchmark_one` many times per (document, model, method) and reports latency and cost percentiles.
+
+python benchmark_suite.py --docs_path raw_docs --models mixtral mistral --methods map-reduce refine --repeats 10 --output results.json
+
+Every combination gets `--warmup` discarded runs, then `--repeats` measured ones. The completion cache is
+never used here, so every run really calls the endpoint. The summary reports p50/p90/p99 with bootstrap
+confidence intervals, the raw samples are kept in the JSON output to compare runs later on.
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import time
+
+import numpy as np
+
+from pdf_cache import PDFCache
+from summarization_methods_app import SUMMARIZERS, benchmark_one, load_document, total_cost
+
+METRICS = ["time_to_summarize_seconds", "time_to_first_token_seconds", "output_tokens_per_second", "cost_usd"]
+PERCENTILES = [50, 90, 99]
+
+
+def bootstrap_ci(samples, statistic, confidence=0.95, num_resamples=2000, rng=None):
+    """Percentile bootstrap confidence interval of `statistic`, computed on all the resamples at once."""
+    rng = rng or np.random.default_rng()
+    samples = np.asarray(samples, dtype=np.float64)
+    if len(samples) < 2:
+        return None, None
+
+    resamples = samples[rng.integers(0, len(samples), size=(num_resamples, len(samples)))]
+    values = statistic(resamples)
+    alpha = (1 - confidence) / 2
+    return float(np.quantile(values, alpha)), float(np.quantile(values, 1 - alpha))
+
+
+def summarize_samples(samples, confidence=0.95, num_resamples=2000, rng=None):
+    samples = np.asarray([sample for sample in samples if sample is not None], dtype=np.float64)
+    if len(samples) == 0:
+        return None
+
+    summary = {"n": len(samples),
+               "mean": float(samples.mean()),
+               "std": float(samples.std(ddof=1)) if len(samples) > 1 else 0.0,
+               "min": float(samples.min()),
+               "max": float(samples.max())}
+    summary["mean_ci"] = bootstrap_ci(samples, lambda x: x.mean(axis=1), confidence, num_resamples, rng)
+    for q in PERCENTILES:
+        # NOTE: with few repeats the upper percentiles are close to the max, the interval shows how much to trust them
+        summary[f"p{q}"] = float(np.percentile(samples, q))
+        summary[f"p{q}_ci"] = bootstrap_ci(samples, lambda x, q=q: np.percentile(x, q, axis=1), confidence, num_resamples, rng)
+    return summary
+
+
+def run_suite(doc_names, model_names, method_names, repeats=5, warmup=1, stream=True, pdf_cache=None,
+              model_kwargs=None, confidence=0.95, num_resamples=2000, seed=0, compress_ratios=(None,)):
+    """Every combination is run once per entry of `compress_ratios`, None being the uncompressed document."""
+    rng = np.random.default_rng(seed)
+    model_kwargs = model_kwargs or {}
+    results = []
+    for model_name in model_names:
+        for method_name in method_names:
+            model = SUMMARIZERS[method_name](model_name, completion_cache=None, **model_kwargs)
+            for doc_name in doc_names:
+                document = load_document(doc_name, model, pdf_cache)
+
+                for compress_ratio in compress_ratios:
+                    for _ in range(warmup):
+                        benchmark_one(document, doc_name, model, stream=stream, compress_ratio=compress_ratio)
+
+                    runs = []
+                    for run_idx in range(repeats):
+                        stats, _ = benchmark_one(document, doc_name, model, stream=stream, compress_ratio=compress_ratio)
+                        stats["cost_usd"] = total_cost(stats)
+                        stats["run"] = run_idx
+                        runs.append(stats)
+
+                    result = {"document": os.path.basename(doc_name),
+                              "model": model_name,
+                              "method": method_name,
+                              "compress_ratio": compress_ratio,
+                              "num_document_tokens": len(document),
+                              "runs": runs}
+                    for metric in METRICS:
+                        result[metric] = summarize_samples([run[metric] for run in runs], confidence, num_resamples, rng)
+                    results.append(result)
+                    print_result(result)
+    return results
+
+
+def print_result(result):
+    latency = result["time_to_summarize_seconds"]
+    ttft = result["time_to_first_token_seconds"]
+    compressed = f" (compressed to {result['compress_ratio']:0.0%})" if result.get("compress_ratio") is not None else ""
+    print(f"{result['document']} | {result['model']} | {result['method']}{compressed}: "
+          f"p50 {latency['p50']:0.2f}s p90 {latency['p90']:0.2f}s p99 {latency['p99']:0.2f}s, "
+          f"TTFT p50 {ttft['p50']:0.2f}s, cost {result['cost_usd']['mean']:0.5f} USD")
+
+
+def write_csv(results, filename):
+    fields = ["document", "model", "method", "compress_ratio", "num_document_tokens"]
+    rows = []
+    for result in results:
+        row = {field: result[field] for field in fields}
+        for metric in METRICS:
+            summary = result[metric] or {}
+            for name in ["n", "mean"] + [f"p{q}" for q in PERCENTILES]:
+                row[f"{metric}_{name}"] = summary.get(name)
+            for name in ["mean_ci"] + [f"p{q}_ci" for q in PERCENTILES]:
+                low, high = summary.get(name) or (None, None)
+                row[f"{metric}_{name}_low"], row[f"{metric}_{name}_high"] = low, high
+        rows.append(row)
+
+    with open(filename, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) if rows else fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs_path", type=str, default="raw_docs")
+    parser.add_argument("--models", nargs="+", choices=["llama2", "mixtral", "mistral", "nous-hermes"], default=["mixtral"])
+    parser.add_argument("--methods", nargs="+", choices=list(SUMMARIZERS), default=["map-reduce"])
+    parser.add_argument("--repeats", type=int, default=5, help="Measured runs per (document, model, method)")
+    parser.add_argument("--warmup", type=int, default=1, help="Discarded runs before the measured ones")
+    parser.add_argument("--no_stream", action="store_true", help="Don't stream the final summary, the time to first token is then the total time")
+    parser.add_argument("--max_concurrency", type=int, default=8)
+    parser.add_argument("--reduce_fan_in", type=int, default=None)
+    parser.add_argument("--compress_ratios", nargs="+", type=float, default=[], help="Also run every combination on the documents compressed to these fractions of their tokens")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Level of the bootstrap confidence intervals")
+    parser.add_argument("--bootstrap_resamples", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pdf_cache_dir", type=str, default=".pdf_cache")
+    parser.add_argument("--no_pdf_cache", action="store_true")
+    parser.add_argument("--output", type=str, default="benchmark_results.json")
+    parser.add_argument("--csv", type=str, default=None, help="Also write the summary rows to this CSV file")
+    args = parser.parse_args()
+
+    doc_names = sorted(glob.glob(os.path.join(args.docs_path, "*.pdf")))
+    start_time = time.time()
+    results = run_suite(doc_names, args.models, args.methods, repeats=args.repeats, warmup=args.warmup,
+                        stream=not args.no_stream,
+                        pdf_cache=None if args.no_pdf_cache else PDFCache(args.pdf_cache_dir),
+                        model_kwargs={"max_concurrency": args.max_concurrency, "reduce_fan_in": args.reduce_fan_in},
+                        confidence=args.confidence, num_resamples=args.bootstrap_resamples, seed=args.seed,
+                        compress_ratios=[None] + args.compress_ratios)
+
+    with open(args.output, "w") as f:
+        json.dump({"started_at": start_time, "config": vars(args), "results": results}, f, indent=2)
+    print("Results written to", args.output)
+    if args.csv:
+        write_csv(results, args.csv)
+        print("Summary written to", args.csv)
@@ -0,0 +1,63 @@
+import hashlib
+import os
+import re
+
+import numpy as np
+
+from tokenized_document import TokenizedDocument
+
+
+class PDFCache:
+    """On-disk cache of parsed PDFs and their token arrays, keyed by the SHA-256 of the PDF bytes.
+
+    Every PDF gets a `<cache_dir>/<digest>/` directory with the extracted `text.txt`, and a pair of
+    `<tokenizer>.ids.npy` / `<tokenizer>.offsets.npy` files per tokenizer, which are loaded memory-mapped.
+    The tokenizer part holds the digest of its `tokenizer.json` when there is one, so an updated tokenizer
+    with the same name doesn't read the token ids of the previous one.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def digest(filename):
+        sha256 = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    def load_text(self, filename, parse_fn, digest=None):
+        entry_dir = os.path.join(self.cache_dir, digest or self.digest(filename))
+        text_path = os.path.join(entry_dir, "text.txt")
+        if os.path.exists(text_path):
+            with open(text_path, encoding="utf-8") as f:
+                return f.read()
+
+        text = parse_fn(filename)
+        os.makedirs(entry_dir, exist_ok=True)
+        tmp_path = f"{text_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        # NOTE: renaming is atomic, so concurrent runs never read a half-written entry
+        os.replace(tmp_path, text_path)
+        return text
+
+    def load_document(self, filename, parse_fn, tokenizer_name, tokenize_fn, tokenizer_digest=None):
+        digest = self.digest(filename)
+        text = self.load_text(filename, parse_fn, digest=digest)
+
+        # NOTE: the tiktoken encodings have no digest, their name is already pinned to a fixed, hash-checked file
+        tokenizer_key = tokenizer_name if tokenizer_digest is None else f"{tokenizer_name}-{tokenizer_digest[:16]}"
+        prefix = os.path.join(self.cache_dir, digest, re.sub(r"[^\w.-]", "_", tokenizer_key))
+        ids_path, offsets_path = prefix + ".ids.npy", prefix + ".offsets.npy"
+        if os.path.exists(ids_path) and os.path.exists(offsets_path):
+            return TokenizedDocument(text, np.load(ids_path, mmap_mode="r"), np.load(offsets_path, mmap_mode="r"))
+
+        document = tokenize_fn(text)
+        for path, array in [(offsets_path, document.offsets), (ids_path, document.token_ids)]:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+        return document
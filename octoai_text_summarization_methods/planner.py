@@ -0,0 +1,188 @@
+"""Estimates the calls, tokens, latency and cost of every (model, method) before summarizing, and picks the fastest plan within budget.
+
+python planner.py --docs_path raw_docs --max_cost 0.01 --max_latency 30
+
+The estimates replay the chunking and the tree reduce of the summarizers on the tokenized document,
+assuming every summary is `summary_tokens` long, so no call is made. The latencies come from LATENCY,
+rough numbers to calibrate against `benchmark_suite.py` results.
+"""
+import math
+
+# NOTE: time to first token in seconds, prompt processing and generation speeds in tokens per second
+LATENCY = {"mixtral": {"ttft": 0.35, "prefill_tokens_per_second": 6000, "output_tokens_per_second": 70},
+           "nous-hermes": {"ttft": 0.35, "prefill_tokens_per_second": 6000, "output_tokens_per_second": 70},
+           "mistral": {"ttft": 0.2, "prefill_tokens_per_second": 12000, "output_tokens_per_second": 110},
+           "llama2": {"ttft": 0.5, "prefill_tokens_per_second": 3000, "output_tokens_per_second": 35}}
+
+
+def call_latency(model, input_tokens, output_tokens):
+    latency = next(value for name, value in LATENCY.items() if model.slug_model_name.startswith(name))
+    return (latency["ttft"] + input_tokens / latency["prefill_tokens_per_second"]
+            + output_tokens / latency["output_tokens_per_second"])
+
+
+def plan_level(model, input_sizes, summary_tokens):
+    """Calls, tokens and latency of a level of independent calls, run `max_concurrency` at a time."""
+    waves = math.ceil(len(input_sizes) / max(1, model.max_concurrency))
+    return {"num_calls": len(input_sizes),
+            "input_tokens": sum(input_sizes),
+            "output_tokens": summary_tokens * len(input_sizes),
+            "latency_seconds": waves * call_latency(model, max(input_sizes), summary_tokens)}
+
+
+def plan_map_reduce(model, document, summary_tokens, final_system_prompt_tokens=None):
+    levels = [plan_level(model, [len(chunk) + model.num_system_prompt_tokens for chunk in model.chunk_text_iter(document)], summary_tokens)]
+
+    # NOTE: same grouping as `tree_reduce`, with every summary assumed to be `summary_tokens` long
+    sizes = [summary_tokens] * levels[0]["num_calls"]
+    while True:
+        groups = model.group_summaries(sizes)
+        if len(groups) > 1 and len(groups) == len(sizes):
+            return None
+
+        is_final = len(groups) == 1
+        system_prompt_tokens = final_system_prompt_tokens if is_final and final_system_prompt_tokens else model.num_system_prompt_tokens
+        levels.append(plan_level(model, [sum(sizes[idx] + 1 for idx in group) + system_prompt_tokens for group in groups], summary_tokens))
+        if is_final:
+            return levels
+        sizes = [summary_tokens] * len(groups)
+
+
+def plan_refine(model, document, summary_tokens):
+    # NOTE: same cursor walk as `OctoAIRefinerSummarizer`, every step waits on the previous summary
+    summary_overhead = model.get_num_tokens("Summary so far:\n\nText: ") + summary_tokens
+    levels, cursor = [], 0
+    while cursor < len(document):
+        chunk_size = model.max_chunk_size if not levels else model.max_chunk_size - summary_overhead
+        chunk_end = document.chunk_end(cursor, chunk_size)
+        input_tokens = chunk_end - cursor + model.num_system_prompt_tokens + (summary_overhead if levels else 0)
+        levels.append(plan_level(model, [input_tokens], summary_tokens))
+        cursor = chunk_end
+    return levels
+
+
+def plan_refine_prefetch(model, document, summary_tokens):
+    # NOTE: assumes the map phase keeps ahead of the refine steps, so every step takes as many chunk summaries
+    #  as fit next to the running summary. The refine steps overlap the map phase, except for the first
+    #  wave before them and the last step after the last chunk summary
+    levels = [plan_level(model, [len(chunk) + model.num_system_prompt_tokens for chunk in model.chunk_text_iter(document)], summary_tokens)]
+    summary_overhead = model.get_num_tokens("Summary so far:\n\nText: ") + summary_tokens
+    num_summaries, cursor = levels[0]["num_calls"], 0
+    while cursor < num_summaries:
+        budget = model.max_chunk_size if cursor == 0 else model.max_chunk_size - summary_overhead
+        group_size = max(1, min(model.reduce_fan_in or num_summaries, num_summaries - cursor, budget // (summary_tokens + 1)))
+        input_tokens = group_size * (summary_tokens + 1) + model.num_system_prompt_tokens + (summary_overhead if cursor else 0)
+        levels.append(plan_level(model, [input_tokens], summary_tokens))
+        cursor += group_size
+
+    first_wave = call_latency(model, max(len(chunk) for chunk in model.chunk_text_iter(document)) + model.num_system_prompt_tokens, summary_tokens)
+    levels[0]["latency_seconds"] = max(first_wave, levels[0]["latency_seconds"] - sum(level["latency_seconds"] for level in levels[1:-1]))
+    return levels
+
+
+def plan_summarization(text, summarizers, model_names, method_names, summary_tokens=300, model_kwargs=None):
+    """Returns one plan per (model, method), sorted by estimated latency, the infeasible ones last.
+
+    `summarizers` maps every method name to its summarizer class, e.g. `summarization_methods_app.SUMMARIZERS`.
+    """
+    model_kwargs = model_kwargs or {}
+    documents = {}
+    plans = []
+    for model_name in model_names:
+        for method_name in method_names:
+            model = summarizers[method_name](model_name, **model_kwargs)
+            # NOTE: models sharing a tokenizer share the tokenized document
+            if model.tokenizer_name not in documents:
+                documents[model.tokenizer_name] = model.as_document(text)
+            document = documents[model.tokenizer_name]
+
+            if not model.is_longer_than_ctx_window(document):
+                levels = [plan_level(model, [len(document) + model.num_system_prompt_tokens], summary_tokens)]
+            elif method_name == "refine":
+                levels = plan_refine(model, document, summary_tokens)
+            elif method_name == "refine-prefetch":
+                levels = plan_refine_prefetch(model, document, summary_tokens)
+            else:
+                final_system_prompt_tokens = model.get_num_tokens(model.final_system_prompt) if model.final_system_prompt else None
+                levels = plan_map_reduce(model, document, summary_tokens, final_system_prompt_tokens)
+
+            plan = {"model_name": model_name, "method": method_name, "model": model, "document": document,
+                    "num_document_tokens": len(document), "feasible": levels is not None}
+            if levels is not None:
+                plan.update(num_calls=sum(level["num_calls"] for level in levels),
+                            serial_depth=len(levels),
+                            num_input_tokens=sum(level["input_tokens"] for level in levels),
+                            num_output_tokens=sum(level["output_tokens"] for level in levels),
+                            latency_seconds=sum(level["latency_seconds"] for level in levels))
+                plan["cost_usd"] = model.cost_usd(plan["num_input_tokens"], plan["num_output_tokens"])
+            plans.append(plan)
+
+    return sorted(plans, key=lambda plan: (not plan["feasible"], plan.get("latency_seconds", 0), plan.get("cost_usd", 0)))
+
+
+def fits_budget(plan, max_cost=None, max_latency=None):
+    return (plan["feasible"]
+            and (max_cost is None or plan["cost_usd"] <= max_cost)
+            and (max_latency is None or plan["latency_seconds"] <= max_latency))
+
+
+def choose_plan(plans, max_cost=None, max_latency=None):
+    """The fastest plan within the budget, the plans must be sorted by `plan_summarization`."""
+    for plan in plans:
+        if fits_budget(plan, max_cost, max_latency):
+            return plan
+
+    feasible_plans = [plan for plan in plans if plan["feasible"]]
+    if not feasible_plans:
+        raise ValueError("None of the summarization plans can reduce the chunk summaries, try a smaller summary_tokens, or a larger reduce_fan_in if it is set")
+    raise ValueError(f"No summarization plan fits max_cost={max_cost} USD and max_latency={max_latency} s,"
+                     f" the cheapest one costs {min(plan['cost_usd'] for plan in feasible_plans):0.5f} USD"
+                     f" and the fastest one takes {min(plan['latency_seconds'] for plan in feasible_plans):0.1f} s")
+
+
+def format_plans(plans, chosen=None, max_cost=None, max_latency=None):
+    lines = [f"   {'model':<14}{'method':<17}{'calls':>6}{'depth':>6}{'input tok':>11}{'output tok':>11}{'latency':>10}{'cost':>11}"]
+    for plan in plans:
+        mark = "-> " if plan is chosen else ("   " if fits_budget(plan, max_cost, max_latency) else " x ")
+        if not plan["feasible"]:
+            lines.append(f"{mark}{plan['model_name']:<14}{plan['method']:<17}  summaries can't be reduced with this reduce_fan_in")
+            continue
+        lines.append(f"{mark}{plan['model_name']:<14}{plan['method']:<17}{plan['num_calls']:>6}{plan['serial_depth']:>6}"
+                     f"{plan['num_input_tokens']:>11}{plan['num_output_tokens']:>11}{plan['latency_seconds']:>9.1f}s{plan['cost_usd']:>9.5f}$")
+    return "\n".join(lines)
+
+
+def print_plans(doc_names, parse_fn, summarizers, model_names, method_names, summary_tokens=300, model_kwargs=None, max_cost=None, max_latency=None):
+    """Prints the plans of every document, `parse_fn` turns a document name into its text."""
+    for doc_name in doc_names:
+        plans = plan_summarization(parse_fn(doc_name), summarizers, model_names, method_names, summary_tokens, model_kwargs)
+        try:
+            chosen = choose_plan(plans, max_cost, max_latency)
+        except ValueError as err:
+            chosen = None
+            print(err)
+        print(doc_name)
+        print(format_plans(plans, chosen, max_cost, max_latency))
+
+
+if __name__ == "__main__":
+    import argparse
+    import glob
+    import os
+
+    # NOTE: only imported when the planner runs on its own, the app passes its summarizers to `plan_summarization`
+    from summarization_methods_app import SUMMARIZERS, load_parse_pdf
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs_path", type=str, default="raw_docs")
+    parser.add_argument("--models", nargs="+", choices=["llama2", "mixtral", "mistral", "nous-hermes"], default=["llama2", "mixtral", "mistral", "nous-hermes"])
+    parser.add_argument("--methods", nargs="+", choices=list(SUMMARIZERS), default=list(SUMMARIZERS))
+    parser.add_argument("--max_cost", type=float, default=None, help="Budget per document in USD")
+    parser.add_argument("--max_latency", type=float, default=None, help="Budget per document in seconds")
+    parser.add_argument("--summary_tokens", type=int, default=300, help="Expected length of every intermediate summary")
+    parser.add_argument("--max_concurrency", type=int, default=8)
+    parser.add_argument("--reduce_fan_in", type=int, default=None)
+    args = parser.parse_args()
+
+    print_plans(glob.glob(os.path.join(args.docs_path, "*.pdf")), load_parse_pdf, SUMMARIZERS, args.models, args.methods, args.summary_tokens,
+                {"max_concurrency": args.max_concurrency, "reduce_fan_in": args.reduce_fan_in}, args.max_cost, args.max_latency)
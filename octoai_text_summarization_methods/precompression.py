@@ -0,0 +1,123 @@
+"""Extractive pre-compression of a document before it's summarized by the LLM.
+
+The document is split into sentences, every sentence is scored by TextRank over TF-IDF vectors, and
+the lowest scored ones are dropped until the document fits in `target_ratio` of its tokens. Tables,
+numbers-only lines and repeated boilerplate end up with the lowest scores, so they go first.
+
+Everything is vectorized with NumPy on the (sentence, term) pairs of the sparse TF-IDF matrix, the
+sentence similarity matrix is never built, so the cost stays linear in the document length.
+"""
+import re
+import time
+
+import numpy as np
+
+from tokenized_document import PARAGRAPH_BREAK, SENTENCE_BREAK
+
+
+WORD = re.compile(r"[a-z][a-z'-]+")
+
+
+def sentence_spans(text):
+    """[start, end) character spans of the sentences, every span keeps its trailing whitespace."""
+    breaks = [match.end() for pattern in (PARAGRAPH_BREAK, SENTENCE_BREAK) for match in pattern.finditer(text)]
+    bounds = np.unique(np.asarray([0, len(text)] + breaks, dtype=np.int64))
+    return np.stack([bounds[:-1], bounds[1:]], axis=1)
+
+
+def tfidf_pairs(sentences):
+    """Sparse L2-normalized TF-IDF matrix of the sentences, as parallel arrays of (sentence, term, weight)."""
+    words = [WORD.findall(sentence.lower()) for sentence in sentences]
+    sentence_ids = np.repeat(np.arange(len(sentences)), [len(sentence_words) for sentence_words in words])
+    if len(sentence_ids) == 0:
+        return sentence_ids, sentence_ids, np.zeros(0)
+
+    _, term_ids = np.unique(np.asarray([word for sentence_words in words for word in sentence_words]), return_inverse=True)
+    num_terms = term_ids.max() + 1
+    pairs, term_counts = np.unique(sentence_ids * num_terms + term_ids, return_counts=True)
+    sentence_ids, term_ids = pairs // num_terms, pairs % num_terms
+
+    document_frequency = np.bincount(term_ids, minlength=num_terms)
+    idf = np.log((1 + len(sentences)) / (1 + document_frequency)) + 1
+    weights = (1 + np.log(term_counts)) * idf[term_ids]
+    norms = np.sqrt(np.bincount(sentence_ids, weights=weights ** 2, minlength=len(sentences)))
+    return sentence_ids, term_ids, weights / norms[sentence_ids]
+
+
+def textrank_scores(sentence_ids, term_ids, weights, num_sentences, damping=0.85, max_iterations=100, tol=1e-6):
+    """PageRank over the cosine similarity graph of the sentences, without materializing the graph.
+
+    The similarity matrix is X X^T, with X the TF-IDF matrix, so multiplying it by a vector is two sparse
+    products, X^T v and then X (X^T v), each one a `np.bincount` over the non-zero entries.
+    """
+    num_terms = term_ids.max() + 1 if len(term_ids) else 0
+    self_similarity = np.bincount(sentence_ids, weights=weights ** 2, minlength=num_sentences)
+
+    def similarity_matvec(vector):
+        per_term = np.bincount(term_ids, weights=weights * vector[sentence_ids], minlength=num_terms)
+        # NOTE: a sentence isn't its own neighbour
+        return np.bincount(sentence_ids, weights=weights * per_term[term_ids], minlength=num_sentences) - self_similarity * vector
+
+    degree = similarity_matvec(np.ones(num_sentences))
+    is_dangling = degree <= 1e-12
+    degree[is_dangling] = 1.0
+
+    scores = np.full(num_sentences, 1 / num_sentences)
+    for _ in range(max_iterations):
+        # NOTE: the sentences without neighbours spread their score uniformly, so the scores keep summing to 1
+        dangling_score = scores[is_dangling].sum() / num_sentences
+        next_scores = (1 - damping) / num_sentences + damping * (similarity_matvec(scores / degree) + dangling_score)
+        converged = np.abs(next_scores - scores).sum() < tol
+        scores = next_scores
+        if converged:
+            break
+    return scores
+
+
+def select_sentences(scores, num_tokens, max_tokens):
+    """Mask of the highest scored sentences fitting in `max_tokens`, the others are dropped."""
+    order = np.argsort(-scores, kind="stable")
+    keep = np.zeros(len(scores), dtype=bool)
+    budget = max_tokens
+    # NOTE: a long sentence that doesn't fit anymore doesn't stop the shorter, lower scored ones from filling the budget
+    for idx in order:
+        if num_tokens[idx] <= budget:
+            keep[idx] = True
+            budget -= num_tokens[idx]
+    return keep
+
+
+def compress_document(document, tokenize, target_ratio=0.5, damping=0.85):
+    """Drops the least salient sentences of a `TokenizedDocument` down to `target_ratio` of its tokens.
+
+    Returns the compressed document, tokenized with `tokenize`, and a report of the reduction.
+    """
+    start_time = time.perf_counter()
+    text = document.text
+    if not text:
+        return document, {"num_document_tokens": 0, "num_compressed_tokens": 0, "num_sentences": 0,
+                          "num_kept_sentences": 0, "compression_seconds": 0.0}
+    spans = sentence_spans(text)
+    sentences = [text[start:end] for start, end in spans]
+    # NOTE: the tokens of every sentence come from the token offsets, nothing is tokenized again
+    token_bounds = np.searchsorted(document.offsets[:, 0], spans[:, 0], side="left")
+    num_tokens = np.diff(np.append(token_bounds, len(document)))
+
+    sentence_ids, term_ids, weights = tfidf_pairs(sentences)
+    scores = textrank_scores(sentence_ids, term_ids, weights, len(sentences), damping=damping)
+    # NOTE: the sentences without any word (tables, page numbers, blank lines) go first, then the repeated ones
+    scores[np.bincount(sentence_ids, minlength=len(sentences)) == 0] = -1.0
+    seen = set()
+    for idx, sentence in enumerate(sentences):
+        key = " ".join(WORD.findall(sentence.lower()))
+        if key and key in seen:
+            scores[idx] = -1.0
+        seen.add(key)
+
+    keep = select_sentences(scores, num_tokens, int(len(document) * target_ratio))
+    compressed = tokenize("".join(sentence for sentence, is_kept in zip(sentences, keep) if is_kept))
+    return compressed, {"num_document_tokens": len(document),
+                        "num_compressed_tokens": len(compressed),
+                        "num_sentences": len(sentences),
+                        "num_kept_sentences": int(keep.sum()),
+                        "compression_seconds": time.perf_counter() - start_time}
@@ -4,16 +4,33 @@ import os
 import glob
 import time
 import sys
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
+from types import SimpleNamespace
 from dotenv import load_dotenv
 from octoai.client import Client
 import tiktoken
 
 from langchain_community.document_loaders import UnstructuredPDFLoader
-from transformers import AutoTokenizer
+
+from completion_cache import CompletionCache
+from dedup import ParagraphDeduplicator
+from pdf_cache import PDFCache
+from planner import choose_plan, format_plans, plan_summarization
+from precompression import compress_document
+from token_counting import count_tokens, count_tokens_batch, get_token_estimator
+from tokenized_document import TokenizedDocument
+from tokenizer_registry import get_tokenizer
+from usage_ledger import UsageLedger
 
 
 load_dotenv()
 
+# NOTE: point it to a local stand-in server, e.g. local_openai_server/, for offline load tests
+OCTOAI_BASE_URL = os.environ.get("OCTOAI_BASE_URL")
+
 SYSTEM_PROMPT = "You are a helpful financial and accounting specialist assistant. You will summarize any given document into 10 bullet points. Please note that your work will be reviewed, if done right, you will get a 100 USD performance bonus per summary."
 
 # NOTE: The prices are up to date as of end of February 2024
@@ -22,12 +39,29 @@ COSTS = {"mixtral": {"input": 0.0003, "output": 0.0005},
          "mistral": {"input": 0.0001, "output": 0.00025},
          "llama2": {"input": 0.0006, "output": 0.0019}}
 
+RERANK_SYSTEM_PROMPT = ("You are a helpful financial and accounting specialist assistant."
+                        " You will pick the top 10 most important items from the given list of bullet points."
+                        " Please note that your work will be reviewed, if done right, you will get a 100 USD performance bonus.")
+
 
 class AbstractOctoAIModel:
-    def __init__(self, model_name, system_prompt=None):
+    # NOTE: the system prompt of the call writing the final summary, when it differs from `system_prompt`
+    final_system_prompt = None
+
+    def __init__(self, model_name, system_prompt=None, max_concurrency=8, reduce_fan_in=None, completion_cache=None):
         self.system_prompt = system_prompt or SYSTEM_PROMPT
         self.client = Client()
+        if OCTOAI_BASE_URL:
+            # NOTE: the octoai SDK has no base_url option, but the chat endpoint is a plain attribute
+            self.client.chat.completions.endpoint = f"{OCTOAI_BASE_URL.rstrip('/')}/chat/completions"
+        self.completion_cache = completion_cache
         self.slug_model_name = model_name
+        # NOTE: max number of in-flight requests during the map phase, 1 means sequential
+        self.max_concurrency = max_concurrency
+        # NOTE: an executor shared by several documents, see `summarize_batch`
+        self.executor = None
+        # NOTE: max number of sibling summaries merged by a single reduce call
+        self.reduce_fan_in = reduce_fan_in
         self.params = {
                 "temperature": 0.75,
                 "presence_penalty": 1,
@@ -38,173 +72,355 @@ class AbstractOctoAIModel:
         
         if self.slug_model_name.startswith("mixtral"):
             self.model_name = "mixtral-8x7b-instruct-fp16"
-            self.tokenizer = AutoTokenizer.from_pretrained("mistralai/Mixtral-8x7B-Instruct-v0.1")
+            self.tokenizer_name = "mistralai/Mixtral-8x7B-Instruct-v0.1"
             self.ctx_window_size = 32768
         elif self.slug_model_name.startswith("mistral"):
             self.model_name = "mistral-7b-instruct-fp16"
-            self.tokenizer = AutoTokenizer.from_pretrained("mistralai/Mistral-7B-Instruct-v0.2")
+            self.tokenizer_name = "mistralai/Mistral-7B-Instruct-v0.2"
             self.ctx_window_size = 32768
         elif self.slug_model_name.startswith("llama2"):
             self.model_name = "llama-2-70b-chat-fp16"
-            self.tokenizer = AutoTokenizer.from_pretrained("NousResearch/Llama-2-70b-chat-hf")
+            self.tokenizer_name = "NousResearch/Llama-2-70b-chat-hf"
             self.ctx_window_size = 4096
         elif self.slug_model_name.startswith("nous-hermes"):
             self.model_name = "nous-hermes-2-mixtral-8x7b-dpo-fp16"
-            self.tokenizer = AutoTokenizer.from_pretrained("mistralai/Mixtral-8x7B-Instruct-v0.1")
+            self.tokenizer_name = "mistralai/Mixtral-8x7B-Instruct-v0.1"
             self.ctx_window_size = 32768
 
-    def chunk_text_iter(self, text):
-        max_size = self.ctx_window_size - self.get_num_tokens(self.system_prompt) - self.params["max_tokens"] - 100
-        current_size = self.get_num_tokens(text)
+        # NOTE: the tokenizers are loaded once per process and shared by all the summarizers
+        self.tokenizer = get_tokenizer(self.tokenizer_name)
+        self.token_estimator = get_token_estimator(self.tokenizer_name, self.tokenizer)
+        # NOTE: the system prompt doesn't change, so it's tokenized only once
+        self.num_system_prompt_tokens = self.get_num_tokens(self.system_prompt)
+        self.max_chunk_size = self.ctx_window_size - self.num_system_prompt_tokens - self.params["max_tokens"] - 100
 
-        n_chunks = current_size // max_size + 1
+    def tokenize(self, text):
+        document = TokenizedDocument.from_text(text, self.tokenizer)
+        self.token_estimator.observe(len(text), len(document))
+        return document
 
-        text_tokens = self.tokenizer.encode(text)
+    def as_document(self, text):
+        return text if isinstance(text, TokenizedDocument) else self.tokenize(text)
 
-        for idx in range(n_chunks):
-            yield self.tokenizer.decode(text_tokens[idx * max_size: (idx + 1) * max_size], skip_special_tokens=True)
+    def chunk_text_iter(self, text):
+        # NOTE: the chunks are slices of the original text cut at paragraph or sentence breaks, nothing is decoded
+        yield from self.as_document(text).iter_chunks(self.max_chunk_size)
 
     def get_num_tokens(self, text):
-        return len(self.tokenizer.encode(text))
-    
-    def is_longer_than_ctx_window(self, text):
-        return self.get_num_tokens(text) > self.ctx_window_size - self.get_num_tokens(self.system_prompt) - self.params["max_tokens"] - 100
+        if isinstance(text, TokenizedDocument):
+            return len(text)
+        num_tokens = count_tokens(self.tokenizer, text)
+        self.token_estimator.observe(len(text), num_tokens)
+        return num_tokens
+
+    def get_num_tokens_batch(self, texts):
+        """Same as `get_num_tokens` for many texts, the strings are encoded in a single parallel batch."""
+        texts = list(texts)
+        strings = [text for text in texts if not isinstance(text, TokenizedDocument)]
+        counts = iter(count_tokens_batch(self.tokenizer, strings))
+        num_tokens = [len(text) if isinstance(text, TokenizedDocument) else next(counts) for text in texts]
+        for text, count in zip(texts, num_tokens):
+            if not isinstance(text, TokenizedDocument):
+                self.token_estimator.observe(len(text), count)
+        return num_tokens
+
+    def estimate_num_tokens(self, text):
+        return len(text) if isinstance(text, TokenizedDocument) else self.token_estimator.estimate(text)
 
-    def get_completions(self, user_prompt):
+    def is_longer_than_ctx_window(self, text):
+        if isinstance(text, TokenizedDocument):
+            return len(text) > self.max_chunk_size
+        # NOTE: only the texts whose length is close to the limit are tokenized
+        is_longer = self.token_estimator.is_longer_than(text, self.max_chunk_size)
+        return is_longer if is_longer is not None else self.get_num_tokens(text) > self.max_chunk_size
+
+    def cost_usd(self, num_input_tokens, num_output_tokens):
+        return total_cost({"num_input_tokens": num_input_tokens, "num_output_tokens": num_output_tokens, "model_name": self.slug_model_name})
+
+    def parallel_map(self, fn, items):
+        items = list(items)
+        if self.executor is not None:
+            return list(self.executor.map(fn, items))
+        if self.max_concurrency <= 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+
+        # NOTE: executor.map returns results in the order of the items, so the reduce step sees the same order
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(items))) as executor:
+            return list(executor.map(fn, items))
+
+    def map_completions(self, chunks, on_progress=None, ledger=None):
+        chunks = list(chunks)
+        num_done = [0]
+        lock = threading.Lock()
+
+        def summarize(chunk):
+            # NOTE: the chunks always fit in the context window
+            completion = self.create_completion(str(chunk), ledger=ledger, stage="map")
+            if on_progress is not None:
+                with lock:
+                    num_done[0] += 1
+                    on_progress("map", num_done[0], len(chunks))
+            return completion
+
+        return self.parallel_map(summarize, chunks)
+
+    def create_completion(self, user_prompt, system_prompt=None, on_token=None, ledger=None, stage="summarize"):
+        """Sends a single chat completion request, when `on_token` is given the response is streamed into it.
+
+        When `ledger` is given, the call is recorded in it under `stage`.
+        """
+        messages = [
+            {
+                "role": "system",
+                "content": system_prompt or self.system_prompt,
+            },
+            {
+                "role": "user",
+                "content": user_prompt
+            }
+        ]
+
+        start_time = time.perf_counter()
+        if self.completion_cache is not None:
+            completion = self.completion_cache.get(self.model_name, self.params, messages)
+            if completion is not None:
+                if on_token is not None:
+                    on_token(completion.choices[0].message.content)
+                if ledger is not None:
+                    ledger.record(stage, self.slug_model_name, completion, start_time, cache_hit=True)
+                return completion
+
+        if on_token is None:
+            completion = self.client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                **self.params
+            )
+        else:
+            stream = self.client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                **{**self.params, "stream": True}
+            )
+            completion = collect_stream(stream, on_token)
+            if completion.usage is None:
+                # NOTE: not every endpoint sends the usage with the last chunk, so count the tokens locally
+                prompt_tokens, completion_tokens = self.get_num_tokens_batch([user_prompt, completion.choices[0].message.content])
+                prompt_tokens += self.get_num_tokens(messages[0]["content"])
+                completion.usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens)
+
+        if ledger is not None:
+            ledger.record(stage, self.slug_model_name, completion, start_time)
+        if self.completion_cache is not None:
+            self.completion_cache.put(self.model_name, self.params, messages, completion)
+        return completion
+
+    def is_fan_in_full(self, group_size):
+        return self.reduce_fan_in is not None and group_size >= self.reduce_fan_in
+
+    def group_summaries(self, summary_sizes):
+        # NOTE: greedily packs consecutive summaries, so that every group keeps the document order,
+        #  fits in a single context window, and has at most `reduce_fan_in` summaries when it's set
+        groups = []
+        current_group, current_size = [], 0
+        for idx, size in enumerate(summary_sizes):
+            if current_group and (self.is_fan_in_full(len(current_group)) or current_size + size + 1 > self.max_chunk_size):
+                groups.append(current_group)
+                current_group, current_size = [], 0
+
+            current_group.append(idx)
+            current_size += size + 1
+
+        if current_group:
+            groups.append(current_group)
+        return groups
+
+    def tree_reduce(self, completions, final_system_prompt=None, ledger=None, final_stage=None, on_progress=None, on_token=None):
+        """Reduces the chunk summaries level by level, running all the reduce calls of a level in parallel.
+
+        Every level merges as many sibling summaries as fit in a context window, and at most `reduce_fan_in`
+        when it's set, so N summaries take O(log N) rounds, and a single one when they all fit. The calls of level k are recorded in `ledger` as stage "reduce-k",
+        except the final one when `final_stage` is given. Only the final reduce call is streamed into `on_token`.
+        """
+        level = 0
+        while True:
+            level += 1
+            groups = self.group_summaries([comp.usage.completion_tokens for comp in completions])
+            if len(groups) > 1 and len(groups) == len(completions):
+                raise ValueError(f"Can't reduce the summaries of {self.slug_model_name}, every summary takes a whole context window, got reduce_fan_in={self.reduce_fan_in}")
+
+            is_final = len(groups) == 1
+            stage = final_stage if is_final and final_stage else f"reduce-{level}"
+            completions = self.parallel_map(
+                lambda group: self.create_completion("\n".join(completions[idx].choices[0].message.content for idx in group),
+                                                     system_prompt=final_system_prompt if is_final else None,
+                                                     on_token=on_token if is_final else None,
+                                                     ledger=ledger, stage=stage),
+                groups)
+            if on_progress is not None and not is_final:
+                on_progress("reduce", level, None)
+
+            if is_final:
+                return completions[0]
+
+    def get_completions(self, user_prompt, ledger=None, on_progress=None, on_token=None):
+        """Summarizes `user_prompt`, every call made is recorded in `ledger` when given.
+
+        The returned completion is the final call only, its usage doesn't include the intermediate calls.
+        """
         raise NotImplementedError()
 
 
 class OctoAIRefinerSummarizer(AbstractOctoAIModel):
-    def get_completions(self, user_prompt):
+    def get_completions(self, user_prompt, ledger=None, on_progress=None, on_token=None):
         if self.is_longer_than_ctx_window(user_prompt):
-            current_chunk = next(self.chunk_text_iter(user_prompt))
+            user_prompt = self.as_document(user_prompt)
+            # NOTE: the cursor walks over the token ids of the original document, so at each step
+            #  only the new running summary is tokenized, and the work stays linear in the document length
+            cursor = 0
+            step = 0
+            chunk_summary = None
+
+            while cursor < len(user_prompt):
+                if chunk_summary is None:
+                    summary_so_far = ""
+                    chunk_size = self.max_chunk_size
+                else:
+                    summary_so_far = f"Summary so far:\n{chunk_summary.choices[0].message.content}\nText: "
+                    chunk_size = self.max_chunk_size - self.get_num_tokens(summary_so_far)
+
+                chunk_end = user_prompt.chunk_end(cursor, chunk_size)
+                current_chunk = user_prompt.slice(cursor, chunk_end)
+                cursor = chunk_end
+
+                is_last = cursor == len(user_prompt)
+                step += 1
+                chunk_summary = self.create_completion(summary_so_far + current_chunk.text, on_token=on_token if is_last else None,
+                                                       ledger=ledger, stage=f"refine-{step}")
+                if on_progress is not None and not is_last:
+                    on_progress("refine", cursor, len(user_prompt))
 
-            chunk_summary = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": self.system_prompt,
-                    },
-                    {
-                        "role": "user",
-                        "content": current_chunk
-                    }
-                ],
-                **self.params
-            )
+            return chunk_summary
+        else:
+            return self.create_completion(str(user_prompt), on_token=on_token, ledger=ledger)
+
+
+class OctoAIRefinePrefetchSummarizer(AbstractOctoAIModel):
+    def get_completions(self, user_prompt, ledger=None, on_progress=None, on_token=None):
+        """Refines a running summary over the chunk summaries instead of the full chunks.
+
+        All the chunks are summarized in parallel as soon as the document is split, like the map phase of
+        map-reduce, while the refine steps run one after another on the chunk summaries already available.
+        Every step takes the next chunk summary, plus the following ones that are already done and fit,
+        so the faster the map phase, the fewer refine steps.
+        """
+        if not self.is_longer_than_ctx_window(user_prompt):
+            return self.create_completion(str(user_prompt), on_token=on_token, ledger=ledger)
+
+        chunks = list(self.chunk_text_iter(self.as_document(user_prompt)))
+        chunk_ends = list(accumulate(len(chunk) for chunk in chunks))
+        num_done = [0]
+        lock = threading.Lock()
+
+        def on_chunk_done(future):
+            if on_progress is not None and not future.cancelled():
+                with lock:
+                    num_done[0] += 1
+                    on_progress("map", num_done[0], len(chunks))
+
+        # NOTE: as in `parallel_map`, the executor shared by the documents of a batch is used when there's one
+        executor = self.executor or ThreadPoolExecutor(max_workers=max(1, min(self.max_concurrency, len(chunks))))
+        futures = [executor.submit(self.create_completion, str(chunk), ledger=ledger, stage="map") for chunk in chunks]
+        for future in futures:
+            future.add_done_callback(on_chunk_done)
+
+        try:
+            cursor = 0
+            step = 0
+            chunk_summary = None
+            while cursor < len(futures):
+                if chunk_summary is None:
+                    summary_so_far = ""
+                    budget = self.max_chunk_size
+                else:
+                    summary_so_far = f"Summary so far:\n{chunk_summary.choices[0].message.content}\nText: "
+                    budget = self.max_chunk_size - self.get_num_tokens(summary_so_far)
+
+                group = [futures[cursor].result()]
+                group_size = group[0].usage.completion_tokens + 1
+                while cursor + len(group) < len(futures) and not self.is_fan_in_full(len(group)) and futures[cursor + len(group)].done():
+                    next_size = futures[cursor + len(group)].result().usage.completion_tokens + 1
+                    if group_size + next_size > budget:
+                        break
+                    group.append(futures[cursor + len(group)].result())
+                    group_size += next_size
+                cursor += len(group)
+
+                is_last = cursor == len(futures)
+                step += 1
+                chunk_summary = self.create_completion(summary_so_far + "\n".join(comp.choices[0].message.content for comp in group),
+                                                       on_token=on_token if is_last else None, ledger=ledger, stage=f"refine-{step}")
+                if on_progress is not None and not is_last:
+                    on_progress("refine", chunk_ends[cursor - 1], chunk_ends[-1])
+            return chunk_summary
+        finally:
+            for future in futures:
+                future.cancel()
+            if executor is not self.executor:
+                executor.shutdown(wait=False)
 
-            while True:
-                user_prompt = f"Summary so far:\n{chunk_summary.choices[0].message.content}\nText: {user_prompt[len(current_chunk):]}"
-                current_chunk = next(self.chunk_text_iter(user_prompt))
 
-                next_chunk_summary = self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": self.system_prompt,
-                        },
-                        {
-                            "role": "user",
-                            "content": current_chunk
-                        }
-                    ],
-                    **self.params
-                )
+class OctoAIMapReduceSummarizer(AbstractOctoAIModel):
+    def get_completions(self, user_prompt, ledger=None, on_progress=None, on_token=None):
+        if self.is_longer_than_ctx_window(user_prompt):
+            user_prompt = self.as_document(user_prompt)
+            completions = self.map_completions(self.chunk_text_iter(user_prompt), on_progress=on_progress, ledger=ledger)
 
-                next_chunk_summary.usage.prompt_tokens += chunk_summary.usage.prompt_tokens
-                next_chunk_summary.usage.completion_tokens += chunk_summary.usage.completion_tokens
-                next_chunk_summary.usage.total_tokens += chunk_summary.usage.total_tokens
+            return self.tree_reduce(completions, ledger=ledger, on_progress=on_progress, on_token=on_token)
+        else:
+            return self.create_completion(str(user_prompt), on_token=on_token, ledger=ledger)
 
-                chunk_summary = next_chunk_summary
 
-                if not self.is_longer_than_ctx_window(user_prompt):
-                    break
+class OctoAIMapReduceFinalRerankerSummarizer(AbstractOctoAIModel):
+    final_system_prompt = RERANK_SYSTEM_PROMPT
 
+    def get_completions(self, user_prompt, ledger=None, on_progress=None, on_token=None, is_final=False):
+        if self.is_longer_than_ctx_window(user_prompt):
+            user_prompt = self.as_document(user_prompt)
+            completions = self.map_completions(self.chunk_text_iter(user_prompt), on_progress=on_progress, ledger=ledger)
 
-            return chunk_summary
+            return self.tree_reduce(completions, final_system_prompt=self.final_system_prompt, ledger=ledger, final_stage="rerank",
+                                    on_progress=on_progress, on_token=on_token)
         else:
-            completions = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": self.system_prompt,
-                    },
-                    {
-                        "role": "user",
-                        "content": user_prompt
-                    }
-                ],
-                **self.params
-            )
+            return self.create_completion(str(user_prompt), system_prompt=self.final_system_prompt if is_final else None, on_token=on_token,
+                                          ledger=ledger, stage="rerank" if is_final else "summarize")
 
-            return completions
 
+SUMMARIZERS = {"map-reduce": OctoAIMapReduceSummarizer,
+               "refine": OctoAIRefinerSummarizer,
+               "refine-prefetch": OctoAIRefinePrefetchSummarizer,
+               "rerank": OctoAIMapReduceFinalRerankerSummarizer}
 
-class OctoAIMapReduceSummarizer(AbstractOctoAIModel):
-    def get_completions(self, user_prompt):
-        if self.is_longer_than_ctx_window(user_prompt):
-            completions = []
-            for chunk in self.chunk_text_iter(user_prompt):
-                completions.append(self.get_completions(chunk))
-
-            final_completion = self.get_completions("\n".join(comp.choices[0].message.content for comp in completions))
-            final_completion.usage.prompt_tokens += sum(comp.usage.prompt_tokens for comp in completions)
-            final_completion.usage.completion_tokens += sum(comp.usage.completion_tokens for comp in completions)
-            final_completion.usage.total_tokens += sum(comp.usage.total_tokens for comp in completions)
-            return final_completion
-        else:
-            completions = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": self.system_prompt,
-                    },
-                    {
-                        "role": "user",
-                        "content": user_prompt
-                    }
-                ],
-                **self.params
-            )
-
-            return completions
 
+def collect_stream(stream, on_token):
+    # NOTE: rebuilds a completion-like object from the streamed chunks, the usage is only known if the endpoint sends it
+    content, usage, finish_reason = [], None, None
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            usage = SimpleNamespace(prompt_tokens=chunk.usage.prompt_tokens,
+                                    completion_tokens=chunk.usage.completion_tokens,
+                                    total_tokens=chunk.usage.total_tokens)
+        if not chunk.choices:
+            continue
 
-class OctoAIMapReduceFinalRerankerSummarizer(AbstractOctoAIModel):
-    def get_completions(self, user_prompt, is_final=False):
-        if self.is_longer_than_ctx_window(user_prompt):
-            completions = []
-            for chunk in self.chunk_text_iter(user_prompt):
-                completions.append(self.get_completions(chunk))
-
-            final_completion = self.get_completions("\n".join(comp.choices[0].message.content for comp in completions), is_final=True)
-            final_completion.usage.prompt_tokens += sum(comp.usage.prompt_tokens for comp in completions)
-            final_completion.usage.completion_tokens += sum(comp.usage.completion_tokens for comp in completions)
-            final_completion.usage.total_tokens += sum(comp.usage.total_tokens for comp in completions)
-            return final_completion
-        else:
-            completions = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": self.system_prompt if not is_final else ("You are a helpful financial and accounting specialist assistant."
-                                    " You will pick the top 10 most important items from the given list of bullet points."
-                                    " Please note that your work will be reviewed, if done right, you will get a 100 USD performance bonus."),
-                    },
-                    {
-                        "role": "user",
-                        "content": user_prompt
-                    }
-                ],
-                **self.params
-            )
+        delta = chunk.choices[0].delta.content
+        if delta:
+            content.append(delta)
+            on_token(delta)
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
 
-            return completions
+    message = SimpleNamespace(role="assistant", content="".join(content))
+    return SimpleNamespace(choices=[SimpleNamespace(index=0, message=message, finish_reason=finish_reason)], usage=usage)
 
 
 def load_parse_pdf(filename):
@@ -213,21 +429,190 @@ def load_parse_pdf(filename):
     return data[0].page_content
 
 
-def benchmark_one(document, doc_name, model):
-    doc_input_tokens = model.get_num_tokens(document)
-    print(f"Loaded {doc_name} of size {doc_input_tokens} tokens")
+def load_document(filename, model, pdf_cache=None, deduplicator=None):
+    if deduplicator is not None:
+        # NOTE: the deduplicated text depends on the documents seen before it, so only the parsed text is cached
+        text = pdf_cache.load_text(filename, load_parse_pdf) if pdf_cache is not None else load_parse_pdf(filename)
+        text = deduplicator.dedup(filename, text)
+        report = deduplicator.reports[filename]
+        print(f"Removed {report['num_removed_paragraphs']} repeated paragraphs ({report['removed_bytes']} bytes) from {filename}")
+        return model.tokenize(text)
+    if pdf_cache is None:
+        return model.tokenize(load_parse_pdf(filename))
+    return pdf_cache.load_document(filename, load_parse_pdf, model.tokenizer_name, model.tokenize,
+                                   tokenizer_digest=getattr(model.tokenizer, "digest", None))
+
+
+def benchmark_one(document, doc_name, model, stream=False, on_progress=None, on_token=None, ledger=None, compress_ratio=None):
+    # NOTE: the document is tokenized once here, and the token ids are reused by all the summarization steps
+    document = model.as_document(document)
+    print(f"Loaded {doc_name} of size {len(document)} tokens")
+
+    cache_counters = model.completion_cache.counters() if model.completion_cache is not None else None
+    # NOTE: pass a ledger to keep the per-call records, e.g. to export them with `UsageLedger.to_json`
+    ledger = ledger if ledger is not None else UsageLedger()
+    first_token_time = []
+
+    def stream_token(token):
+        if not first_token_time:
+            first_token_time.append(time.perf_counter())
+        if on_token is not None:
+            on_token(token)
 
     start_time = time.perf_counter()
-    completions = model.get_completions(document)
-    time_spent_seconds = time.perf_counter() - start_time
+    compression = None
+    if compress_ratio is not None:
+        # NOTE: the compression time is part of the time to summarize, it has to pay for itself
+        document, compression = compress_document(document, model.tokenize, compress_ratio)
+        print(f"Compressed {doc_name} to {len(document)} tokens in {compression['compression_seconds']:0.2f}s")
+    completions = model.get_completions(document, ledger=ledger, on_progress=on_progress,
+                                        on_token=stream_token if stream or on_token is not None else None)
+    end_time = time.perf_counter()
+    time_spent_seconds = end_time - start_time
     response = completions.choices[0].message.content
 
-    return {"num_input_tokens": completions.usage.prompt_tokens,
+    # NOTE: without streaming the first token arrives together with the whole summary
+    time_to_first_token_seconds = (first_token_time[0] if first_token_time else end_time) - start_time
+    final_call_seconds = end_time - first_token_time[0] if first_token_time else 0.0
+    output_tokens_per_second = (model.get_num_tokens(response) / final_call_seconds) if final_call_seconds > 0 else None
+
+    totals = ledger.totals()
+    usage_by_stage = ledger.by_stage()
+    stats = {"num_input_tokens": totals["num_input_tokens"],
             "time_to_summarize_seconds": time_spent_seconds,
-            "num_output_tokens": completions.usage.completion_tokens,
-            "input_text_len": len(document),
+            "time_to_first_token_seconds": time_to_first_token_seconds,
+            "output_tokens_per_second": output_tokens_per_second,
+            "num_output_tokens": totals["num_output_tokens"],
+            "num_calls": totals["num_calls"],
+            "cached_input_tokens": totals["cached_input_tokens"],
+            "cached_output_tokens": totals["cached_output_tokens"],
+            "input_text_len": len(document.text),
             "model_name": model.slug_model_name,
-            "ctx_window_size": model.ctx_window_size}, response
+            "ctx_window_size": model.ctx_window_size,
+            "reduce_depth": sum(1 for stage in usage_by_stage if stage["stage"].startswith("reduce-") or stage["stage"] == "rerank"),
+            "usage_by_stage": usage_by_stage}
+
+    if compression is not None:
+        stats.update(compression)
+        # NOTE: a lower bound, every removed token is one less map input token, and the fewer chunks
+        #  also mean fewer system prompts and chunk summaries to pay for and to reduce
+        stats["estimated_cost_saved_usd"] = total_cost({"num_input_tokens": compression["num_document_tokens"] - compression["num_compressed_tokens"],
+                                                        "num_output_tokens": 0,
+                                                        "model_name": model.slug_model_name})
+
+    if cache_counters is not None:
+        # NOTE: in --batch mode the counters also include the calls of the documents summarized at the same time
+        for name, value in model.completion_cache.counters().items():
+            stats[name] = value - cache_counters[name]
+
+    return stats, response
+
+
+def ledger_path(ledger_dir, doc_name, model):
+    return os.path.join(ledger_dir, f"{os.path.splitext(os.path.basename(doc_name))[0]}.{model.slug_model_name}.usage.json")
+
+
+def stream_benchmark_one(document, doc_name, model):
+    """Runs `benchmark_one` in a background thread and yields its events as they happen.
+
+    Yields `("progress", message)` while the chunks are summarized, `("token", text)` for every
+    streamed token of the final summary, and a last `("done", (stats, summary))`.
+    """
+    events = queue.Queue()
+
+    def on_progress(stage, done, total):
+        if stage == "reduce":
+            events.put(("progress", f"Reduce level {done} done"))
+        else:
+            events.put(("progress", f"{stage}: {done}/{total} {'tokens' if stage == 'refine' else 'chunks'} summarized"))
+
+    def run():
+        try:
+            events.put(("done", benchmark_one(document, doc_name, model, stream=True, on_progress=on_progress,
+                                              on_token=lambda token: events.put(("token", token)))))
+        except Exception as err:
+            events.put(("error", err))
+
+    threading.Thread(target=run, daemon=True).start()
+    while True:
+        event, payload = events.get()
+        if event == "error":
+            raise payload
+        yield event, payload
+        if event == "done":
+            return
+
+
+class BatchProgress:
+    """Thread-safe per-document status of a batch run."""
+
+    def __init__(self, doc_names):
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.documents = {doc_name: {"status": "queued", "num_tokens": None, "seconds": None} for doc_name in doc_names}
+
+    def update(self, doc_name, status, **kwargs):
+        with self.lock:
+            self.documents[doc_name].update(status=status, **kwargs)
+            num_done = sum(doc["status"] in ("done", "failed") for doc in self.documents.values())
+            print(f"[{num_done}/{len(self.documents)} done, {time.perf_counter() - self.start_time:0.1f}s] {doc_name}: {status}")
+
+
+def summarize_batch(doc_names, model, pdf_cache=None, max_documents_in_flight=4, ledger_dir=None, compress_ratio=None, deduplicator=None):
+    """Summarizes many documents through a single work queue shared by all of them.
+
+    A background thread parses the documents one after another, while every parsed document is
+    summarized by a coordinator thread. The coordinators submit their map and reduce calls to the
+    same executor, bounded by `model.max_concurrency`, so parsing the next document overlaps with
+    the LLM calls of the previous ones. Yields `(doc_name, stats, summary)` as documents complete,
+    with `stats` set to the raised exception if a document failed. The usage ledger of every
+    document is written to `ledger_dir` when given. With a `deduplicator`, the paragraphs repeated
+    from the documents parsed before are removed, the documents are parsed in the order of `doc_names`.
+    """
+    progress = BatchProgress(doc_names)
+    results = queue.Queue()
+
+    def summarize(doc_name, document):
+        progress.update(doc_name, "summarizing", num_tokens=len(document))
+        try:
+            ledger = UsageLedger()
+            stats, summary = benchmark_one(document, doc_name, model, ledger=ledger, compress_ratio=compress_ratio)
+            if deduplicator is not None:
+                stats.update(deduplicator.stats(doc_name, model))
+            if ledger_dir is not None:
+                ledger.to_json(ledger_path(ledger_dir, doc_name, model))
+            progress.update(doc_name, "done", seconds=stats["time_to_summarize_seconds"])
+            results.put((doc_name, stats, summary))
+        except Exception as err:
+            progress.update(doc_name, "failed")
+            results.put((doc_name, err, None))
+
+    with ThreadPoolExecutor(max_workers=model.max_concurrency) as call_executor, \
+         ThreadPoolExecutor(max_workers=max_documents_in_flight) as document_executor, \
+         ThreadPoolExecutor(max_workers=1) as parse_executor:
+        # NOTE: the workers of the shared executor only ever run single completion calls, chunks always fit
+        #  in the context window, so they never wait on other tasks of the same executor
+        model.executor = call_executor
+
+        def parse(doc_name):
+            progress.update(doc_name, "parsing")
+            try:
+                document = load_document(doc_name, model, pdf_cache, deduplicator)
+            except Exception as err:
+                progress.update(doc_name, "failed")
+                results.put((doc_name, err, None))
+                return
+            document_executor.submit(summarize, doc_name, document)
+
+        for doc_name in doc_names:
+            parse_executor.submit(parse, doc_name)
+
+        try:
+            for _ in doc_names:
+                yield results.get()
+        finally:
+            model.executor = None
+
 
 def total_cost(stats_dict):
     model_name_mapper = {
@@ -244,21 +629,55 @@ def total_cost(stats_dict):
            + stats_dict['num_output_tokens'] * COSTS[ model_name_mapper[stats_dict['model_name']] ]['output'] / 1000)
 
 
+def as_html_stages(stats_dict):
+    # NOTE: one row per stage, the wall clock time of a stage is shorter than its summed latency when its calls run concurrently
+    rows = "".join(f"""
+      <tr>
+        <td>{stage['stage']}</td>
+        <td>{stage['num_calls']}</td>
+        <td>{stage['num_input_tokens']}</td>
+        <td>{stage['num_output_tokens']}</td>
+        <td>{stage['wall_clock_seconds']:0.2f} s</td>
+        <td>{stage['cache_hits']} ({stage['cached_input_tokens'] + stage['cached_output_tokens']} tokens)</td>
+        <td>{total_cost(stage):0.5f} USD</td>
+      </tr>""" for stage in stats_dict.get("usage_by_stage", []))
+    return f"""
+    <table>
+      <tr>
+        <th>Stage</th>
+        <th># calls</th>
+        <th># input tokens</th>
+        <th># output tokens</th>
+        <th>Time</th>
+        <th>Cache hits</th>
+        <th>Cost</th>
+      </tr>{rows}
+    </table>
+    """
+
+
 def as_html_spec(stats_dict):
-    # make html table
+    # NOTE: the tokens and the cost are the billed ones, the cache hits are free
     return f"""
     <table>
       <tr>
         <th># input tokens</th>
         <th># output tokens</th>
+        <th>Time to first token</th>
+        <th>Total time</th>
+        <th># cached tokens</th>
         <th>Total cost</th>
       </tr>
       <tr>
         <td>{stats_dict['num_input_tokens']}</td>
         <td>{stats_dict['num_output_tokens']}</td>
+        <td>{stats_dict['time_to_first_token_seconds']:0.2f} s</td>
+        <td>{stats_dict['time_to_summarize_seconds']:0.2f} s</td>
+        <td>{stats_dict.get('cached_input_tokens', 0) + stats_dict.get('cached_output_tokens', 0)}</td>
         <td>{total_cost(stats_dict):0.5f} USD</td>
       </tr>
     </table>
+    {as_html_stages(stats_dict)}
     """
 
 
@@ -266,49 +685,150 @@ if __name__ == "__main__":
     import argparse
 
     model_choices = ["llama2", "mixtral", "mistral", "nous-hermes"]
-    method_choices = ["map-reduce", "refine", "rerank"]
+    method_choices = list(SUMMARIZERS)
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--use_model", choices=model_choices)
-    parser.add_argument("--use_method", choices=method_choices)
+    parser.add_argument("--use_model", choices=model_choices + ["auto"], help="With auto, the planner picks the model")
+    parser.add_argument("--use_method", choices=method_choices + ["auto"], help="With auto, the planner picks the method")
     parser.add_argument("--docs_path", type=str)
+    parser.add_argument("--max_concurrency", type=int, default=8, help="Max number of in-flight requests during the map phase, 1 runs the chunks sequentially")
+    parser.add_argument("--reduce_fan_in", type=int, default=None, help="Max number of chunk summaries merged by a single reduce call, by default as many as fit in the context window")
 
-    parser.add_argument("--as_gradio_app", action="store_true")
-    args = parser.parse_args()
+    parser.add_argument("--batch", action="store_true", help="Summarize all the documents in --docs_path through one shared work queue")
+    parser.add_argument("--max_documents_in_flight", type=int, default=4, help="Max number of documents summarized at the same time in --batch mode")
 
-    if not args.as_gradio_app:
-        if args.use_method == "map-reduce":
-            octo_model = OctoAIMapReduceSummarizer(args.use_model)
-        elif args.use_method == "rerank":
-            octo_model = OctoAIMapReduceFinalRerankerSummarizer(args.use_model)
-        elif args.use_method == "refine":
-            octo_model = OctoAIRefinerSummarizer(args.use_model)
-        else:
-            raise ValueError("Invalid summarization method was provided, was expecting one of ['map-reduce', 'refine', 'rerank'], but got:", args.use_method)
+    parser.add_argument("--pdf_cache_dir", type=str, default=".pdf_cache", help="Where to cache the parsed PDFs and their token ids")
+    parser.add_argument("--no_pdf_cache", action="store_true", help="Always parse and tokenize the PDFs from scratch")
+
+    parser.add_argument("--completion_cache_path", type=str, default=".completion_cache.sqlite", help="SQLite file where the chat completions are cached")
+    parser.add_argument("--no_completion_cache", action="store_true", help="Always send the chat completions to the endpoint")
+
+    parser.add_argument("--stream", action="store_true", help="Stream the final summary to stdout and report the time to first token")
+
+    parser.add_argument("--compress_ratio", type=float, default=None, help="Drop the least salient sentences down to this fraction of the document tokens before summarizing")
+    parser.add_argument("--dedup", action="store_true", help="Remove the paragraphs repeating an earlier one, in the same document or in the documents summarized before")
+    parser.add_argument("--dedup_threshold", type=float, default=0.8, help="Min estimated Jaccard similarity of the word shingles of two repeated paragraphs")
+    parser.add_argument("--ledger_dir", type=str, default=None, help="Write the per-call usage and latency of every document as JSON in this directory")
+
+    parser.add_argument("--max_cost", type=float, default=None, help="With auto, the max estimated cost per document in USD")
+    parser.add_argument("--max_latency", type=float, default=None, help="With auto, the max estimated latency per document in seconds")
+    parser.add_argument("--summary_tokens", type=int, default=300, help="With auto, the expected length of every intermediate summary")
 
+    parser.add_argument("--as_gradio_app", action="store_true")
+    args = parser.parse_args()
+    use_planner = "auto" in (args.use_model, args.use_method)
+    if use_planner and args.batch:
+        parser.error("--batch summarizes all the documents with the same model and method, it can't be used with auto")
+    if use_planner and args.compress_ratio is not None:
+        parser.error("the planner estimates the uncompressed documents, --compress_ratio can't be used with auto")
+
+    pdf_cache = None if args.no_pdf_cache else PDFCache(args.pdf_cache_dir)
+    if args.ledger_dir is not None:
+        os.makedirs(args.ledger_dir, exist_ok=True)
+    deduplicator = ParagraphDeduplicator(args.dedup_threshold) if args.dedup else None
+    completion_cache = CompletionCache(args.completion_cache_path, enabled=not args.no_completion_cache)
+    model_kwargs = {"max_concurrency": args.max_concurrency, "reduce_fan_in": args.reduce_fan_in, "completion_cache": completion_cache}
+
+    if not args.as_gradio_app and use_planner:
         for doc_name in glob.glob(os.path.join(args.docs_path, "*.pdf")):
-            document = load_parse_pdf(doc_name)
-            stats, summary = benchmark_one(document, doc_name, octo_model)
+            text = pdf_cache.load_text(doc_name, load_parse_pdf) if pdf_cache is not None else load_parse_pdf(doc_name)
+            if deduplicator is not None:
+                text = deduplicator.dedup(doc_name, text)
+            # NOTE: the planner only tokenizes the document, no call is made before a plan is chosen
+            plans = plan_summarization(text, SUMMARIZERS,
+                                       model_choices if args.use_model == "auto" else [args.use_model],
+                                       method_choices if args.use_method == "auto" else [args.use_method],
+                                       args.summary_tokens, model_kwargs)
+            print(doc_name)
+            try:
+                plan = choose_plan(plans, args.max_cost, args.max_latency)
+            except ValueError as err:
+                # NOTE: no plan fits the budget, the document is skipped and the estimates are shown
+                print(format_plans(plans, None, args.max_cost, args.max_latency))
+                print(err)
+                print("-*--*-" * 12)
+                continue
+            print(format_plans(plans, plan, args.max_cost, args.max_latency))
+
+            ledger = UsageLedger()
+            stats, summary = benchmark_one(plan["document"], doc_name, plan["model"], stream=args.stream,
+                                           on_token=(lambda token: print(token, end="", flush=True)) if args.stream else None, ledger=ledger)
+            if args.ledger_dir is not None:
+                ledger.to_json(ledger_path(args.ledger_dir, doc_name, plan["model"]))
+            if args.stream:
+                print()
+            stats["method"] = plan["method"]
+            if deduplicator is not None:
+                stats.update(deduplicator.stats(doc_name, plan["model"]))
+            stats["estimated_latency_seconds"], stats["estimated_cost_usd"] = plan["latency_seconds"], plan["cost_usd"]
             print(stats)
             print("Summarization cost:", total_cost(stats), "USD")
             print("-*--*-" * 12)
+    elif not args.as_gradio_app:
+        if args.use_method not in SUMMARIZERS:
+            raise ValueError("Invalid summarization method was provided, was expecting one of", method_choices, "but got:", args.use_method)
+        octo_model = SUMMARIZERS[args.use_method](args.use_model, **model_kwargs)
+
+        doc_names = glob.glob(os.path.join(args.docs_path, "*.pdf"))
+        if args.batch:
+            for doc_name, stats, summary in summarize_batch(doc_names, octo_model, pdf_cache, args.max_documents_in_flight, args.ledger_dir,
+                                                              args.compress_ratio, deduplicator):
+                print(doc_name)
+                print(stats)
+                if not isinstance(stats, Exception):
+                    print("Summarization cost:", total_cost(stats), "USD")
+                print("-*--*-" * 12)
+        else:
+            for doc_name in doc_names:
+                document = load_document(doc_name, octo_model, pdf_cache, deduplicator)
+                ledger = UsageLedger()
+                stats, summary = benchmark_one(document, doc_name, octo_model, stream=args.stream,
+                                               on_token=(lambda token: print(token, end="", flush=True)) if args.stream else None, ledger=ledger,
+                                               compress_ratio=args.compress_ratio)
+                if args.ledger_dir is not None:
+                    ledger.to_json(ledger_path(args.ledger_dir, doc_name, octo_model))
+                if deduplicator is not None:
+                    stats.update(deduplicator.stats(doc_name, octo_model))
+                if args.stream:
+                    print()
+                print(stats)
+                print("Summarization cost:", total_cost(stats), "USD")
+                print("-*--*-" * 12)
     else:
         import gradio as gr
 
 
         def compare_models(doc_name, octo_model_name, summarization_method_pick):
-            document = load_parse_pdf(doc_name)
-            if summarization_method_pick == "map-reduce":
-                octo_model = OctoAIMapReduceSummarizer(octo_model_name)
-            elif summarization_method_pick == "rerank":
-                octo_model = OctoAIMapReduceFinalRerankerSummarizer(octo_model_name)
-            elif summarization_method_pick == "refine":
-                octo_model = OctoAIRefinerSummarizer(octo_model_name)
+            if summarization_method_pick == "auto":
+                yield "Planning...", ""
+                text = pdf_cache.load_text(doc_name, load_parse_pdf) if pdf_cache is not None else load_parse_pdf(doc_name)
+                plans = plan_summarization(text, SUMMARIZERS, [octo_model_name], method_choices, args.summary_tokens, model_kwargs)
+                try:
+                    plan = choose_plan(plans, args.max_cost, args.max_latency)
+                except ValueError as err:
+                    yield f"{format_plans(plans, None, args.max_cost, args.max_latency)}\n\n{err}", ""
+                    return
+                yield format_plans(plans, plan, args.max_cost, args.max_latency), ""
+                octo_model, document = plan["model"], plan["document"]
+            elif summarization_method_pick in SUMMARIZERS:
+                octo_model = SUMMARIZERS[summarization_method_pick](octo_model_name, **model_kwargs)
             else:
-                raise ValueError("Invalid summarization method was provided, was expecting one of ['map-reduce', 'refine', 'rerank'], but got:", summarization_method_pick)
-            octo_stats, octo_summary = benchmark_one(document, doc_name, octo_model)
-
-            return octo_summary, as_html_spec(octo_stats)
+                raise ValueError("Invalid summarization method was provided, was expecting one of", method_choices, "but got:", summarization_method_pick)
+            if summarization_method_pick != "auto":
+                yield "Parsing the document...", ""
+                document = load_document(doc_name, octo_model, pdf_cache)
+
+            # NOTE: the summary box shows the map/reduce progress until the final summary starts streaming in
+            summary = ""
+            for event, payload in stream_benchmark_one(document, doc_name, octo_model):
+                if event == "progress":
+                    yield payload, ""
+                elif event == "token":
+                    summary += payload
+                    yield summary, ""
+                else:
+                    octo_stats, octo_summary = payload
+                    yield octo_summary, as_html_spec(octo_stats)
 
 
         with gr.Blocks() as demo:
@@ -317,7 +837,7 @@ if __name__ == "__main__":
             document_content = gr.File()
 
             octoai_model_pick = gr.Dropdown(value="mixtral-8x7b", label="OctoAI Model", show_label=True, choices=["llama2-70b", "mixtral-8x7b", "mistral-7b-v0.2", "nous-hermes-2-mixtral"])
-            summarization_method_pick = gr.Dropdown(value="map-reduce", label="Summarization Method", show_label=True, choices=method_choices)
+            summarization_method_pick = gr.Dropdown(value="map-reduce", label="Summarization Method", show_label=True, choices=method_choices + ["auto"])
 
             summarize_btn = gr.Button(value="Summarize")
 
@@ -329,4 +849,4 @@ if __name__ == "__main__":
 
             summarize_btn.click(compare_models, [document_content, octoai_model_pick, summarization_method_pick], [octoai_summary, octoai_stats])
 
-        demo.launch()
+        demo.queue().launch()
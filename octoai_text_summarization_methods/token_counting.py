@@ -0,0 +1,108 @@
+import math
+import threading
+
+
+class TokenCountEstimator:
+    """Brackets the number of tokens of a text from its length, so obvious context window checks skip the tokenizer.
+
+    Two kinds of bounds are combined. The hard ones always hold: every token covers at least one byte of the
+    UTF-8 text (plus the leading space some tokenizers add), and at most as many characters as the longest
+    vocabulary entry. The calibrated ones come from the characters per token ratios seen on texts that were fully
+    tokenized, widened by `margin`, and are only used once `min_observations` texts were seen. They are a guess,
+    not a guarantee, so they never let a text skip the tokenizer as short enough.
+    The counts are the content tokens, without the special tokens, like `count_tokens` and `TokenizedDocument`.
+    """
+
+    def __init__(self, max_token_chars, margin=0.15, min_observations=3, min_observation_chars=2000):
+        self.max_token_chars = max(1, max_token_chars)
+        self.margin = margin
+        self.min_observations = min_observations
+        self.min_observation_chars = min_observation_chars
+        self.lock = threading.Lock()
+        self.num_observations = 0
+        self.min_ratio = math.inf
+        self.max_ratio = 0.0
+        self.num_skipped = 0
+        self.num_tokenized = 0
+
+    @classmethod
+    def for_tokenizer(cls, tokenizer, **kwargs):
+        if hasattr(tokenizer, "token_byte_values"):
+            # NOTE: tiktoken encodings, every token is a byte string
+            return cls(max(len(token) for token in tokenizer.token_byte_values()), **kwargs)
+        return cls(max(len(token) for token in tokenizer.get_vocab()), **kwargs)
+
+    def observe(self, num_chars, num_tokens):
+        # NOTE: short texts have noisy ratios, and would make the calibrated bounds useless
+        if num_chars < self.min_observation_chars or num_tokens == 0:
+            return
+        ratio = num_chars / num_tokens
+        with self.lock:
+            self.num_observations += 1
+            self.min_ratio = min(self.min_ratio, ratio)
+            self.max_ratio = max(self.max_ratio, ratio)
+
+    def hard_bounds(self, text):
+        """The (lowest, highest) possible number of tokens of `text`, whatever the text."""
+        return len(text) // self.max_token_chars, len(text.encode("utf-8")) + 2
+
+    def bounds(self, text):
+        """The (lowest, highest) likely number of tokens of `text`, tightened by the calibration."""
+        low, high = self.hard_bounds(text)
+        with self.lock:
+            if self.num_observations >= self.min_observations:
+                low = max(low, math.floor(len(text) / (self.max_ratio * (1 + self.margin))))
+                high = min(high, math.ceil(len(text) / (self.min_ratio * (1 - self.margin))))
+        return low, high
+
+    def estimate(self, text):
+        low, high = self.bounds(text)
+        with self.lock:
+            if self.num_observations >= self.min_observations:
+                return min(high, max(low, round(2 * len(text) / (self.min_ratio + self.max_ratio))))
+        return (low + high) // 2
+
+    def is_longer_than(self, text, max_tokens):
+        """True or False when the bounds settle it, None when the text has to be tokenized.
+
+        False only comes from the hard bound, a text wrongly taken as short enough would overflow the context window.
+        True may come from the calibrated bound, at worst a text that would have fit is split.
+        """
+        _, hard_high = self.hard_bounds(text)
+        low, _ = self.bounds(text)
+        answer = False if hard_high <= max_tokens else True if low > max_tokens else None
+        with self.lock:
+            if answer is None:
+                self.num_tokenized += 1
+            else:
+                self.num_skipped += 1
+        return answer
+
+
+def count_tokens(tokenizer, text):
+    """Number of content tokens of the text, the special tokens aren't counted, as in `TokenizedDocument`."""
+    if hasattr(tokenizer, "encode_ordinary"):
+        # NOTE: tiktoken encodings
+        return len(tokenizer.encode_ordinary(text))
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def count_tokens_batch(tokenizer, texts):
+    """Same as `count_tokens` for many texts, encoded in parallel by the tokenizer."""
+    if not texts:
+        return []
+    if hasattr(tokenizer, "encode_ordinary_batch"):
+        return [len(token_ids) for token_ids in tokenizer.encode_ordinary_batch(texts)]
+    return [len(token_ids) for token_ids in tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+
+_ESTIMATORS = {}
+_LOCK = threading.Lock()
+
+
+def get_token_estimator(tokenizer_name, tokenizer):
+    # NOTE: one estimator per tokenizer, so all the models sharing a tokenizer share its calibration
+    with _LOCK:
+        if tokenizer_name not in _ESTIMATORS:
+            _ESTIMATORS[tokenizer_name] = TokenCountEstimator.for_tokenizer(tokenizer)
+        return _ESTIMATORS[tokenizer_name]
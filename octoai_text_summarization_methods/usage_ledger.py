@@ -0,0 +1,78 @@
+import json
+import threading
+import time
+
+
+class UsageLedger:
+    """Thread-safe record of every chat completion call made to summarize one document.
+
+    Each call is recorded with its stage (e.g. "map", "reduce-1", "refine-3", "rerank"), model, prompt and
+    completion tokens, latency and whether it was served from the completion cache. The `num_*_tokens` totals
+    are the billed ones, the tokens of the cache hits are reported as `cached_*_tokens`. The calls are never
+    merged into the completions themselves, so the per-stage breakdown stays available after the run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.calls = []
+
+    def record(self, stage, model_name, completion, start_time, end_time=None, cache_hit=False):
+        end_time = end_time if end_time is not None else time.perf_counter()
+        call = {"stage": stage,
+                "model_name": model_name,
+                "prompt_tokens": completion.usage.prompt_tokens,
+                "completion_tokens": completion.usage.completion_tokens,
+                "start_seconds": start_time - self.start_time,
+                "latency_seconds": end_time - start_time,
+                "cache_hit": cache_hit}
+        with self.lock:
+            self.calls.append(call)
+
+    def totals(self):
+        """The billed tokens only count the calls that reached the endpoint, the cache hits are counted apart."""
+        with self.lock:
+            calls = list(self.calls)
+        return {"num_calls": len(calls),
+                "num_input_tokens": sum(call["prompt_tokens"] for call in calls if not call["cache_hit"]),
+                "num_output_tokens": sum(call["completion_tokens"] for call in calls if not call["cache_hit"]),
+                "cache_hits": sum(call["cache_hit"] for call in calls),
+                "cached_input_tokens": sum(call["prompt_tokens"] for call in calls if call["cache_hit"]),
+                "cached_output_tokens": sum(call["completion_tokens"] for call in calls if call["cache_hit"])}
+
+    def by_stage(self):
+        """One entry per stage, in the order the stages started.
+
+        `latency_seconds` adds up the latencies of the calls, `wall_clock_seconds` is the time from the first
+        call of the stage starting to the last one finishing, so their ratio is the concurrency of the stage.
+        """
+        with self.lock:
+            calls = sorted(self.calls, key=lambda call: call["start_seconds"])
+
+        stages = {}
+        for call in calls:
+            stage = stages.setdefault(call["stage"], {"stage": call["stage"], "model_name": call["model_name"], "num_calls": 0,
+                                                      "num_input_tokens": 0, "num_output_tokens": 0, "cache_hits": 0,
+                                                      "cached_input_tokens": 0, "cached_output_tokens": 0,
+                                                      "latency_seconds": 0.0, "start_seconds": call["start_seconds"], "end_seconds": 0.0})
+            stage["num_calls"] += 1
+            # NOTE: like in `totals`, the tokens of the cache hits weren't billed
+            prefix = "cached_" if call["cache_hit"] else "num_"
+            stage[f"{prefix}input_tokens"] += call["prompt_tokens"]
+            stage[f"{prefix}output_tokens"] += call["completion_tokens"]
+            stage["cache_hits"] += call["cache_hit"]
+            stage["latency_seconds"] += call["latency_seconds"]
+            stage["end_seconds"] = max(stage["end_seconds"], call["start_seconds"] + call["latency_seconds"])
+
+        for stage in stages.values():
+            stage["wall_clock_seconds"] = stage.pop("end_seconds") - stage["start_seconds"]
+        return list(stages.values())
+
+    def to_dict(self):
+        with self.lock:
+            calls = list(self.calls)
+        return {"totals": self.totals(), "stages": self.by_stage(), "calls": calls}
+
+    def to_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
@@ -0,0 +1,92 @@
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+from types import SimpleNamespace
+
+
+def completion_to_json(completion):
+    if hasattr(completion, "model_dump"):
+        return json.dumps(completion.model_dump())
+    if hasattr(completion, "dict"):
+        return json.dumps(completion.dict())
+    return json.dumps(completion, default=vars)
+
+
+def completion_from_json(payload):
+    # NOTE: the summarizers only use attribute access on the completions, so namespaces are enough
+    return json.loads(payload, object_hook=lambda obj: SimpleNamespace(**obj))
+
+
+class CompletionCache:
+    """Chat completions cache with an in-memory LRU tier in front of an on-disk SQLite tier.
+
+    Entries are keyed by a SHA-256 of the model, the sampling params and the messages.
+    Every hit is a fresh object, so callers can mutate it safely.
+    """
+
+    def __init__(self, path=".completion_cache.sqlite", max_memory_entries=1024, enabled=True):
+        self.enabled = enabled
+        self.max_memory_entries = max_memory_entries
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.db = None
+        if enabled and path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, completion TEXT NOT NULL)")
+            self.db.commit()
+
+    @staticmethod
+    def key(model, params, messages):
+        # NOTE: streaming doesn't change the completion itself, so it's not part of the key
+        params = {name: value for name, value in params.items() if name != "stream"}
+        payload = json.dumps({"model": model, "params": params, "messages": messages}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, model, params, messages):
+        if not self.enabled:
+            return None
+
+        key = self.key(model, params, messages)
+        with self.lock:
+            payload = self.memory.get(key)
+            if payload is not None:
+                self.memory.move_to_end(key)
+            elif self.db is not None:
+                row = self.db.execute("SELECT completion FROM completions WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    payload = row[0]
+                    self._remember(key, payload)
+
+            if payload is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        return completion_from_json(payload)
+
+    def put(self, model, params, messages, completion):
+        if not self.enabled:
+            return
+
+        key = self.key(model, params, messages)
+        payload = completion_to_json(completion)
+        with self.lock:
+            self._remember(key, payload)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO completions (key, completion) VALUES (?, ?)", (key, payload))
+                self.db.commit()
+
+    def _remember(self, key, payload):
+        self.memory[key] = payload
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def counters(self):
+        with self.lock:
+            return {"cache_hits": self.hits, "cache_misses": self.misses}
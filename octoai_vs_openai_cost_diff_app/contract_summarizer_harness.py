@@ -4,17 +4,33 @@ import os
 import glob
 import time
 import sys
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 from dotenv import load_dotenv
 from octoai.client import Client
 from openai import OpenAI
 import tiktoken
 
 from langchain_community.document_loaders import UnstructuredPDFLoader
-from transformers import AutoTokenizer
+
+from completion_cache import CompletionCache
+from dedup import ParagraphDeduplicator
+from pdf_cache import PDFCache
+from rate_limiter import ProviderRateLimiter
+from results_writer import ResultsWriter
+from token_counting import count_tokens, count_tokens_batch, get_token_estimator
+from tokenized_document import TokenizedDocument
+from tokenizer_registry import get_tokenizer
+from usage_ledger import UsageLedger
 
 
 load_dotenv()
 
+# NOTE: point it to a local stand-in server, e.g. local_openai_server/, for offline load tests
+OCTOAI_BASE_URL = os.environ.get("OCTOAI_BASE_URL")
+
 SYSTEM_PROMPT = "You are a helpful financial and accounting specialist assistant. You will summarize any given document into 10 bullet points. Please note that your work will be reviewed, if done right, you will get a 100 USD performance bonus per summary."
 
 # NOTE: The prices are up to date as of end of February 2024
@@ -41,50 +57,166 @@ class AbstactModel:
                 "max_tokens": NotImplemented,
             }
         self.tokenizer = NotImplemented
-    
+        self.tokenizer_name = NotImplemented
+        self.token_estimator = NotImplemented
+        self.max_concurrency = NotImplemented
+        self.completion_cache = None
+        # NOTE: an executor shared by several documents, see `summarize_batch`
+        self.executor = None
+        self.provider = NotImplemented
+        # NOTE: a `ProviderRateLimiter` shared by all the models of the same provider, see `summarize_matrix`
+        self.rate_limiter = None
+        self.max_chunk_size = NotImplemented
+
+    def tokenize(self, text):
+        document = TokenizedDocument.from_text(text, self.tokenizer)
+        self.token_estimator.observe(len(text), len(document))
+        return document
+
+    def as_document(self, text):
+        return text if isinstance(text, TokenizedDocument) else self.tokenize(text)
+
     def chunk_text_iter(self, text):
-        raise NotImplementedError()
+        # NOTE: the chunks are slices of the original text cut at paragraph or sentence breaks, nothing is decoded
+        yield from self.as_document(text).iter_chunks(self.max_chunk_size)
 
     def get_num_tokens(self, text):
-        return len(self.tokenizer.encode(text))
-    
-    def is_longer_than_ctx_window(self, text):
-        return self.get_num_tokens(text) > self.ctx_window_size - self.get_num_tokens(SYSTEM_PROMPT) - self.params["max_tokens"] - 100
+        if isinstance(text, TokenizedDocument):
+            return len(text)
+        num_tokens = count_tokens(self.tokenizer, text)
+        self.token_estimator.observe(len(text), num_tokens)
+        return num_tokens
+
+    def get_num_tokens_batch(self, texts):
+        """Same as `get_num_tokens` for many texts, the strings are encoded in a single parallel batch."""
+        texts = list(texts)
+        strings = [text for text in texts if not isinstance(text, TokenizedDocument)]
+        counts = iter(count_tokens_batch(self.tokenizer, strings))
+        num_tokens = [len(text) if isinstance(text, TokenizedDocument) else next(counts) for text in texts]
+        for text, count in zip(texts, num_tokens):
+            if not isinstance(text, TokenizedDocument):
+                self.token_estimator.observe(len(text), count)
+        return num_tokens
+
+    def estimate_num_tokens(self, text):
+        return len(text) if isinstance(text, TokenizedDocument) else self.token_estimator.estimate(text)
 
-    def get_completions(self, user_prompt):
+    def is_longer_than_ctx_window(self, text):
+        if isinstance(text, TokenizedDocument):
+            return len(text) > self.max_chunk_size
+        # NOTE: only the texts whose length is close to the limit are tokenized
+        is_longer = self.token_estimator.is_longer_than(text, self.max_chunk_size)
+        return is_longer if is_longer is not None else self.get_num_tokens(text) > self.max_chunk_size
+
+    def map_completions(self, chunks, on_progress=None, ledger=None, stage="map"):
+        chunks = list(chunks)
+        num_done = [0]
+        lock = threading.Lock()
+
+        def summarize(chunk):
+            # NOTE: the chunks always fit in the context window
+            completion = self.create_completion(str(chunk), ledger=ledger, stage=stage)
+            if on_progress is not None:
+                with lock:
+                    num_done[0] += 1
+                    on_progress("map", num_done[0], len(chunks))
+            return completion
+
+        if self.executor is not None:
+            return list(self.executor.map(summarize, chunks))
+        if self.max_concurrency <= 1 or len(chunks) <= 1:
+            return [summarize(chunk) for chunk in chunks]
+
+        # NOTE: executor.map returns results in the order of the chunks, so the reduce step sees the same order
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(chunks))) as executor:
+            return list(executor.map(summarize, chunks))
+
+    def get_completions(self, user_prompt, on_progress=None, on_token=None, ledger=None, level=0):
+        """Summarizes `user_prompt`, every call made is recorded in `ledger` when given.
+
+        The chunk summaries of the document are recorded as stage "map", and the calls summarizing the
+        summaries at `level` k as "reduce-k", or "reduce-k-map" when they don't fit in a single call.
+        The returned completion is the final call only, its usage doesn't include the intermediate calls.
+        """
         if self.is_longer_than_ctx_window(user_prompt):
-            completions = []
-            for chunk in self.chunk_text_iter(user_prompt):
-                completions.append(self.get_completions(chunk))
-
-            final_completion = self.get_completions("\n".join(comp.choices[0].message.content for comp in completions))
-            final_completion.usage.prompt_tokens += sum(comp.usage.prompt_tokens for comp in completions)
-            final_completion.usage.completion_tokens += sum(comp.usage.completion_tokens for comp in completions)
-            final_completion.usage.total_tokens += sum(comp.usage.total_tokens for comp in completions)
-            return final_completion
+            user_prompt = self.as_document(user_prompt)
+            completions = self.map_completions(self.chunk_text_iter(user_prompt), on_progress=on_progress,
+                                               ledger=ledger, stage="map" if level == 0 else f"reduce-{level}-map")
+
+            # NOTE: only the last call, the one producing the final summary, is streamed
+            return self.get_completions("\n".join(comp.choices[0].message.content for comp in completions),
+                                        on_progress=on_progress, on_token=on_token, ledger=ledger, level=level + 1)
         else:
-            completions = self.client.chat.completions.create(
+            return self.create_completion(str(user_prompt), on_token=on_token, ledger=ledger,
+                                          stage="summarize" if level == 0 else f"reduce-{level}")
+
+    def create_completion(self, user_prompt, on_token=None, ledger=None, stage="summarize"):
+        """Sends a single chat completion request, when `on_token` is given the response is streamed into it.
+
+        When `ledger` is given, the call is recorded in it under `stage`.
+        """
+        messages = [
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT,
+            },
+            {
+                "role": "user",
+                "content": user_prompt
+            }
+        ]
+
+        start_time = time.perf_counter()
+        if self.completion_cache is not None:
+            completion = self.completion_cache.get(self.model_name, self.params, messages)
+            if completion is not None:
+                if on_token is not None:
+                    on_token(completion.choices[0].message.content)
+                if ledger is not None:
+                    ledger.record(stage, self.slug_model_name, completion, start_time, cache_hit=True)
+                return completion
+
+        if self.rate_limiter is not None:
+            # NOTE: like the providers, count the estimated prompt and the max number of output tokens against the limit
+            self.rate_limiter.acquire(self.estimate_num_tokens(SYSTEM_PROMPT + user_prompt) + self.params["max_tokens"])
+            # NOTE: the time spent waiting for the rate limits is reported by the rate limiter, not as call latency
+            start_time = time.perf_counter()
+
+        if on_token is None:
+            completion = self.client.chat.completions.create(
                 model=self.model_name,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": SYSTEM_PROMPT,
-                    },
-                    {
-                        "role": "user",
-                        "content": user_prompt
-                    }
-                ],
+                messages=messages,
                 **self.params
             )
+        else:
+            stream = self.client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                **{**self.params, "stream": True}
+            )
+            completion = collect_stream(stream, on_token)
+            if completion.usage is None:
+                # NOTE: not every endpoint sends the usage with the last chunk, so count the tokens locally
+                prompt_tokens, completion_tokens = self.get_num_tokens_batch([user_prompt, completion.choices[0].message.content])
+                prompt_tokens += self.get_num_tokens(SYSTEM_PROMPT)
+                completion.usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens)
 
-            return completions
+        if ledger is not None:
+            ledger.record(stage, self.slug_model_name, completion, start_time)
+        if self.completion_cache is not None:
+            self.completion_cache.put(self.model_name, self.params, messages, completion)
+        return completion
 
 
 class OpenAIModel(AbstactModel):
-    def __init__(self, model_name) -> None:
+    def __init__(self, model_name, max_concurrency=8, completion_cache=None, rate_limiter=None) -> None:
         self.client = OpenAI()
         self.slug_model_name = model_name
+        self.provider = "openai"
+        self.max_concurrency = max_concurrency
+        self.executor = None
+        self.completion_cache = completion_cache
+        self.rate_limiter = rate_limiter
         self.ctx_window_size = 16385
         self.params = {
                 "temperature": 0.75,
@@ -93,7 +225,9 @@ class OpenAIModel(AbstactModel):
                 "stream": False,
                 "max_tokens": 512,
             }
-        self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        self.tokenizer_name = "cl100k_base"
+        self.tokenizer = tiktoken.get_encoding(self.tokenizer_name)
+        self.token_estimator = get_token_estimator(self.tokenizer_name, self.tokenizer)
         if self.slug_model_name == "gpt3.5":
             self.model_name = "gpt-3.5-turbo-1106"
             self.ctx_window_size = 16385
@@ -104,22 +238,21 @@ class OpenAIModel(AbstactModel):
             self.model_name = "gpt-4-turbo"
             self.ctx_window_size = 128000
 
-    def chunk_text_iter(self, text):
-        max_size = self.ctx_window_size - self.get_num_tokens(SYSTEM_PROMPT) - self.params["max_tokens"] - 100
-        current_size = self.get_num_tokens(text)
-
-        n_chunks = current_size // max_size + 1
-
-        text_tokens = self.tokenizer.encode(text)
-
-        for idx in range(n_chunks):
-            yield self.tokenizer.decode(text_tokens[idx * max_size: (idx + 1) * max_size])
+        self.max_chunk_size = self.ctx_window_size - self.get_num_tokens(SYSTEM_PROMPT) - self.params["max_tokens"] - 100
 
 
 class OctoAIModel(AbstactModel):
-    def __init__(self, model_name) -> None:
+    def __init__(self, model_name, max_concurrency=8, completion_cache=None, rate_limiter=None) -> None:
         self.client = Client()
+        if OCTOAI_BASE_URL:
+            # NOTE: the octoai SDK has no base_url option, but the chat endpoint is a plain attribute
+            self.client.chat.completions.endpoint = f"{OCTOAI_BASE_URL.rstrip('/')}/chat/completions"
         self.slug_model_name = model_name
+        self.provider = "octoai"
+        self.max_concurrency = max_concurrency
+        self.executor = None
+        self.completion_cache = completion_cache
+        self.rate_limiter = rate_limiter
         self.params = {
                 "temperature": 0.75,
                 "presence_penalty": 1,
@@ -130,31 +263,46 @@ class OctoAIModel(AbstactModel):
         
         if self.slug_model_name.startswith("mixtral"):
             self.model_name = "mixtral-8x7b-instruct-fp16"
-            self.tokenizer = AutoTokenizer.from_pretrained("mistralai/Mixtral-8x7B-Instruct-v0.1")
+            self.tokenizer_name = "mistralai/Mixtral-8x7B-Instruct-v0.1"
             self.ctx_window_size = 32768
         elif self.slug_model_name.startswith("mistral"):
             self.model_name = "mistral-7b-instruct-fp16"
-            self.tokenizer = AutoTokenizer.from_pretrained("mistralai/Mistral-7B-Instruct-v0.2")
+            self.tokenizer_name = "mistralai/Mistral-7B-Instruct-v0.2"
             self.ctx_window_size = 32768
         elif self.slug_model_name.startswith("llama2"):
             self.model_name = "llama-2-70b-chat-fp16"
-            self.tokenizer = AutoTokenizer.from_pretrained("NousResearch/Llama-2-70b-chat-hf")
+            self.tokenizer_name = "NousResearch/Llama-2-70b-chat-hf"
             self.ctx_window_size = 4096
         elif self.slug_model_name.startswith("nous-hermes"):
             self.model_name = "nous-hermes-2-mixtral-8x7b-dpo-fp16"
-            self.tokenizer = AutoTokenizer.from_pretrained("mistralai/Mixtral-8x7B-Instruct-v0.1")
+            self.tokenizer_name = "mistralai/Mixtral-8x7B-Instruct-v0.1"
             self.ctx_window_size = 32768
 
-    def chunk_text_iter(self, text):
-        max_size = self.ctx_window_size - self.get_num_tokens(SYSTEM_PROMPT) - self.params["max_tokens"] - 100
-        current_size = self.get_num_tokens(text)
+        # NOTE: the tokenizers are loaded once per process and shared by all the models
+        self.tokenizer = get_tokenizer(self.tokenizer_name)
+        self.token_estimator = get_token_estimator(self.tokenizer_name, self.tokenizer)
+        self.max_chunk_size = self.ctx_window_size - self.get_num_tokens(SYSTEM_PROMPT) - self.params["max_tokens"] - 100
 
-        n_chunks = current_size // max_size + 1
 
-        text_tokens = self.tokenizer.encode(text)
+def collect_stream(stream, on_token):
+    # NOTE: rebuilds a completion-like object from the streamed chunks, the usage is only known if the endpoint sends it
+    content, usage, finish_reason = [], None, None
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            usage = SimpleNamespace(prompt_tokens=chunk.usage.prompt_tokens,
+                                    completion_tokens=chunk.usage.completion_tokens,
+                                    total_tokens=chunk.usage.total_tokens)
+        if not chunk.choices:
+            continue
 
-        for idx in range(n_chunks):
-            yield self.tokenizer.decode(text_tokens[idx * max_size: (idx + 1) * max_size], skip_special_tokens=True)
+        delta = chunk.choices[0].delta.content
+        if delta:
+            content.append(delta)
+            on_token(delta)
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+
+    message = SimpleNamespace(role="assistant", content="".join(content))
+    return SimpleNamespace(choices=[SimpleNamespace(index=0, message=message, finish_reason=finish_reason)], usage=usage)
 
 
 def load_parse_pdf(filename):
@@ -163,21 +311,250 @@ def load_parse_pdf(filename):
     return data[0].page_content
 
 
-def benchmark_one(document, doc_name, model):
-    doc_input_tokens = model.get_num_tokens(document)
-    print(f"Loaded {doc_name} of size {doc_input_tokens} tokens")
+def load_document(filename, model, pdf_cache=None, deduplicator=None):
+    if deduplicator is not None:
+        # NOTE: the deduplicated text depends on the documents seen before it, so only the parsed text is cached
+        text = pdf_cache.load_text(filename, load_parse_pdf) if pdf_cache is not None else load_parse_pdf(filename)
+        text = deduplicator.dedup(filename, text)
+        report = deduplicator.reports[filename]
+        print(f"Removed {report['num_removed_paragraphs']} repeated paragraphs ({report['removed_bytes']} bytes) from {filename}")
+        return model.tokenize(text)
+    if pdf_cache is None:
+        return model.tokenize(load_parse_pdf(filename))
+    return pdf_cache.load_document(filename, load_parse_pdf, model.tokenizer_name, model.tokenize,
+                                   tokenizer_digest=getattr(model.tokenizer, "digest", None))
+
+
+def benchmark_one(document, doc_name, model, stream=False, on_progress=None, on_token=None, ledger=None):
+    # NOTE: the document is tokenized once here, and the token ids are reused by all the summarization steps
+    document = model.as_document(document)
+    print(f"Loaded {doc_name} of size {len(document)} tokens")
+
+    cache_counters = model.completion_cache.counters() if model.completion_cache is not None else None
+    # NOTE: pass a ledger to keep the per-call records, e.g. to export them with `UsageLedger.to_json`
+    ledger = ledger if ledger is not None else UsageLedger()
+    first_token_time = []
+
+    def stream_token(token):
+        if not first_token_time:
+            first_token_time.append(time.perf_counter())
+        if on_token is not None:
+            on_token(token)
 
     start_time = time.perf_counter()
-    completions = model.get_completions(document)
-    time_spent_seconds = time.perf_counter() - start_time
+    completions = model.get_completions(document, on_progress=on_progress,
+                                        on_token=stream_token if stream or on_token is not None else None, ledger=ledger)
+    end_time = time.perf_counter()
+    time_spent_seconds = end_time - start_time
     response = completions.choices[0].message.content
 
-    return {"num_input_tokens": completions.usage.prompt_tokens,
-                    "time_to_summarize_seconds": time_spent_seconds,
-                    "num_output_tokens": completions.usage.completion_tokens,
-                    "input_text_len": len(document),
-                    "model_name": model.slug_model_name,
-                    "ctx_window_size": model.ctx_window_size}, response
+    # NOTE: without streaming the first token arrives together with the whole summary
+    time_to_first_token_seconds = (first_token_time[0] if first_token_time else end_time) - start_time
+    final_call_seconds = end_time - first_token_time[0] if first_token_time else 0.0
+    output_tokens_per_second = (model.get_num_tokens(response) / final_call_seconds) if final_call_seconds > 0 else None
+
+    totals = ledger.totals()
+    stats = {"num_input_tokens": totals["num_input_tokens"],
+             "time_to_summarize_seconds": time_spent_seconds,
+             "time_to_first_token_seconds": time_to_first_token_seconds,
+             "output_tokens_per_second": output_tokens_per_second,
+             "num_output_tokens": totals["num_output_tokens"],
+             "num_calls": totals["num_calls"],
+             "cached_input_tokens": totals["cached_input_tokens"],
+             "cached_output_tokens": totals["cached_output_tokens"],
+             "input_text_len": len(document.text),
+             "model_name": model.slug_model_name,
+             "ctx_window_size": model.ctx_window_size,
+             "usage_by_stage": ledger.by_stage()}
+
+    if cache_counters is not None:
+        # NOTE: in --batch mode the counters also include the calls of the documents summarized at the same time
+        for name, value in model.completion_cache.counters().items():
+            stats[name] = value - cache_counters[name]
+
+    return stats, response
+
+
+def ledger_path(ledger_dir, doc_name, model):
+    return os.path.join(ledger_dir, f"{os.path.splitext(os.path.basename(doc_name))[0]}.{model.slug_model_name}.usage.json")
+
+
+def stream_benchmarks(doc_name, models, pdf_cache=None):
+    """Loads and summarizes `doc_name` with all the `models` at the same time, one background thread per model.
+
+    Yields `(idx, event, payload)` as they happen, where `idx` is the index of the model: `("progress", message)`
+    while its chunks are summarized, `("token", text)` for every streamed token of its final summary, then
+    either `("done", (stats, summary))` or `("error", exception)`.
+    """
+    events = queue.Queue()
+
+    def run(idx, model):
+        def on_progress(stage, done, total):
+            events.put((idx, "progress", f"{stage}: {done}/{total} chunks summarized"))
+
+        try:
+            start_time = time.perf_counter()
+            events.put((idx, "progress", "Parsing the document..."))
+            document = load_document(doc_name, model, pdf_cache)
+            stats, summary = benchmark_one(document, doc_name, model, stream=True, on_progress=on_progress,
+                                           on_token=lambda token: events.put((idx, "token", token)))
+            # NOTE: unlike `time_to_summarize_seconds`, it includes parsing and tokenizing the document
+            stats["wall_clock_seconds"] = time.perf_counter() - start_time
+            events.put((idx, "done", (stats, summary)))
+        except Exception as err:
+            events.put((idx, "error", err))
+
+    for idx, model in enumerate(models):
+        threading.Thread(target=run, args=(idx, model), daemon=True).start()
+
+    num_running = len(models)
+    while num_running > 0:
+        idx, event, payload = events.get()
+        yield idx, event, payload
+        if event in ("done", "error"):
+            num_running -= 1
+
+
+class BatchProgress:
+    """Thread-safe per-document status of a batch run."""
+
+    def __init__(self, doc_names):
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.documents = {doc_name: {"status": "queued", "num_tokens": None, "seconds": None} for doc_name in doc_names}
+
+    def update(self, doc_name, status, **kwargs):
+        with self.lock:
+            self.documents[doc_name].update(status=status, **kwargs)
+            num_done = sum(doc["status"] in ("done", "failed") for doc in self.documents.values())
+            print(f"[{num_done}/{len(self.documents)} done, {time.perf_counter() - self.start_time:0.1f}s] {doc_name}: {status}")
+
+
+def summarize_batch(doc_names, model, pdf_cache=None, max_documents_in_flight=4, ledger_dir=None, deduplicator=None):
+    """Summarizes many documents through a single work queue shared by all of them.
+
+    A background thread parses the documents one after another, while every parsed document is
+    summarized by a coordinator thread. The coordinators submit their map and reduce calls to the
+    same executor, bounded by `model.max_concurrency`, so parsing the next document overlaps with
+    the LLM calls of the previous ones. Yields `(doc_name, stats, summary)` as documents complete,
+    with `stats` set to the raised exception if a document failed. The usage ledger of every
+    document is written to `ledger_dir` when given. With a `deduplicator`, the paragraphs repeated
+    from the documents parsed before are removed, the documents are parsed in the order of `doc_names`.
+    """
+    progress = BatchProgress(doc_names)
+    results = queue.Queue()
+
+    def summarize(doc_name, document):
+        progress.update(doc_name, "summarizing", num_tokens=len(document))
+        try:
+            ledger = UsageLedger()
+            stats, summary = benchmark_one(document, doc_name, model, ledger=ledger)
+            if ledger_dir is not None:
+                ledger.to_json(ledger_path(ledger_dir, doc_name, model))
+            if deduplicator is not None:
+                stats.update(deduplicator.stats(doc_name, model))
+            progress.update(doc_name, "done", seconds=stats["time_to_summarize_seconds"])
+            results.put((doc_name, stats, summary))
+        except Exception as err:
+            progress.update(doc_name, "failed")
+            results.put((doc_name, err, None))
+
+    with ThreadPoolExecutor(max_workers=model.max_concurrency) as call_executor, \
+         ThreadPoolExecutor(max_workers=max_documents_in_flight) as document_executor, \
+         ThreadPoolExecutor(max_workers=1) as parse_executor:
+        # NOTE: the workers of the shared executor only ever run single completion calls, chunks always fit
+        #  in the context window, so they never wait on other tasks of the same executor
+        model.executor = call_executor
+
+        def parse(doc_name):
+            progress.update(doc_name, "parsing")
+            try:
+                document = load_document(doc_name, model, pdf_cache, deduplicator)
+            except Exception as err:
+                progress.update(doc_name, "failed")
+                results.put((doc_name, err, None))
+                return
+            document_executor.submit(summarize, doc_name, document)
+
+        for doc_name in doc_names:
+            parse_executor.submit(parse, doc_name)
+
+        try:
+            for _ in doc_names:
+                yield results.get()
+        finally:
+            model.executor = None
+
+
+def summarize_matrix(doc_names, models, pdf_cache=None, max_pairs_in_flight=16, ledger_dir=None, deduplicator=None):
+    """Summarizes every document with every model, all the (model, document) pairs at the same time.
+
+    Every document is parsed once, in a background thread. Each model gets its own executor for its
+    completion calls, bounded by its `max_concurrency`, and the calls of a provider are throttled by
+    the `rate_limiter` shared by its models. Yields `(doc_name, model, stats, summary)` as pairs complete,
+    with `stats` set to the raised exception if a pair failed. The usage ledger of every pair is
+    written to `ledger_dir` when given. With a `deduplicator`, every document is deduplicated once,
+    against the documents parsed before it, and all the models summarize the same deduplicated text.
+    """
+    progress = BatchProgress([f"{model.slug_model_name}:{doc_name}" for model in models for doc_name in doc_names])
+    results = queue.Queue()
+
+    def parse(doc_name):
+        text = pdf_cache.load_text(doc_name, load_parse_pdf) if pdf_cache is not None else load_parse_pdf(doc_name)
+        return deduplicator.dedup(doc_name, text) if deduplicator is not None else text
+
+    def summarize(doc_name, model, text_future):
+        label = f"{model.slug_model_name}:{doc_name}"
+        try:
+            start_time = time.perf_counter()
+            progress.update(label, "parsing")
+            text = text_future.result()
+            # NOTE: with the PDF cache, the token ids of the same tokenizer are also shared across runs
+            use_pdf_cache = pdf_cache is not None and deduplicator is None
+            document = load_document(doc_name, model, pdf_cache) if use_pdf_cache else model.tokenize(text)
+            progress.update(label, "summarizing", num_tokens=len(document))
+            ledger = UsageLedger()
+            stats, summary = benchmark_one(document, doc_name, model, ledger=ledger)
+            if ledger_dir is not None:
+                ledger.to_json(ledger_path(ledger_dir, doc_name, model))
+            stats["wall_clock_seconds"] = time.perf_counter() - start_time
+            if deduplicator is not None:
+                stats.update(deduplicator.stats(doc_name, model))
+            progress.update(label, "done", seconds=stats["time_to_summarize_seconds"])
+            results.put((doc_name, model, stats, summary))
+        except Exception as err:
+            progress.update(label, "failed")
+            results.put((doc_name, model, err, None))
+
+    call_executors = [ThreadPoolExecutor(max_workers=model.max_concurrency) for model in models]
+    try:
+        with ThreadPoolExecutor(max_workers=1) as parse_executor, \
+             ThreadPoolExecutor(max_workers=max_pairs_in_flight) as pair_executor:
+            # NOTE: as in `summarize_batch`, the call executors only run single completion calls
+            for model, call_executor in zip(models, call_executors):
+                model.executor = call_executor
+
+            text_futures = {doc_name: parse_executor.submit(parse, doc_name) for doc_name in doc_names}
+            # NOTE: document-major order, so the first documents are done by every model before the next ones start
+            for doc_name in doc_names:
+                for model in models:
+                    pair_executor.submit(summarize, doc_name, model, text_futures[doc_name])
+
+            for _ in range(len(doc_names) * len(models)):
+                yield results.get()
+    finally:
+        for model, call_executor in zip(models, call_executors):
+            model.executor = None
+            call_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def as_result_row(doc_name, model, stats, summary):
+    row = {"doc_name": doc_name, "model_name": model.slug_model_name, "provider": model.provider}
+    if isinstance(stats, Exception):
+        return dict(row, status="failed", error=repr(stats))
+    return dict(row, status="done", summary=summary, cost_usd=total_cost(stats),
+                **{name: value for name, value in stats.items() if name not in ("model_name", "input_text_len", "ctx_window_size")})
+
 
 def total_cost(stats_dict):
     model_name_mapper = {
@@ -197,25 +574,73 @@ def total_cost(stats_dict):
            + stats_dict['num_output_tokens'] * COSTS[ model_name_mapper[stats_dict['model_name']] ]['output'] / 1000)
 
 
+def as_html_stages(stats_dict):
+    # NOTE: one row per stage, the wall clock time of a stage is shorter than its summed latency when its calls run concurrently
+    rows = "".join(f"""
+      <tr>
+        <td>{stage['stage']}</td>
+        <td>{stage['num_calls']}</td>
+        <td>{stage['num_input_tokens']}</td>
+        <td>{stage['num_output_tokens']}</td>
+        <td>{stage['wall_clock_seconds']:0.2f} s</td>
+        <td>{stage['cache_hits']} ({stage['cached_input_tokens'] + stage['cached_output_tokens']} tokens)</td>
+        <td>{total_cost(stage):0.5f} USD</td>
+      </tr>""" for stage in stats_dict.get("usage_by_stage", []))
+    return f"""
+    <table>
+      <tr>
+        <th>Stage</th>
+        <th># calls</th>
+        <th># input tokens</th>
+        <th># output tokens</th>
+        <th>Time</th>
+        <th>Cache hits</th>
+        <th>Cost</th>
+      </tr>{rows}
+    </table>
+    """
+
+
 def as_html_spec(stats_dict):
-    # make html table
+    # NOTE: the tokens and the cost are the billed ones, the cache hits are free
     return f"""
     <table>
       <tr>
         <th># input tokens</th>
         <th># output tokens</th>
+        <th>Time to first token</th>
+        <th>Total time</th>
+        <th># cached tokens</th>
         <th>Total cost</th>
       </tr>
       <tr>
         <td>{stats_dict['num_input_tokens']}</td>
         <td>{stats_dict['num_output_tokens']}</td>
+        <td>{stats_dict['time_to_first_token_seconds']:0.2f} s</td>
+        <td>{stats_dict['time_to_summarize_seconds']:0.2f} s</td>
+        <td>{stats_dict.get('cached_input_tokens', 0) + stats_dict.get('cached_output_tokens', 0)}</td>
         <td>{total_cost(stats_dict):0.5f} USD</td>
       </tr>
     </table>
+    {as_html_stages(stats_dict)}
     """
 
-def as_html_diff_summary(lhs_stats_dict, rhs_stats_dict):
-    return f"<h2>OctoAI would cost {total_cost(rhs_stats_dict) / total_cost(lhs_stats_dict):0.3f}x less than OpenAI.</h2>"
+def as_html_diff_summary(lhs_stats_dict, rhs_stats_dict, wall_clock_seconds=None):
+    lhs_seconds, rhs_seconds = lhs_stats_dict["time_to_summarize_seconds"], rhs_stats_dict["time_to_summarize_seconds"]
+    latency_diff = f"{rhs_seconds / lhs_seconds:0.2f}x faster" if lhs_seconds <= rhs_seconds else f"{lhs_seconds / rhs_seconds:0.2f}x slower"
+    lhs_cost, rhs_cost = total_cost(lhs_stats_dict), total_cost(rhs_stats_dict)
+    # NOTE: the costs only count the billed tokens, a side fully served by the completion cache cost nothing
+    cost_diff = (f"OctoAI would cost {rhs_cost / lhs_cost:0.3f}x less than OpenAI." if lhs_cost > 0
+                 else f"OctoAI was fully served by the completion cache, OpenAI would cost {rhs_cost:0.5f} USD.")
+    html = (f"<h2>{cost_diff}</h2>"
+            f"<h2>OctoAI summarized it in {lhs_seconds:0.1f}s vs {rhs_seconds:0.1f}s for OpenAI, {latency_diff}.</h2>")
+    cached_tokens = [stats.get("cached_input_tokens", 0) + stats.get("cached_output_tokens", 0) for stats in (lhs_stats_dict, rhs_stats_dict)]
+    if any(cached_tokens):
+        html += f"<p>Cached tokens, not billed: {cached_tokens[0]} for OctoAI, {cached_tokens[1]} for OpenAI.</p>"
+    if wall_clock_seconds is not None:
+        sequential_seconds = (lhs_stats_dict.get("wall_clock_seconds", lhs_seconds) + rhs_stats_dict.get("wall_clock_seconds", rhs_seconds))
+        html += f"<p>Both ran at the same time in {wall_clock_seconds:0.1f}s, one after the other would take {sequential_seconds:0.1f}s.</p>"
+    return html
 
 
 if __name__ == "__main__":  
@@ -226,35 +651,113 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--use_model", choices=model_choices)
     parser.add_argument("--docs_path", type=str)
+    parser.add_argument("--max_concurrency", type=int, default=8, help="Max number of in-flight requests during the map phase, 1 runs the chunks sequentially")
+
+    parser.add_argument("--batch", action="store_true", help="Summarize all the documents in --docs_path through one shared work queue")
+    parser.add_argument("--max_documents_in_flight", type=int, default=4, help="Max number of documents summarized at the same time in --batch mode")
+
+    parser.add_argument("--matrix_models", nargs="+", choices=model_choices, help="Summarize all the documents in --docs_path with all these models at the same time")
+    parser.add_argument("--max_pairs_in_flight", type=int, default=16, help="Max number of (model, document) pairs summarized at the same time with --matrix_models")
+    parser.add_argument("--results_path", type=str, default="matrix_results.csv", help="CSV or .parquet file where the --matrix_models results are appended as they finish")
+    parser.add_argument("--dedup", action="store_true", help="Remove the paragraphs repeating an earlier one, in the same document or in the documents summarized before")
+    parser.add_argument("--dedup_threshold", type=float, default=0.8, help="Min estimated Jaccard similarity of the word shingles of two repeated paragraphs")
+    parser.add_argument("--ledger_dir", type=str, default=None, help="Write the per-call usage and latency of every (model, document) as JSON in this directory")
+    parser.add_argument("--openai_rpm", type=int, default=None, help="Max OpenAI requests per minute, shared by all the OpenAI models")
+    parser.add_argument("--openai_tpm", type=int, default=None, help="Max OpenAI tokens per minute, shared by all the OpenAI models")
+    parser.add_argument("--octoai_rpm", type=int, default=None, help="Max OctoAI requests per minute, shared by all the OctoAI models")
+    parser.add_argument("--octoai_tpm", type=int, default=None, help="Max OctoAI tokens per minute, shared by all the OctoAI models")
+
+    parser.add_argument("--pdf_cache_dir", type=str, default=".pdf_cache", help="Where to cache the parsed PDFs and their token ids")
+    parser.add_argument("--no_pdf_cache", action="store_true", help="Always parse and tokenize the PDFs from scratch")
+
+    parser.add_argument("--completion_cache_path", type=str, default=".completion_cache.sqlite", help="SQLite file where the chat completions are cached")
+    parser.add_argument("--no_completion_cache", action="store_true", help="Always send the chat completions to the endpoint")
+
+    parser.add_argument("--stream", action="store_true", help="Stream the final summary to stdout and report the time to first token")
 
     parser.add_argument("--as_gradio_app", action="store_true")
     args = parser.parse_args()
 
-    if not args.as_gradio_app:
-        use_oai = True if args.use_model.startswith("gpt") else False
-        model = OpenAIModel(args.use_model) if use_oai else OctoAIModel(args.use_model)
-
-        for doc_name in glob.glob(os.path.join(args.docs_path, "*.pdf")):
-            document = load_parse_pdf(doc_name)
-            stats, summary = benchmark_one(document, doc_name, model)
-            print(stats)
-            print("Summarization cost:", total_cost(stats), "USD")
-            print("-*--*-" * 12)
+    pdf_cache = None if args.no_pdf_cache else PDFCache(args.pdf_cache_dir)
+    if args.ledger_dir is not None:
+        os.makedirs(args.ledger_dir, exist_ok=True)
+    deduplicator = ParagraphDeduplicator(args.dedup_threshold) if args.dedup else None
+    completion_cache = CompletionCache(args.completion_cache_path, enabled=not args.no_completion_cache)
+    model_kwargs = {"max_concurrency": args.max_concurrency, "completion_cache": completion_cache}
+    openai_rate_limiter = ProviderRateLimiter(args.openai_rpm, args.openai_tpm)
+    octoai_rate_limiter = ProviderRateLimiter(args.octoai_rpm, args.octoai_tpm)
+
+    def make_model(model_name):
+        if model_name.startswith("gpt"):
+            return OpenAIModel(model_name, rate_limiter=openai_rate_limiter, **model_kwargs)
+        return OctoAIModel(model_name, rate_limiter=octoai_rate_limiter, **model_kwargs)
+
+    if not args.as_gradio_app and args.matrix_models:
+        doc_names = glob.glob(os.path.join(args.docs_path, "*.pdf"))
+        models = [make_model(model_name) for model_name in args.matrix_models]
+        with ResultsWriter(args.results_path) as results_writer:
+            for doc_name, model, stats, summary in summarize_matrix(doc_names, models, pdf_cache, args.max_pairs_in_flight, args.ledger_dir, deduplicator):
+                results_writer.write(as_result_row(doc_name, model, stats, summary))
+                print(doc_name, model.slug_model_name)
+                print(stats)
+                if not isinstance(stats, Exception):
+                    print("Summarization cost:", total_cost(stats), "USD")
+                print("-*--*-" * 12)
+        print("Results written to", args.results_path)
+        print(f"Waited for the rate limits: OpenAI {openai_rate_limiter.waited_seconds:0.1f}s, OctoAI {octoai_rate_limiter.waited_seconds:0.1f}s (summed over all the calls)")
+    elif not args.as_gradio_app:
+        model = make_model(args.use_model)
+
+        doc_names = glob.glob(os.path.join(args.docs_path, "*.pdf"))
+        if args.batch:
+            for doc_name, stats, summary in summarize_batch(doc_names, model, pdf_cache, args.max_documents_in_flight, args.ledger_dir, deduplicator):
+                print(doc_name)
+                print(stats)
+                if not isinstance(stats, Exception):
+                    print("Summarization cost:", total_cost(stats), "USD")
+                print("-*--*-" * 12)
+        else:
+            for doc_name in doc_names:
+                document = load_document(doc_name, model, pdf_cache, deduplicator)
+                ledger = UsageLedger()
+                stats, summary = benchmark_one(document, doc_name, model, stream=args.stream,
+                                               on_token=(lambda token: print(token, end="", flush=True)) if args.stream else None, ledger=ledger)
+                if args.ledger_dir is not None:
+                    ledger.to_json(ledger_path(args.ledger_dir, doc_name, model))
+                if deduplicator is not None:
+                    stats.update(deduplicator.stats(doc_name, model))
+                if args.stream:
+                    print()
+                print(stats)
+                print("Summarization cost:", total_cost(stats), "USD")
+                print("-*--*-" * 12)
     else:
         import gradio as gr
 
 
         def compare_models(doc_name, octo_model_name, openai_model_name):
-            document = load_parse_pdf(doc_name)
-            octo_model = OctoAIModel(octo_model_name)
-            octo_stats, octo_summary = benchmark_one(document, doc_name, octo_model)
+            # NOTE: both providers run at the same time, every column shows its map progress,
+            #  then its streamed summary, and its stats as soon as it's done
+            start_time = time.perf_counter()
+            models = [make_model(octo_model_name), make_model(openai_model_name)]
+            summaries, streamed, specs, stats = ["", ""], ["", ""], ["", ""], [None, None]
+            for idx, event, payload in stream_benchmarks(doc_name, models, pdf_cache):
+                if event == "progress":
+                    summaries[idx] = payload
+                elif event == "token":
+                    streamed[idx] += payload
+                    summaries[idx] = streamed[idx]
+                elif event == "done":
+                    stats[idx], summaries[idx] = payload
+                    specs[idx] = as_html_spec(stats[idx])
+                else:
+                    summaries[idx] = f"Failed: {payload}"
+                yield summaries[0], summaries[1], specs[0], specs[1], ""
+
+            diff = as_html_diff_summary(stats[0], stats[1], time.perf_counter() - start_time) if None not in stats else ""
+            yield summaries[0], summaries[1], specs[0], specs[1], diff
 
-            openai_model = OpenAIModel(openai_model_name)
-            openai_stats, openai_summary = benchmark_one(document, doc_name, openai_model)
 
-            return octo_summary, openai_summary, as_html_spec(octo_stats), as_html_spec(openai_stats), as_html_diff_summary(octo_stats, openai_stats)
-
-        
         with gr.Blocks() as demo:
             gr.Markdown("# Docs summarization app")
             gr.Markdown("Comparing the cost-efficiency of OpenAI and OctoAI.")
@@ -278,4 +781,4 @@ if __name__ == "__main__":
 
             summarize_btn.click(compare_models, [document_content, octoai_model_pick, openai_model_pick], [octoai_summary, openai_summary, octoai_stats, openai_stats, stats_diff])
 
-        demo.launch()
+        demo.queue().launch()
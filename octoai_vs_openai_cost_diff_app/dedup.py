@@ -0,0 +1,100 @@
+import re
+import threading
+import zlib
+
+import numpy as np
+
+from tokenized_document import PARAGRAPH_BREAK
+
+
+MERSENNE_PRIME = (1 << 31) - 1
+DIGITS = re.compile(r"\d+")
+WHITESPACE = re.compile(r"\s+")
+
+
+class ParagraphDeduplicator:
+    """Removes the paragraphs that repeat an earlier one, within a document and across all the documents seen so far.
+
+    Paragraphs are compared by the Jaccard similarity of their word shingles, estimated with MinHash
+    signatures, and only the pairs sharing a band of their signature (LSH) are compared at all, so
+    every new paragraph is checked against the whole index in constant time. The numbers are
+    normalized away, so page headers and footers only differing by their page number also match.
+    Paragraphs shorter than `min_chars`, or mostly made of digits (tables), are always kept.
+    """
+
+    def __init__(self, threshold=0.8, num_permutations=64, num_bands=16, shingle_size=5, min_chars=20, max_digit_ratio=0.3, seed=0):
+        if num_permutations % num_bands != 0:
+            raise ValueError(f"num_permutations must be a multiple of num_bands, got {num_permutations} and {num_bands}")
+        self.threshold = threshold
+        self.num_bands = num_bands
+        self.shingle_size = shingle_size
+        self.min_chars = min_chars
+        self.max_digit_ratio = max_digit_ratio
+        rng = np.random.default_rng(seed)
+        # NOTE: h -> (a * h + b) mod p, with a, b < 2^31 and 32-bit hashes h, so it never overflows uint64
+        self.a = rng.integers(1, MERSENNE_PRIME, size=(num_permutations, 1), dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, size=(num_permutations, 1), dtype=np.uint64)
+
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.signatures = []
+        # NOTE: the same document is only deduplicated once, e.g. when several models summarize it
+        self.reports = {}
+        self.results = {}
+
+    def is_candidate(self, paragraph):
+        stripped = paragraph.strip()
+        if len(stripped) < self.min_chars:
+            return False
+        return sum(char.isdigit() for char in stripped) / len(stripped) <= self.max_digit_ratio
+
+    def signature(self, paragraph):
+        words = WHITESPACE.sub(" ", DIGITS.sub("0", paragraph.lower())).strip().split(" ")
+        size = min(self.shingle_size, len(words))
+        shingles = {" ".join(words[idx:idx + size]) for idx in range(len(words) - size + 1)}
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        return ((self.a * hashes[None, :] + self.b) % MERSENNE_PRIME).min(axis=1)
+
+    def find_or_add(self, signature):
+        """True if a near-duplicate of the signature is already indexed, otherwise indexes it."""
+        bands = [(band, signature_band.tobytes()) for band, signature_band in enumerate(np.split(signature, self.num_bands))]
+        candidates = {idx for key in bands for idx in self.buckets.get(key, ())}
+        # NOTE: the fraction of equal MinHash values is an unbiased estimate of the Jaccard similarity
+        if any(np.mean(self.signatures[idx] == signature) >= self.threshold for idx in candidates):
+            return True
+
+        for key in bands:
+            self.buckets.setdefault(key, []).append(len(self.signatures))
+        self.signatures.append(signature)
+        return False
+
+    def dedup(self, doc_name, text):
+        """Returns `text` without its repeated paragraphs, the removed ones are listed in `reports[doc_name]`."""
+        with self.lock:
+            if doc_name in self.results:
+                return self.results[doc_name]
+
+            # NOTE: the paragraphs keep their trailing break, so the kept ones join back into the original layout
+            bounds = [0] + [match.end() for match in PARAGRAPH_BREAK.finditer(text)] + [len(text)]
+            paragraphs = [text[start:end] for start, end in zip(bounds, bounds[1:]) if end > start]
+            kept, removed = [], []
+            for paragraph in paragraphs:
+                if self.is_candidate(paragraph) and self.find_or_add(self.signature(paragraph)):
+                    removed.append(paragraph)
+                else:
+                    kept.append(paragraph)
+
+            self.results[doc_name] = "".join(kept)
+            self.reports[doc_name] = {"num_paragraphs": len(paragraphs),
+                                      "num_removed_paragraphs": len(removed),
+                                      "removed_bytes": sum(len(paragraph.encode("utf-8")) for paragraph in removed),
+                                      "removed_paragraphs": removed}
+            return self.results[doc_name]
+
+    def stats(self, doc_name, model):
+        """The removal report of `doc_name`, with the removed tokens counted by the tokenizer of `model`."""
+        report = self.reports[doc_name]
+        return {"dedup_num_paragraphs": report["num_paragraphs"],
+                "dedup_removed_paragraphs": report["num_removed_paragraphs"],
+                "dedup_removed_bytes": report["removed_bytes"],
+                "dedup_removed_tokens": sum(model.get_num_tokens_batch(report["removed_paragraphs"]))}
@@ -0,0 +1,55 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at `rate_per_minute`, holding at most `capacity` tokens.
+
+    `acquire` blocks until the requested amount is available, the waiting callers are served first come, first served.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60
+        # NOTE: by default a whole minute of budget can be spent at once, like the providers' limits
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.available = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.turn = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+    def acquire(self, amount=1):
+        # NOTE: a request larger than the bucket could never go through, so it only waits for a full bucket
+        amount = min(amount, self.capacity)
+        with self.turn:
+            while True:
+                with self.lock:
+                    self._refill()
+                    if self.available >= amount:
+                        self.available -= amount
+                        return
+                    wait_seconds = (amount - self.available) / self.rate_per_second
+                time.sleep(wait_seconds)
+
+
+class ProviderRateLimiter:
+    """Requests per minute and tokens per minute limits of one provider, shared by all its models."""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.lock = threading.Lock()
+        self.waited_seconds = 0.0
+
+    def acquire(self, num_tokens):
+        start_time = time.perf_counter()
+        if self.requests is not None:
+            self.requests.acquire(1)
+        if self.tokens is not None:
+            self.tokens.acquire(num_tokens)
+        with self.lock:
+            self.waited_seconds += time.perf_counter() - start_time
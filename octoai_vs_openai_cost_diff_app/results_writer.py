@@ -0,0 +1,70 @@
+import csv
+import os
+import threading
+
+
+RESULT_FIELDS = ["doc_name", "model_name", "provider", "status", "error", "num_input_tokens", "num_output_tokens", "num_calls",
+                 "cached_input_tokens", "cached_output_tokens", "time_to_summarize_seconds", "time_to_first_token_seconds", "wall_clock_seconds", "cost_usd",
+                 "cache_hits", "cache_misses", "dedup_removed_bytes", "dedup_removed_tokens", "summary"]
+
+
+class ResultsWriter:
+    """Appends one row per finished (model, document) pair to a CSV or Parquet file.
+
+    The CSV rows are on disk as soon as they're written. The Parquet rows are buffered and written as one
+    row group every `row_group_size` rows, and the file is only readable once closed, so use the writer as
+    a context manager.
+    """
+
+    def __init__(self, path, row_group_size=256):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.rows = []
+        self.lock = threading.Lock()
+        self.is_parquet = os.path.splitext(path)[1] in (".parquet", ".pq")
+        if self.is_parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            string_fields = {"doc_name", "model_name", "provider", "status", "error", "summary"}
+            int_fields = {"num_input_tokens", "num_output_tokens", "num_calls", "cached_input_tokens", "cached_output_tokens", "cache_hits", "cache_misses", "dedup_removed_bytes", "dedup_removed_tokens"}
+            self.schema = pa.schema([(name, pa.string() if name in string_fields else pa.int64() if name in int_fields else pa.float64())
+                                     for name in RESULT_FIELDS])
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            self.file = open(path, "w", newline="", encoding="utf-8")
+            self.writer = csv.DictWriter(self.file, fieldnames=RESULT_FIELDS)
+            self.writer.writeheader()
+            self.file.flush()
+
+    def write(self, row):
+        row = {name: row.get(name) for name in RESULT_FIELDS}
+        with self.lock:
+            if self.is_parquet:
+                self.rows.append(row)
+                if len(self.rows) >= self.row_group_size:
+                    self.flush_rows()
+            else:
+                self.writer.writerow(row)
+                self.file.flush()
+
+    def flush_rows(self):
+        import pyarrow as pa
+
+        if self.rows:
+            self.writer.write_table(pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        with self.lock:
+            if self.is_parquet:
+                self.flush_rows()
+                self.writer.close()
+            else:
+                self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
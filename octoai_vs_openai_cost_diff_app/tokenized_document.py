@@ -0,0 +1,80 @@
+import re
+
+import numpy as np
+
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+SENTENCE_BREAK = re.compile(r"[.!?][\"')\]]*\s+")
+
+
+class TokenizedDocument:
+    """A text tokenized once, together with the character span of every token.
+
+    Slicing a document slices the token ids and offsets, so chunks never have
+    to be re-tokenized or decoded back into text.
+    """
+
+    def __init__(self, text, token_ids, offsets):
+        self.text = text
+        self.token_ids = np.asarray(token_ids, dtype=np.int32)
+        # NOTE: (num_tokens, 2) array with the [start, end) character offsets of each token in `text`
+        self.offsets = np.asarray(offsets, dtype=np.int32).reshape(-1, 2)
+        self._breaks = {}
+
+    @classmethod
+    def from_text(cls, text, tokenizer):
+        if hasattr(tokenizer, "decode_with_offsets"):
+            # NOTE: tiktoken encodings, the BPE is lossless so the decoded text is the original text
+            token_ids = tokenizer.encode(text, disallowed_special=())
+            _, starts = tokenizer.decode_with_offsets(token_ids)
+            return cls(text, token_ids, list(zip(starts, starts[1:] + [len(text)])))
+
+        token_ids, offsets = tokenizer.encode_with_offsets(text)
+        return cls(text, token_ids, offsets)
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def __str__(self):
+        return self.text
+
+    def slice(self, start, end):
+        token_ids = self.token_ids[start:end]
+        offsets = self.offsets[start:end]
+        if len(offsets) == 0:
+            return TokenizedDocument("", token_ids, offsets)
+
+        char_start, char_end = offsets[0, 0], offsets[-1, 1]
+        return TokenizedDocument(self.text[char_start:char_end], token_ids, offsets - char_start)
+
+    def break_points(self, pattern):
+        """Sorted token indices right after every match of `pattern`, i.e. where a chunk can start."""
+        if pattern.pattern not in self._breaks:
+            char_positions = np.fromiter((match.end() for match in pattern.finditer(self.text)), dtype=np.int64)
+            self._breaks[pattern.pattern] = np.unique(np.searchsorted(self.offsets[:, 0], char_positions, side="left"))
+        return self._breaks[pattern.pattern]
+
+    def chunk_end(self, start, max_tokens, min_fill=0.5):
+        """Token index where the chunk starting at `start` should end.
+
+        Prefers the last paragraph break within `max_tokens`, then the last sentence break,
+        and cuts mid-sentence only if neither keeps at least `min_fill` of the budget.
+        """
+        end = min(start + max_tokens, len(self))
+        if end == len(self):
+            return end
+
+        lowest = start + max(1, int(max_tokens * min_fill))
+        for pattern in (PARAGRAPH_BREAK, SENTENCE_BREAK):
+            breaks = self.break_points(pattern)
+            idx = np.searchsorted(breaks, end, side="right") - 1
+            if idx >= 0 and breaks[idx] >= lowest:
+                return int(breaks[idx])
+        return end
+
+    def iter_chunks(self, max_tokens):
+        start = 0
+        while start < len(self):
+            end = self.chunk_end(start, max_tokens)
+            yield self.slice(start, end)
+            start = end
@@ -0,0 +1,73 @@
+"""Process-wide registry of tokenizers, loaded once from a local `tokenizer.json`.
+
+Only the first use of a tokenizer needs the network, afterwards it's read from
+TOKENIZER_CACHE_DIR with the `tokenizers` library, without importing `transformers`.
+To fetch the tokenizers ahead of time, e.g. for offline runs, execute
+
+python tokenizer_registry.py mistralai/Mixtral-8x7B-Instruct-v0.1 NousResearch/Llama-2-70b-chat-hf
+"""
+import hashlib
+import os
+import shutil
+import sys
+import threading
+
+from tokenizers import Tokenizer
+
+
+TOKENIZER_CACHE_DIR = os.environ.get("TOKENIZER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "octoai_cookbook", "tokenizers"))
+
+_TOKENIZERS = {}
+_LOCK = threading.Lock()
+
+
+class FastTokenizer:
+    """The subset of the `transformers` tokenizer API used by the summarizers, on top of `tokenizers.Tokenizer`."""
+
+    def __init__(self, tokenizer, digest=None):
+        self.tokenizer = tokenizer
+        # NOTE: the SHA-256 of the `tokenizer.json` it was loaded from, so the caches of its token ids can tell its versions apart
+        self.digest = digest
+
+    def encode(self, text, add_special_tokens=True):
+        return self.tokenizer.encode(text, add_special_tokens=add_special_tokens).ids
+
+    def encode_with_offsets(self, text):
+        encoding = self.tokenizer.encode(text, add_special_tokens=False)
+        return encoding.ids, encoding.offsets
+
+    def encode_batch(self, texts, add_special_tokens=True):
+        # NOTE: the texts are encoded in parallel by the Rust threads of `tokenizers`
+        return [encoding.ids for encoding in self.tokenizer.encode_batch(list(texts), add_special_tokens=add_special_tokens)]
+
+    def get_vocab(self):
+        return self.tokenizer.get_vocab()
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return self.tokenizer.decode(list(token_ids), skip_special_tokens=skip_special_tokens)
+
+
+def local_tokenizer_path(name):
+    path = os.path.join(TOKENIZER_CACHE_DIR, name.replace("/", "--"), "tokenizer.json")
+    if not os.path.exists(path):
+        from huggingface_hub import hf_hub_download
+
+        downloaded_path = hf_hub_download(name, "tokenizer.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(downloaded_path, path + ".tmp")
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def get_tokenizer(name):
+    with _LOCK:
+        if name not in _TOKENIZERS:
+            with open(local_tokenizer_path(name), "rb") as f:
+                data = f.read()
+            _TOKENIZERS[name] = FastTokenizer(Tokenizer.from_str(data.decode("utf-8")), hashlib.sha256(data).hexdigest())
+        return _TOKENIZERS[name]
+
+
+if __name__ == "__main__":
+    for tokenizer_name in sys.argv[1:]:
+        print(tokenizer_name, "->", local_tokenizer_path(tokenizer_name))